@@ -30,6 +30,17 @@ from utilities import ports_finder
 from utilities import safe_serial
 from utilities import log
 import weakref
+import numpy as np
+
+# Current (pA), the instrument's timestamp (s) and its status word, from one READ? reply.
+KI_RECORD = np.dtype([('CURRENT', 'f8'), ('INSTR_TIME', 'f8'), ('STATUS', 'i4')])
+
+def _record(current: float, instr_time: float = float('nan'), status: int = -1):
+    rec = np.zeros((), dtype=KI_RECORD)
+    rec['CURRENT'] = current
+    rec['INSTR_TIME'] = instr_time
+    rec['STATUS'] = status
+    return rec[()]
 
 class KI_Picoammeter:
     def __init__(self, samples: int, man_port: str = None):
@@ -143,7 +154,16 @@ class KI_Picoammeter:
         """ Requests a detector sample from the device.
 
         Returns:
-            _type_: The detector's output value.
+            float: The detector's output value, in pA.
+        """
+
+        return float(self.detect_record()['CURRENT'])
+
+    def detect_record(self):
+        """ Requests a detector sample from the device, keeping the timestamp and status words of the reply.
+
+        Returns:
+            np.void: A record of dtype KI_RECORD. CURRENT is ERR_VAL and STATUS is -1 if the read failed.
         """
 
         ERR_VAL = -999.0
@@ -169,7 +189,7 @@ class KI_Picoammeter:
                 retry_ser -= 1
             if retry_ser <= 0 and len(buf) == 0:
                 log.error('ERROR: Unable to receive anything from the picoammeter.')
-                return ERR_VAL
+                return _record(ERR_VAL)
             out = buf
 
             # OK:
@@ -203,20 +223,25 @@ class KI_Picoammeter:
         if num_read_err_flag:
             # err_val = -999.0
             log.error('ERROR: Failed to get a proper value from the detector. Substituting %d for the value. This should never happen, and indicates a significant failure of detector-program communications. Please send the log file to the developer immediately.'%(ERR_VAL))
-            return ERR_VAL
+            return _record(ERR_VAL)
 
         if words is None:
             # err_val = -999.0
             log.error("For some reason, words is NoneType and yet made it to the end of detect.")
-            return ERR_VAL
+            return _record(ERR_VAL)
 
         log.debug("About to subscript 'words'.")
         mes = float(words[0][:-1]) # skips the A (unit suffix)
-        # err = int(float(words[2])) # skip timestamp
+        try:
+            instr_time = float(words[1])
+            status = int(float(words[2]))
+        except ValueError:
+            log.warn('Could not parse the timestamp and status of:', words)
+            instr_time, status = float('nan'), -1
 
         mes *= 1e12 # Converts from A to pA
  
-        return mes
+        return _record(mes, instr_time, status)
 
     def __del__(self):
         """ KI6485 destructor.
@@ -272,15 +297,23 @@ class KI_Picoammeter_Dummy:
         self.samples = samples
 
     def detect(self):
-        import numpy as np
+        """ Requests a detector sample from the device.
+
+        Returns:
+            float: The detector's output value, in pA.
+        """
+
+        return float(self.detect_record()['CURRENT'])
+
+    def detect_record(self):
         # return np.random.random()
         # out = np.random.random(2)
         # return '%eA,%e,0'%(out[0], out[1])
 
-        """ Requests a detector sample from the device.
+        """ Requests a detector sample from the device, keeping the timestamp and status words of the reply.
 
         Returns:
-            _type_: The detector's output value.
+            np.void: A record of dtype KI_RECORD. CURRENT is ERR_VAL and STATUS is -1 if the read failed.
         """
 
         ERR_VAL = -999.0
@@ -310,7 +343,7 @@ class KI_Picoammeter_Dummy:
                 retry_ser -= 1
             if retry_ser <= 0 and len(buf) == 0:
                 log.error('ERROR: Unable to receive anything from the picoammeter.')
-                return ERR_VAL
+                return _record(ERR_VAL)
             out = buf
 
             log.debug(f'outp: {outp}')
@@ -341,23 +374,28 @@ class KI_Picoammeter_Dummy:
         if num_read_err_flag:
             # err_val = -999.0
             log.error('ERROR: Failed to get a proper value from the detector. Substituting %d for the value. This should never happen, and indicates a significant failure of detector-program communications. Please send the log file to the developer immediately.'%(ERR_VAL))
-            return ERR_VAL
+            return _record(ERR_VAL)
 
         if words is None:
             # err_val = -999.0
             log.error("For some reason, words is NoneType and yet made it to the end of detect.")
-            return ERR_VAL
+            return _record(ERR_VAL)
 
         log.debug("About to subscript 'words'.")
         mes = float(words[0][:-1]) # skips the A (unit suffix)
-        # err = int(float(words[2])) # skip timestamp
+        try:
+            instr_time = float(words[1])
+            status = int(float(words[2]))
+        except ValueError:
+            log.warn('Could not parse the timestamp and status of:', words)
+            instr_time, status = float('nan'), -1
 
         mes *= 1e12 # Converts from A to pA
  
         mes = self.prev_mes + np.random.normal(0, 1)
         self.prev_mes = mes
 
-        return mes
+        return _record(mes, instr_time, status)
 
     def __del__(self):
         pass
@@ -23,7 +23,6 @@
 #
 
 import time
-import directnet
 from utilities import ports_finder
 from utilities import safe_serial
 from threading import Lock
@@ -89,25 +88,68 @@ or the 747 power cycled.
 
 class MP_747(StageDevice):
     WR_DLY = 0.05
-
-    ENQ = bytearray(b'N!\x05')
-    ACK = bytearray(b'N!\x06')
-    NACK = bytearray(b'N!\x15')
-    EOT = bytearray(b'\x15')
-    STX = bytearray(b'\x02')
-    ETX = bytearray(b'\x03')
+    POLL_DLY = 0.05
+    MOVE_TIMEOUT = 60
+    RETRIES = 5
+
+    # Link-level messages.
+    ENQ = b'N!\x05'
+    ACK = b'N!\x06'
+    NACK = b'N!\x15'
+    EOT = b'\x04'
+
+    # Framing bytes.
+    SOH = 0x01
+    STX = 0x02
+    ETX = 0x03
+    ETB = 0x17
+
+    # Response sizes, in bytes. Reading exactly these avoids waiting out the serial timeout on every read.
+    ACK_LEN = 3
+    HEADER_LEN = 18
+    DATA_LEN = 8
+
+    # Hex ASCII V-memory reference addresses (see the V-Memory notes above).
+    ADDR_FLAGS = '4181' # Error flag (bit 8); increment position bits (bits 0 - 3).
+    ADDR_MOTION = '4182' # Any device in motion (bit 0); devices 1 - 4 in motion (bits 1 - 4).
+    ADDR_INIT = '4183' # Devices 1 - 4 require initialization (bits 0 - 3).
+    ADDR_POSITION = ['04A1', '04A2', '04A3', '04A4']
+    ADDR_DESTINATION = ['04A9', '04AA', '04AB', '04AC']
+
+    # Frames which never change (status query headers, small data blocks) are built once and reused. The fixed status
+    # query headers are precomputed when this module is imported.
+    _FRAME_CACHE = {}
 
     def backend(self)->str:
         return 'MP_747'
 
-    def __init__(self, port):
+    def __init__(self, port, device: int = 1, positions: int = None):
+        """ MP_747 constructor.
+
+        Args:
+            port (str): The port on which to attempt a connection.
+            device (int, optional): Which of the 747's four devices (1 - 4) this instance controls. Defaults to 1.
+            positions (int, optional): Number of physical positions of the device. If given, destinations beyond it are refused. Defaults to None.
+
+        Raises:
+            RuntimeError: Raised if `port` is NoneType.
+            RuntimeError: Raised if `port` is not found in the list of available ports; may already be in use.
+            RuntimeError: Raised if `device` is not 1 - 4.
+            RuntimeError: Raised if the 747 does not answer an enquiry.
+            RuntimeError: Raised if the device could not be initialized.
+        """
+
         self.s_name = 'MP747'
         self.l_name = 'McPherson 747'
-        self._is_homing = False
+        self._homing = False
         self._moving = False
-        self.moving_poll_mutex = Lock()
         self.stop_queued = 0
         self._position = 0
+        self._device = device
+        self._positions = positions
+
+        self._home_speed_mult = 1
+        self._move_speed_mult = 1
 
         log.info('Attempting to connect to McPherson Model 747 Device Controller on port %s.'%(port))
 
@@ -115,6 +157,10 @@ class MP_747(StageDevice):
         if port is None:
             log.error('Port is none type.')
             raise RuntimeError('Port is nonetype.')
+
+        if device < 1 or device > 4:
+            log.error('Invalid device number %d; must be 1 - 4.'%(device))
+            raise RuntimeError('Invalid device number %d; must be 1 - 4.'%(device))
         
         # Check if the port is available.
         ser_ports = ports_finder.find_serial_ports()
@@ -123,58 +169,132 @@ class MP_747(StageDevice):
             raise RuntimeError('Port not valid. Is another program using the port?')
         
         # Get a SafeSerial connection on the port and begin communication.
+        # Using 0.8s timeout, as the manual suggests, results in the 747 cancelling comms due to it timing-out internally. 0.5s avoids this.
         self.s = safe_serial.SafeSerial(port, 9600, timeout=0.5)
-        
-        # TODO: Begin communication a la 789, and get rid of these weird functions.
 
         # A short communication to determine if the 747 is alive / exists.
         if not self._comms_detect():
             log.error('Could not detect MP747 on port %s.'%(port))
             raise RuntimeError('Could not detect MP747 on port %s.'%(port))
         
-        # Initialize the 747.
-        if not self._comms_init(True, False, False, False):
-            log.error('Could not initialize MP747 on port %s.'%(port))
-            raise RuntimeError('Could not initialize MP747 on port %s.'%(port))
+        # Initialize the device.
+        if not self.home():
+            log.error('Could not initialize MP747 device %d on port %s.'%(device, port))
+            raise RuntimeError('Could not initialize MP747 device %d on port %s.'%(device, port))
 
-        # May not be desired / applicable???
-        self.home()
+    # Low-level link helpers. These must only be called with the port lock held (see _read_word() and _write_word()).
+    def _send(self, buf: bytes):
+        self.s._write(bytes(buf), eol=b'')
 
-    # The _comms functions help hide some of the complexity of the 747's communication protocol.
-    def _comms_detect(self)->bool:
-        """ Detects whether we are able to talk to an MP747.
+    def _recv(self, size: int)->bytes:
+        return self.s._read(size, delay=0)
+
+    def _enquire(self)->bool:
+        self._send(MP_747.ENQ)
+        return self._parse_ack(self._recv(MP_747.ACK_LEN))
+
+    def _abort(self):
+        # An EOT from the master ends any transaction in progress.
+        self._send(MP_747.EOT)
+
+    def _read_word(self, addr: str)->int or None:
+        """ Performs a complete read request for one V-memory word.
+
+        Args:
+            addr (str): Hex ASCII reference address.
+
+        Returns:
+            int or None: The word, or None if the 747 did not complete the transaction.
+        """
+
+        for attempt in range(MP_747.RETRIES):
+            self.s._lock_override()
+            try:
+                if not self._enquire():
+                    self._abort()
+                    continue
+
+                self._send(self._frame('r', addr)) # Header
+                if not self._parse_ack(self._recv(MP_747.ACK_LEN)):
+                    self._abort()
+                    continue
+
+                value = self._parse_data(self._recv(MP_747.DATA_LEN))
+                if value is None:
+                    self._abort()
+                    continue
+
+                self._send(MP_747.ACK)
+                self._recv(len(MP_747.EOT)) # Expected: EOT
+                self._send(MP_747.EOT)
+                return value
+            finally:
+                self.s._release_override()
+
+        log.error('747 read of %s failed after %d attempts.'%(addr, MP_747.RETRIES))
+        return None
+
+    def _write_word(self, addr: str, value: int)->bool:
+        """ Performs a complete write request for one V-memory word.
+
+        Args:
+            addr (str): Hex ASCII reference address.
+            value (int): The word to write (0 - 0xFFFF).
 
         Returns:
             bool: False on failure, True on success.
         """
 
-        TO_RETRIES = 5
-        to_retries = 0
-        while (to_retries < TO_RETRIES):
-            self.s.write(MP_747.ENQ)
-            msg = self.s.read(128)
-
-            if msg != MP_747.ACK:
-                if MP_747.EOT in msg:
-                    # The 747 timed-out internally.
-                    log.warn('747 timed-out internally.')
-                    to_retries += 1
+        data = self._frame_data(value)
+
+        for attempt in range(MP_747.RETRIES):
+            self.s._lock_override()
+            try:
+                if not self._enquire():
+                    self._abort()
                     continue
-                return False
 
-            self.s.write(MP_747.EOT)
-            msg = self.s.read(128)
+                self._send(self._frame('w', addr)) # Header
+                if not self._parse_ack(self._recv(MP_747.ACK_LEN)):
+                    self._abort()
+                    continue
 
-            self.s.write(MP_747.EOT)
-            break
+                self._send(data) # Data block
+                acked = self._parse_ack(self._recv(MP_747.ACK_LEN))
+                self._send(MP_747.EOT)
+                if acked:
+                    return True
+            finally:
+                self.s._release_override()
 
-        return True
+        log.error('747 write of %s to %s failed after %d attempts.'%(value, addr, MP_747.RETRIES))
+        return False
+
+    # The _comms functions help hide some of the complexity of the 747's communication protocol.
+    def _comms_detect(self)->bool:
+        """ Detects whether we are able to talk to an MP747.
+
+        Returns:
+            bool: False on failure, True on success.
+        """
+
+        for attempt in range(MP_747.RETRIES):
+            self.s._lock_override()
+            try:
+                acked = self._enquire()
+                self._abort()
+            finally:
+                self.s._release_override()
+            if acked:
+                return True
+
+        return False
 
     def _comms_init(self, dev_1: bool, dev_2: bool, dev_3: bool, dev_4: bool)->bool:
-        """ Initializes the 747.
+        """ Initializes devices on the 747 by setting their increment position bits.
 
         Args:
-            dev_maske (int): Four-bit binary mask, 1 = init, 0 = ignore. Bits 0-3 correspond to devices 1-4.
+            dev_1 - dev_4 (bool): True to initialize the device.
         
         Returns:
             bool: False on failure, True on success.
@@ -191,81 +311,61 @@ class MP_747(StageDevice):
         if dev_4:
             dev_mask |= 8
 
-        if dev_mask < 0 or dev_mask > 15:
-            log.error('Invalid device mask.')
-            raise RuntimeError('Invalid device mask.')
-        
-        # Convert the bitmask to a string in hex format. `hex()` gives us '0x', so [2:] skips that. This gives us the data we want to write in this scenario.
-        dev_mask_str = hex(dev_mask)[2:]
-        log.debug('Bitmask as a hex string:', dev_mask_str)
-
-        self.s.write(MP_747.ENQ) # Enquiry
-        msg = self.s.read(128) # Expected: ACK
+        log.debug('Initialization bitmask:', dev_mask)
 
-        if msg != MP_747.ACK:
-            return False
-        
-        header = self._header('w', '4181')
-        if header is None:
-            return False
-        
-        self.s.write(header) # Header
-        msg = self.s.read(128) # Expected: ACK
+        return self._write_word(MP_747.ADDR_FLAGS, dev_mask)
 
-        # UNKNOWN WHAT WILL BE RETURNED HERE. CHECK BEFORE PROCEEDING.
-        print(msg)
-
-        data = self._data(dev_mask_str) # Generates a 747-friendly data block.
-        if data is None:
-            return False
-        self.s.write(data) # Writes the data block.
-        msg = self.s.read(128) # Expected: ACK
-
-        # UNKNOWN WHAT WILL BE RETURNED HERE. CHECK BEFORE PROCEEDING.
-        print(msg)
-
-        # Supposedly after that last ACK, we are supposed to send more data (??) and then another ACK, etc.
-        # Here I just assume one set of data is enough and finish.
-
-        self.s.write(MP_747.EOT)
+    def _comms_query_motion(self, device: int)->bool or None:
+        """ Queries the MP747 for its motion status.
 
-        return True
+        Args:
+            device (int): 0 for any motion, 1 - 4 for a specific device's motion.
 
-        # Header ->
-        # <- ACK
-        # <- DATA
-        # ACK ->
-        # <- DATA
-        # ACK ->
-        # <- EOT
-        # EOT ->
+        Returns:
+            bool or None: In motion (True), stopped (False) or unknown (None).
+        """
 
+        # From the In Motion Flags entry of the 747 manual's V-memory map (quoted at the top of this file): octal
+        # address 40601, bits 16 - 20, with bit 16 set while any device moves and bits 17 - 20 for devices 1 - 4. V
+        # memory is addressed in 16-bit words, so bit 16 is read here as bit 0 of the word at 40601 (reference 4182)
+        # and device n as bit n. This reading of the manual has not been checked on real hardware; MP_747_SIM was
+        # written from the same assumption.
+        word = self._read_word(MP_747.ADDR_MOTION)
+        if word is None:
+            return None
+        return bool(word & (1 << device))
 
-    def _comms_query_motion(self, device: int):
-        """ Queries the MP747 for its motion status.
+    def _comms_query_init(self, device: int)->bool or None:
+        """ Queries whether a device requires initialization.
 
         Args:
-            device (int): 0 for any motion, 1 - 4 for a specific device's motion.
+            device (int): 1 - 4 for a specific device.
         """
 
-        pass
+        word = self._read_word(MP_747.ADDR_INIT)
+        if word is None:
+            return None
+        return bool(word & (1 << (device - 1)))
 
-    def _comms_query_error(self):
+    def _comms_query_error(self)->bool or None:
         """ Queries the MP747 for its error status.
         """
 
-        pass
+        word = self._read_word(MP_747.ADDR_FLAGS)
+        if word is None:
+            return None
+        return bool(word & (1 << 8))
 
-    def _comms_query_position(self, device: int):
+    def _comms_query_position(self, device: int)->int or None:
         """ Queries the MP747 for the position of a device.
 
         Args:
             device (int): 1 - 4 for a specific device.
         """
 
-        pass
+        return self._read_word(MP_747.ADDR_POSITION[device - 1])
 
-    def _comms_set_destination(self, device: int, position: int):
+    def _comms_set_destination(self, device: int, position: int)->bool:
         """ Sets the destination of a device.
 
         Args:
@@ -273,22 +373,72 @@ class MP_747(StageDevice):
             position (int): The position to set the device to.
         """
 
-        pass
-    
-    def _lrc(self, data: bytearray)->bytearray or None:
-        pass
+        return self._write_word(MP_747.ADDR_DESTINATION[device - 1], position)
+
+    @staticmethod
+    def _parse_ack(msg: bytes)->bool:
+        """ Validates a three-byte acknowledgement from the 747.
+
+        Returns:
+            bool: True for ACK; False for NACK, an internal time-out (EOT) or anything else.
+        """
+
+        if msg == MP_747.ACK:
+            return True
+
+        if msg == MP_747.NACK:
+            log.warn('747 replied NACK.')
+        elif len(msg) == 0:
+            log.warn('747 did not reply.')
+        elif MP_747.EOT in msg:
+            log.warn('747 timed-out internally.')
+        else:
+            log.warn('Unexpected reply from 747:', msg)
+        return False
+
+    @staticmethod
+    def _parse_data(block: bytes)->int or None:
+        """ Validates a 747 data block and extracts its word.
+
+        Returns:
+            int or None: The word, or None if the block is malformed or fails its LRC.
+        """
 
-    def _data(self, data: str)->bytearray or None:
+        if len(block) != MP_747.DATA_LEN or block[0] != MP_747.STX or block[5] != MP_747.ETX:
+            log.warn('Malformed 747 data block:', block)
+            return None
+
+        payload = block[1:5]
+        if block[6:8] != MP_747._lrc(payload):
+            log.warn('747 data block failed LRC check:', block)
+            return None
+
+        # Bytes arrive as data byte #3, #4, #1, #2.
+        try:
+            return int((payload[2:4] + payload[0:2]).decode('ascii'), 16)
+        except ValueError:
+            log.warn('747 data block is not hex ASCII:', block)
+            return None
+
+    @staticmethod
+    def _lrc(data: bytes)->bytes:
+        """ Computes the LRC of a message as two hex ASCII characters.
+        """
+
+        return b'%02X'%(lrc(data))
+
+    @staticmethod
+    def _data(data: str)->bytes:
         """ Builds a 747 data block.
 
         Args:
-            data (str): The data to be written.
+            data (str): The four hex ASCII characters to be written.
 
         Raises:
-            RuntimeError: _description_
+            RuntimeError: Raised if `data` is not a four-character string.
 
         Returns:
-            _type_: _description_
+            bytes: The data block.
         """
 
         if type(data) is not str:
@@ -299,20 +449,18 @@ class MP_747(StageDevice):
             log.error('The data parameter must be four characters long.')
             raise RuntimeError('The data parameter must be four characters long.')
 
+        payload = (data[2:4] + data[0:2]).encode('ascii')
+
         data_block = bytearray()
         data_block.append(MP_747.STX)
-        data_block.append(data[2])
-        data_block.append(data[3])
-        data_block.append(data[0])
-        data_block.append(data[1])
+        data_block += payload
         data_block.append(MP_747.ETX)
-        lrc = self._lrc(data_block[1:5])
-        data_block.append(lrc[0]) # LRC byte #1
-        data_block.append(lrc[1]) # LRC byte #2
+        data_block += MP_747._lrc(payload)
 
-        return data_block
+        return bytes(data_block)
 
-    def _header(self, rw: str, str_data_addr: str)->bytearray or None:
+    @staticmethod
+    def _header(rw: str, str_data_addr: str)->bytes:
         """ Builds a 747 header.
 
         Args:
@@ -320,10 +468,10 @@ class MP_747(StageDevice):
             str_data_addr (str): The four-character ASCII address to access (e.g. '04A1').
 
         Raises:
-            RuntimeError: _description_
+            RuntimeError: Raised if the address or read/write value is invalid.
 
         Returns:
-            _type_: _description_
+            bytes: The header.
         """
 
         if type(str_data_addr) is not str:
@@ -335,7 +483,7 @@ class MP_747(StageDevice):
             raise RuntimeError('The str_data_addr parameter must be four characters long.')
 
         header = bytearray()
-        header.append(0x1) # SOH
+        header.append(MP_747.SOH)
         header.append(0x30) # Controller address
         header.append(0x31) # Controller address
 
@@ -350,12 +498,8 @@ class MP_747(StageDevice):
         
         header.append(0x31) # Data type (V Memory)
         
-        # Append mem addr MSB
-        header.append(0x30)
-        header.append(0x30)
-        # Append mem addr LSB
-        header.append(0x30)
-        header.append(0x30)
+        # Memory address MSB, LSB.
+        header += str_data_addr.upper().encode('ascii')
         
         # For remote control of the 747, the full data blocks should never need to be used.
         header.append(0x30) # Complete data blocks (none)
@@ -366,14 +510,54 @@ class MP_747(StageDevice):
 
         header.append(0x30) # Host computer address
         header.append(0x31) # Host computer address
-        header.append(0x17) # ETB
+        header.append(MP_747.ETB)
 
-        # Append LRC checksum
-        log.warn('LRC checksum not yet implemented.')
-        header.append(0x00) # LRC CS
-        header.append(0x00) # LRC CS
+        # LRC over everything between SOH and ETB.
+        header += MP_747._lrc(header[1:15])
 
-        return header
+        return bytes(header)
+
+    @staticmethod
+    def _frame(rw: str, addr: str)->bytes:
+        frame = MP_747._FRAME_CACHE.get((rw, addr))
+        if frame is None:
+            frame = MP_747._header(rw, addr)
+            MP_747._FRAME_CACHE[(rw, addr)] = frame
+        return frame
+
+    @staticmethod
+    def _frame_data(value: int)->bytes:
+        if value < 0 or value > 0xFFFF:
+            log.error('Value %d does not fit in a V-memory word.'%(value))
+            raise RuntimeError('Value %d does not fit in a V-memory word.'%(value))
+
+        frame = MP_747._FRAME_CACHE.get(('d', value))
+        if frame is None:
+            frame = MP_747._data('%04X'%(value))
+            MP_747._FRAME_CACHE[('d', value)] = frame
+        return frame
+
+    def _wait_for_motion(self, timeout: float = MOVE_TIMEOUT)->bool:
+        """ Polls until this device reports it is stopped, then checks the error flag.
+
+        Returns:
+            bool: True if the device stopped without error.
+        """
+
+        start_time = time.time()
+        while True:
+            moving = self._comms_query_motion(self._device)
+            if moving is False:
+                break
+            if time.time() - start_time > timeout:
+                log.error('Timed out waiting for 747 device %d to stop.'%(self._device))
+                return False
+            time.sleep(MP_747.POLL_DLY)
+
+        if self._comms_query_error():
+            log.error('747 reports a system error. The device may need to be initialized or the 747 power cycled.')
+            return False
+        return True
 
     def set_stage(self, stage):
         pass
@@ -382,49 +566,113 @@ class MP_747(StageDevice):
         return None
 
     def home(self)->bool:
-        """_summary_
+        """ Initializes the device, which drives it to its first position.
 
         Returns:
-            bool: _description_
+            bool: Success (True) or failure (False).
         """
 
-        pass
+        log.info('Beginning initialization of 747 device %d.'%(self._device))
+        self._homing = True
+        try:
+            if not self._comms_init(*[self._device == d for d in range(1, 5)]):
+                return False
+
+            if not self._wait_for_motion():
+                return False
+
+            position = self._comms_query_position(self._device)
+            if position is not None:
+                self._position = position
+        finally:
+            self._homing = False
+
+        return True
 
     def get_position(self):
-        """_summary_
+        """ Returns the current position of the device, as reported by the 747.
         """
 
-        pass
+        position = self._comms_query_position(self._device)
+        if position is not None:
+            self._position = position
+        return self._position
 
     def stop(self):
-        """_summary_
+        """ The 747 has no stop command; the device always completes its move.
         """
 
-        pass
+        self.stop_queued = 1
+        log.warn('The 747 cannot stop a device mid-move.')
+
+    def emergency_stop(self):
+        self.stop()
+        return None
 
     def is_moving(self):
-        """_summary_
+        """ Returns whether the device is in motion.
         """
 
-        pass
+        if self._homing:
+            return True
+
+        moving = self._comms_query_motion(self._device)
+        if moving is None:
+            return self._moving
+        return moving
 
     def is_homing(self):
-        """_summary_
+        """ Return initialization status.
         """
 
-        pass
+        return self._homing
 
-    def move_to(self, position: int, backlash: int):
-        pass
+    def move_to(self, position: int, backlash: int = None):
+        """ Sends the device directly to a position. Backlash correction does not apply to the 747.
+
+        Args:
+            position (int): The destination position (1 or greater).
+            backlash (int, optional): Ignored.
+
+        Raises:
+            RuntimeError: Raised if the position is invalid or the move fails.
+        """
+
+        position = int(position)
+        if position < 1 or (self._positions is not None and position > self._positions):
+            # Writing a destination beyond the device's physical positions latches an error in the 747.
+            log.error('Invalid 747 destination %d.'%(position))
+            raise RuntimeError('Invalid 747 destination %d.'%(position))
+
+        self.stop_queued = 0
+        self._moving = True
+        try:
+            if not self._comms_set_destination(self._device, position):
+                raise RuntimeError('Failed to set 747 destination.')
+
+            if not self._wait_for_motion():
+                raise RuntimeError('747 device %d failed to reach position %d.'%(self._device, position))
+
+            self.get_position()
+        finally:
+            self._moving = False
 
     def move_relative(self, steps: int):
-        pass
+        self.move_to(self._position + steps)
+
+    def set_home_speed_mult(self, speed):
+        log.info('The 747 does not support speed control.')
+        self._home_speed_mult = speed
+
+    def set_move_speed_mult(self, speed):
+        log.info('The 747 does not support speed control.')
+        self._move_speed_mult = speed
 
     def short_name(self):
-        pass
+        return self.s_name
 
     def long_name(self):
-        pass
+        return self.l_name
 
     def open(self):
         pass
@@ -580,18 +828,6 @@ Master              Slave
 0x4 <EOT>
  """
 
-def print_bytes(message: bytearray):
-    """ Print a bytearray as a string of hex values. """
-    print(" ".join("0x{:02x}".format(b) for b in message))
-
-def int_to_bytes(value: int, length: int):
-    """ Convert an integer to a bytearray of a given length. """
-    return value.to_bytes(length, byteorder='big')
-
-def bytes_to_int(message: bytearray):
-    """ Convert a bytearray to an integer. """
-    return int.from_bytes(message, byteorder='big')
-
 def lrc(message: bytearray):
     """ Calculate the Longitudinal Redundancy Check (LRC) for a message. """
 
@@ -600,36 +836,178 @@ def lrc(message: bytearray):
         checksum ^= b
     return checksum
 
-def Initialize_Serial(comport: str):
-    """ Initialize the serial port. """
-    
-    # Using 0.8s timeout, as the manual suggests, results in the 747 cancelling comms due to it timing-out internally. 0.5s avoids this.
-    return safe_serial.SafeSerial(comport, 9600, timeout=0.5)
+# Precompute the headers for the fixed status queries.
+for _addr in [MP_747.ADDR_FLAGS, MP_747.ADDR_MOTION, MP_747.ADDR_INIT] + MP_747.ADDR_POSITION:
+    MP_747._frame('r', _addr)
+for _addr in [MP_747.ADDR_FLAGS] + MP_747.ADDR_DESTINATION:
+    MP_747._frame('w', _addr)
 
-def Initialize_747(s):
-    """ Initialize the 747. """
+class MP_747_SIM(safe_serial.VirtualSerial):
+    """ Wire-level simulator of a 747 Device Controller.
 
-    # Setup our bytearrays / commands.
-    ENQ = bytearray(b'N!\x05')
-    ACK = bytearray(b'N!\x06')
-    NACK = bytearray(b'N!\x15')
-    EOT = bytearray(b'\x15')
+    Speaks the DirectNET exchange described above, including LRC checks, NACKs and the motion / error flags, so that
+    MP_747 can be exercised and benchmarked without hardware. Register it with safe_serial.register_virtual_port() and
+    open MP_747 on the same port name.
+    """
 
-    # First let's just try a basic enquiry, reading the ACK, and then sending EOT.
-    # This is just a basic test.
-    s.write(ENQ)
-    msg = s.read(128)
+    def __init__(self, positions: int = 6, move_time: float = 0.05, timeout: float = 0.5):
+        """ MP_747_SIM constructor.
 
-    s.write(EOT)
-    msg = s.read(128)
+        Args:
+            positions (int, optional): Number of physical positions of each device. Defaults to 6.
+            move_time (float, optional): Seconds taken to travel one position. Defaults to 0.05.
+            timeout (float, optional): Host-side read timeout. Defaults to 0.5.
+        """
 
-    s.write(EOT)
+        super().__init__(timeout)
+        self.positions = positions
+        self.move_time = move_time
+        self.nacks = 0
+
+        self._in = bytearray()
+        self._state = 'idle'
+        self._addr = None
+        self._error = False
+        self._needs_init = 0b1111
+        self._pos = [0, 0, 0, 0]
+        self._dest = [0, 0, 0, 0]
+        self._arrival = [None, None, None, None]
+
+    def _receive(self, buf: bytes):
+        self._in += buf
+
+        while len(self._in) > 0:
+            # An EOT from the host ends whatever transaction is in progress.
+            if self._in[0] == MP_747.EOT[0]:
+                del self._in[:1]
+                self._state = 'idle'
+                continue
+
+            if self._state == 'idle':
+                if len(self._in) < MP_747.ACK_LEN:
+                    return
+                msg = bytes(self._in[:MP_747.ACK_LEN])
+                del self._in[:MP_747.ACK_LEN]
+                if msg == MP_747.ENQ:
+                    self._reply(MP_747.ACK)
+                    self._state = 'header'
+
+            elif self._state == 'header':
+                if len(self._in) < MP_747.HEADER_LEN:
+                    return
+                header = bytes(self._in[:MP_747.HEADER_LEN])
+                del self._in[:MP_747.HEADER_LEN]
+                if header[0] != MP_747.SOH or header[15] != MP_747.ETB or header[16:18] != MP_747._lrc(header[1:15]):
+                    self.nacks += 1
+                    self._reply(MP_747.NACK)
+                    self._state = 'idle'
+                    continue
+                self._addr = header[5:9].decode('ascii')
+                self._reply(MP_747.ACK)
+                if header[3] == 0x30:
+                    self._reply(MP_747._frame_data(self._mem_read(self._addr)))
+                    self._state = 'read_ack'
+                else:
+                    self._state = 'write_data'
+
+            elif self._state == 'read_ack':
+                if len(self._in) < MP_747.ACK_LEN:
+                    return
+                msg = bytes(self._in[:MP_747.ACK_LEN])
+                del self._in[:MP_747.ACK_LEN]
+                if msg == MP_747.ACK:
+                    self._reply(MP_747.EOT)
+                self._state = 'done'
+
+            elif self._state == 'write_data':
+                if len(self._in) < MP_747.DATA_LEN:
+                    return
+                block = bytes(self._in[:MP_747.DATA_LEN])
+                del self._in[:MP_747.DATA_LEN]
+                value = MP_747._parse_data(block)
+                if value is None:
+                    self.nacks += 1
+                    self._reply(MP_747.NACK)
+                    self._state = 'idle'
+                    continue
+                self._mem_write(self._addr, value)
+                self._reply(MP_747.ACK)
+                self._state = 'done'
+
+            else:
+                # Waiting for the host's EOT; discard anything else.
+                del self._in[:1]
+
+    def _update(self):
+        now = time.monotonic()
+        for i in range(4):
+            if self._arrival[i] is not None and now >= self._arrival[i]:
+                self._pos[i] = self._dest[i]
+                self._arrival[i] = None
+
+    def _start_move(self, i: int, dest: int):
+        self._dest[i] = dest
+        self._arrival[i] = time.monotonic() + self.move_time * max(1, abs(dest - self._pos[i]))
+
+    def _mem_read(self, addr: str)->int:
+        self._update()
+
+        if addr == MP_747.ADDR_FLAGS:
+            return int(self._error) << 8
+        elif addr == MP_747.ADDR_MOTION:
+            word = 0
+            for i in range(4):
+                if self._arrival[i] is not None:
+                    word |= 1 | (1 << (i + 1))
+            return word
+        elif addr == MP_747.ADDR_INIT:
+            return self._needs_init
+        elif addr in MP_747.ADDR_POSITION:
+            return self._pos[MP_747.ADDR_POSITION.index(addr)]
+        elif addr in MP_747.ADDR_DESTINATION:
+            return self._dest[MP_747.ADDR_DESTINATION.index(addr)]
+        return 0
+
+    def _mem_write(self, addr: str, value: int):
+        self._update()
+
+        if addr == MP_747.ADDR_FLAGS:
+            for i in range(4):
+                if value & (1 << i):
+                    if self._needs_init & (1 << i):
+                        # Initialization drives the device to its first position and clears the error.
+                        self._needs_init &= ~(1 << i)
+                        self._error = False
+                        self._start_move(i, 1)
+                    else:
+                        self._start_move(i, (self._pos[i] % self.positions) + 1)
+        elif addr in MP_747.ADDR_DESTINATION:
+            i = MP_747.ADDR_DESTINATION.index(addr)
+            if value < 1 or value > self.positions or self._needs_init & (1 << i):
+                self._error = True
+                self._needs_init |= (1 << i)
+            else:
+                self._start_move(i, value)
 
 if __name__ == "__main__":
-    comport = input('Port:')
+    comport = input('Port (blank for simulator):')
     log.register()
     
-    # s = Initialize_Serial(comport)
-    # Initialize_747(s)
+    if comport == '':
+        comport = 'MP747_SIM'
+        safe_serial.register_virtual_port(comport, MP_747_SIM())
 
     mp747 = MP_747(comport)
+
+    # Round-trip benchmark of the status poll used while waiting on moves.
+    num_polls = 100
+    start = time.perf_counter()
+    for i in range(num_polls):
+        mp747.is_moving()
+    elapsed = time.perf_counter() - start
+    log.info('%d motion polls in %.3f s (%.2f ms per poll).'%(num_polls, elapsed, 1000 * elapsed / num_polls))
+
+    for position in [3, 1, 6]:
+        start = time.perf_counter()
+        mp747.move_to(position)
+        log.info('Moved to %d in %.3f s; reports position %d.'%(position, time.perf_counter() - start, mp747.get_position()))
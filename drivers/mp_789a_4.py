@@ -24,6 +24,7 @@
 
 # import serial
 from __future__ import annotations
+import sys
 import threading
 import time
 from utilities import ports_finder
@@ -108,7 +109,7 @@ class MP_789A_4(StageDevice):
             raise RuntimeError('self.s is None')
 
         # Starting movement watchdog.
-        self.movement_status_tid = threading.Thread(target=self.movement_status_thread)
+        self.movement_status_tid = threading.Thread(target=self.movement_status_thread, daemon=True)
         self.movement_status_tid.start()
 
         # Home the 789A-4.
@@ -362,10 +363,7 @@ class MP_789A_4(StageDevice):
         """ Triple-redundant serial stop command.
         """
 
-        self.stop_queued = 1
-
-        self.s.xfer([b'@'])
-        # self.s.write(b'@')
+        self.emergency_stop()
         log.info('Stopping.')
         time.sleep(MP_789A_4.WR_DLY)
 
@@ -382,6 +380,16 @@ class MP_789A_4(StageDevice):
         self._moving = False
         self._homing = False
 
+    def emergency_stop(self)->float:
+        """ Sends a single stop command ahead of any queued communication.
+
+        Returns:
+            float: time.perf_counter() timestamp at which the stop was written.
+        """
+
+        self.stop_queued = 1
+        return self.s.preempt(b'@')
+
     def is_moving(self):
         """_summary_
 
@@ -435,7 +443,12 @@ class MP_789A_4(StageDevice):
         self.moving_poll_mutex.acquire()
 
         log.debug('ACQUIRED MOVING POLL MUTEX')
-        status = self.s.xfer([b'^']).decode('utf-8').rstrip()
+        try:
+            status = self.s.xfer([b'^']).decode('utf-8').rstrip()
+        except safe_serial.SerialPreempted:
+            # The status was lost to a stop; keep the last known state and ask again on the next poll.
+            self.moving_poll_mutex.release()
+            return self._moving
         log.debug('789 _status:', status)
         time.sleep(MP_789A_4.WR_DLY)
 
@@ -478,10 +491,9 @@ class MP_789A_4(StageDevice):
         # self.moving_poll_mutex.acquire()
         self._moving = True
 
-        # Set the movement speed for moving.
-        self._enact_speed_factor(self._move_speed_mult)
-
         try:
+            # Set the movement speed for moving.
+            self._enact_speed_factor(self._move_speed_mult)
 
             self.stop_queued = 0
 
@@ -514,6 +526,11 @@ class MP_789A_4(StageDevice):
             self.stop_queued = 0
             self._backlash_lock = False
 
+        except safe_serial.SerialPreempted:
+            # An emergency stop cut the move short; stop() finishes the job.
+            log.warn('Move interrupted by a stop.')
+            self._backlash_lock = False
+
         except Exception as e:
             # self.moving_poll_mutex.release()
             raise e
@@ -771,6 +788,89 @@ class MP_789A_4_DUMMY(StageDevice):
         log.debug('func: long_name')
         return self.l_name
 
+class MP_789A_4_SIM(safe_serial.VirtualSerial):
+    """ Serial-level simulator of a 789A-4 Scan Controller.
+
+    Answers the command set above closely enough to run the real driver, including timed moves, the homing limit
+    switch sequence and soft stops. Register it with safe_serial.register_virtual_port() and open the driver on the
+    same port name.
+    """
+
+    # Limit switch status reported when stopped on the home switch.
+    HOME_STATUS = b'32'
+
+    def __init__(self, steps_per_sec: float = 20000, home_time: float = 0.5, timeout: float = 0.3, axes: int = 1):
+        """ MP_789A_4_SIM constructor.
+
+        Args:
+            steps_per_sec (float, optional): Simulated indexing speed. Defaults to 20000.
+            home_time (float, optional): Seconds a constant-velocity (M) move takes to reach the home switch. Defaults to 0.5.
+            timeout (float, optional): Host-side read timeout. Defaults to 0.3.
+            axes (int, optional): Number of simulated axes. Defaults to 1.
+        """
+
+        super().__init__(timeout)
+        self.steps_per_sec = steps_per_sec
+        self.home_time = home_time
+        self.stops = 0
+
+        self._in = bytearray()
+        self._initialized = False
+        self._axis = 0
+        self._until = [0.0] * axes # When each axis's current move ends.
+        self._at_home = [False] * axes
+
+    def _receive(self, buf: bytes):
+        self._in += buf
+
+        # Commands are terminated by CR and/or LF.
+        while True:
+            ends = [i for i in (self._in.find(b'\r'), self._in.find(b'\n')) if i >= 0]
+            if not ends:
+                return
+            end = min(ends)
+            cmd = bytes(self._in[:end]).decode('utf-8', errors='ignore')
+            del self._in[:end + 1]
+            if cmd != '':
+                self._command(cmd)
+
+    def _command(self, cmd: str):
+        now = time.monotonic()
+        axis = self._axis
+        moving = now < self._until[axis]
+
+        if cmd == ' ':
+            self._reply(b' #\r\n' if self._initialized else b' v2.55\r\n#\r\n')
+            self._initialized = True
+        elif cmd == '^':
+            self._reply(b'^%s\r\n#\r\n'%(b'+' if moving else b'0'))
+        elif cmd == ']':
+            if moving:
+                status = b'2'
+            elif self._at_home[axis]:
+                status = self.HOME_STATUS
+            else:
+                status = b'0'
+            self._reply(b']%s\r\n#\r\n'%(status))
+        elif cmd == '@':
+            self.stops += 1
+            self._until[axis] = now
+            self._reply(b'@\r\n#\r\n')
+        elif cmd[0] in '+-' and cmd[1:].isdigit():
+            self._until[axis] = now + int(cmd[1:]) / self.steps_per_sec
+            self._at_home[axis] = False
+            self._reply(cmd.encode('utf-8') + b'\r\n#\r\n')
+        elif cmd[0] == 'M':
+            self._until[axis] = now + self.home_time
+            self._at_home[axis] = cmd[1:2] == '-'
+            self._reply(cmd.encode('utf-8') + b'\r\n#\r\n')
+        elif cmd[0] == 'F':
+            self._until[axis] = now + 0.05
+            self._reply(cmd.encode('utf-8') + b'\r\n#\r\n')
+        else:
+            self._reply(cmd.encode('utf-8') + b'\r\n#\r\n')
+
+
 """ 
 McPherson Model 789A-4 Scan Controller Command Set
 
@@ -797,3 +897,32 @@ X                   Examine Parameters
 -                   Index Scan In Down Direction
 ^                   Read Moving Status
 """
+
+if __name__ == '__main__':
+    log.register()
+
+    # Measures stop latency against the simulator: time from the stop request to the first byte received by the
+    # controller, while a move and its status polling are keeping the port busy.
+    sim = safe_serial.register_virtual_port('MP789_SIM', MP_789A_4_SIM(steps_per_sec=1000))
+    dev = MP_789A_4('MP789_SIM')
+
+    latencies = []
+    for i in range(10):
+        mover = threading.Thread(target=dev.move_to, args=(dev.get_position() + 2000, 0))
+        mover.start()
+        time.sleep(0.3)
+
+        t = time.perf_counter()
+        dev.emergency_stop()
+        latencies.append(sim.first_rx_after(t) - t)
+        dev.stop()
+        mover.join()
+
+    log.info('Stop latency: mean %.2f ms, max %.2f ms.'%(1000 * sum(latencies) / len(latencies), 1000 * max(latencies)))
+
+    # Fails the run if any stop took longer than the 20 ms all-stop target to reach the controller.
+    STOP_LATENCY_TARGET = 0.020
+    if max(latencies) > STOP_LATENCY_TARGET:
+        log.error('Stop latency exceeds the %.0f ms target.'%(1000 * STOP_LATENCY_TARGET))
+        sys.exit(1)
+    log.info('Stop latency is within the %.0f ms target.'%(1000 * STOP_LATENCY_TARGET))
@@ -22,8 +22,10 @@
 #
 #
 
+import sys
 import threading
 from threading import Lock
+from collections import deque
 import serial
 import time
 from utilities import ports_finder
@@ -32,10 +34,56 @@ from utilities import log
 
 from drivers.mp_789a_4 import MP_789A_4
 from drivers.mp_789a_4 import MP_789A_4_DUMMY
+from drivers.mp_789a_4 import MP_789A_4_SIM
+
+class MP_792_Move:
+    """ Handle to a move queued on the 792 axis scheduler.
+
+    A move is a list of relative segments (a backlash-corrected move is an overshoot followed by a correction) which
+    the scheduler sends to the axis one after the other. `done` is set once the last segment has completed, the move
+    was cancelled by a stop, or it failed; `error` then says why it failed.
+    """
+
+    def __init__(self, axis: int, segments: list):
+        self.axis = axis
+        self.segments = deque(segments)
+        self.success = True
+        self.error = None
+        self.done = threading.Event()
+        # When the current segment was sent, whether the controller acknowledged it, and whether the axis has been seen
+        # moving since.
+        self.sent_at = 0.0
+        self.acked = False
+        self.started = False
+
+    def wait(self, timeout: float = None)->bool:
+        """ Blocks until the move completes.
+
+        Returns:
+            bool: True if the move completed, False if it was stopped or the wait timed out.
+        """
+
+        if not self.done.wait(timeout):
+            return False
+        return self.success
 
 class MP_792:
     AXES = [b'A0', b'A8', b'A16', b'A24']
     WR_DLY = 0.05
+    POLL_DLY = 0.05
+
+    # The 792 drives its axes through a single switched output, so only one axis can move at a time; the controller
+    # does not support simultaneous moves. Moves on other axes are queued and dispatched the moment the moving axis
+    # reports it is done.
+    MAX_MOVING_AXES = 1
+
+    # The axis may not report moving for a moment after a move is sent. Until it has been seen moving, a segment whose
+    # command was not acknowledged only counts as done once this many seconds have passed. An acknowledged segment is
+    # done at the first poll which finds the axis idle.
+    START_GRACE = 0.5
+
+    # Seconds a caller waits for a queued move before giving up on it.
+    MOVE_TIMEOUT = 5*60
 
     MAX_VEL = 60000
     DEF_VEL = 60000
@@ -64,8 +112,15 @@ class MP_792:
         self._is_homing = [False] * axes
         self._is_moving_l = [False] * axes
         self.current_axis = 0
-        self._backlash_lock_l = [False] * axes
         self.stop_queued_l = [0] * axes
+        self._enacted_vel_l = [None] * axes
+
+        # Axis scheduler state, guarded by _sched_cv.
+        self._sched_cv = threading.Condition()
+        self._pending_l = [deque() for i in range(axes)] # Queued MP_792_Move objects, per axis.
+        self._active = {} # axis: MP_792_Move currently being driven.
+        self._planned_l = [0] * axes # Where each axis will be once its queue drains.
+        self._next_axis = 0
 
         if port is None:
             log.error('Port is none type.')
@@ -97,10 +152,9 @@ class MP_792:
         else:
             raise RuntimeError('Invalid response.')
 
-        # TODO: (This is new) Spawn the t_movement_status thread. This thread will update the current movement status in line with what the device can handle. This is a break-away from the previous paradigm where only when asked would we check. This didnt make much sense.
-        # Starting movement watchdog.
-        self.movement_status_tid = threading.Thread(target=self.movement_status_thread)
-        self.movement_status_tid.start()
+        # The scheduler thread is the only thing which dispatches moves and polls movement status for queued moves.
+        self.scheduler_tid = threading.Thread(target=self.scheduler_thread, daemon=True)
+        self.scheduler_tid.start()
 
         log.info('Checking axes...')
         for i in [2, 0, 3, 1]:
@@ -130,69 +184,181 @@ class MP_792:
 
         log.info('McPherson 792 initialization complete.')
 
-    def movement_status_thread(self):
+    def scheduler_thread(self):
         # This thread runs in the background.
-        # It will be the only thing which calls the internal _is_moving() function.
-        # The middleware calls the external is_moving() function.
-        # This way we can ensure that the device is only queried for movement status when it is safe to do so.
+        # Callers queue moves with submit_move(); this thread sends each segment to its axis, polls the moving axes
+        # round-robin, and dispatches the next queued segment (on this or another axis) as soon as an axis reports done.
+
+        while True:
+            with self._sched_cv:
+                while not self._active and not any(self._pending_l):
+                    self._sched_cv.wait()
 
+            try:
+                self._schedule()
+            except safe_serial.SerialPreempted:
+                # An emergency stop wrote over a transfer; it also cancels the queued moves, so just poll again.
+                log.warn('792 scheduler transfer interrupted by a stop.')
+            except Exception as e:
+                # A failed transfer leaves the state of the moving axes unknown, so every queued move is failed rather
+                # than left for its caller to wait on.
+                log.error('792 scheduler failure, failing all queued moves: %s'%(e))
+                with self._sched_cv:
+                    for axis in range(self.num_axes):
+                        self._fail(axis, 'Move aborted after a communication failure: %s'%(e))
+
+            time.sleep(MP_792.POLL_DLY)
+
+    # One pass of the scheduler: dispatches newly claimed moves and polls the moving axes.
+    def _schedule(self):
+        with self._sched_cv:
+            to_dispatch = self._claim_axes()
+            active = list(self._active.items())
+
+        for axis, job in to_dispatch:
+            self._dispatch_segment(job)
+
+        for axis, job in active:
+            if self._is_moving(axis):
+                job.started = True
+                continue
+            if not job.started and not job.acked and time.time() - job.sent_at < MP_792.START_GRACE:
+                continue
 
-        any_alive = False
+            # This axis is done with its current segment.
+            with self._sched_cv:
+                if job.segments and not self.stop_queued_l[axis]:
+                    dispatch_next = True
+                else:
+                    dispatch_next = False
+                    self._finish(job)
+                    to_dispatch = self._claim_axes()
+
+            if dispatch_next:
+                self._dispatch_segment(job)
+            else:
+                for next_axis, next_job in to_dispatch:
+                    self._dispatch_segment(next_job)
+
+    # Must be called with _sched_cv held. Moves queued jobs into the active set, up to MAX_MOVING_AXES.
+    def _claim_axes(self)->list:
+        claimed = []
+        for n in range(self.num_axes):
+            if len(self._active) + sum(self._is_homing) >= MP_792.MAX_MOVING_AXES:
+                break
 
-        while True:
-            time.sleep(0.25)
+            axis = (self._next_axis + n) % self.num_axes
+            if axis in self._active or self._is_homing[axis] or not self._pending_l[axis]:
+                continue
 
-            alive_axes_indices = [i for i, v in enumerate(self.axis_alive) if v]
+            job = self._pending_l[axis][0]
+            self._active[axis] = job
+            claimed.append((axis, job))
+
+        if claimed:
+            self._next_axis = (claimed[-1][0] + 1) % self.num_axes
+        return claimed
+
+    # Must be called with _sched_cv held.
+    def _finish(self, job: MP_792_Move):
+        axis = job.axis
+        if self._active.get(axis) is job:
+            del self._active[axis]
+        if job in self._pending_l[axis]:
+            self._pending_l[axis].remove(job)
+        self._is_moving_l[axis] = False
+        job.done.set()
+        self._sched_cv.notify_all()
+
+    # Must be called with _sched_cv held. Fails the active and queued moves of an axis, which is left wherever it is.
+    def _fail(self, axis: int, error: str):
+        jobs = list(self._pending_l[axis])
+        if axis in self._active and self._active[axis] not in jobs:
+            jobs.append(self._active[axis])
+        for job in jobs:
+            job.segments.clear()
+            job.success = False
+            job.error = error
+            self._finish(job)
+        self._planned_l[axis] = self._position[axis]
+
+    def _dispatch_segment(self, job: MP_792_Move):
+        axis = job.axis
+        with self._sched_cv:
+            # The move may have been cancelled by a stop since it was claimed.
+            if not job.segments:
+                return
+            steps = job.segments.popleft()
 
-            moving_axes = 0
+        self._enact_speed_factor(self._move_speed_mult_l[axis], axis)
 
-            for i in alive_axes_indices:
-                any_alive = True
-                if self._is_moving_l[i]:
-                    moving_axes += 1
+        log.info('Axis %d being told to move %d steps.'%(axis, steps))
 
-            if not any_alive:
-                log.error('No axes are alive.')
-                continue
+        # A zero-step segment never starts moving, so there is nothing to wait for.
+        job.started = steps == 0
+        job.acked = False
+        job.sent_at = time.time()
+
+        if steps > 0:
+            self._is_moving_l[axis] = True
+            rx = self.s.xfer([self.set_axis_cmd(axis), b'+%d'%(steps)], custom_delay=MP_792.WR_DLY)
+            job.acked = bool(rx)
+        elif steps < 0:
+            self._is_moving_l[axis] = True
+            rx = self.s.xfer([self.set_axis_cmd(axis), b'-%d'%(steps * -1)], custom_delay=MP_792.WR_DLY)
+            job.acked = bool(rx)
+        else:
+            log.info('Not moving (0 steps).')
+        self._position[axis] += steps
 
-            if moving_axes > 1:
-                log.error('Multiple axes are moving.')
-                log.error('Cancelling all movement.')
+    def submit_move(self, position: int, axis: int, backlash: int = 0)->MP_792_Move:
+        """ Queues a move to an absolute position without waiting for it.
 
-                for i in alive_axes_indices:
-                    self.stop(i)
+        Args:
+            position (int): Destination, in steps.
+            axis (int): The axis to move.
+            backlash (int, optional): Overshoot used to approach the destination from below. Defaults to 0.
 
-                continue
+        Returns:
+            MP_792_Move: Handle which can be waited on.
+        """
+
+        with self._sched_cv:
+            # Steps are computed from where the axis will be once everything ahead of this move has run.
+            steps = position - self._planned_l[axis]
 
-            elif moving_axes == 1:
-                moving_axis_index = next((i for i, v in enumerate(self._is_moving_l) if v), None)
+            if (steps < 0) and (backlash > 0):
+                segments = [steps - backlash, backlash]
+            else:
+                segments = [steps]
 
-                # Check if the backlash lock is active. If so, we should check again later.
-                if self._backlash_lock_l[moving_axis_index]:
-                    # log.info('Backlash lock is active. Skipping movement inquiry.')
-                    log.info('Backlash lock is active, but not skipping movement inquiry.')
+            return self._queue(axis, segments, position)
 
-                    # continue
+    # Must be called with _sched_cv held.
+    def _queue(self, axis: int, segments: list, position: int)->MP_792_Move:
+        log.debug('MOVE-DEBUG: Queueing axis %d segments:'%(axis), segments)
 
-                # Update the movement status of the axis which is moving.
-                log.info(f'Checking movement status of axis {moving_axis_index}.')
-                self._is_moving_l[moving_axis_index] = self._is_moving(moving_axis_index)
-                log.info(f'Axis {moving_axis_index} is moving? {self._is_moving_l[moving_axis_index]}.')
+        # Reset the stop queued such that we dont immediately stop from an old stop request.
+        self.stop_queued_l[axis] = 0
+        self._planned_l[axis] = position
 
-            # Checking for movement in this last case isn't necessary because we know when we initiate an axis move - it should be set to True (moving) when its told to move. The assumption should be that it does begin to move. Then, we use the previous case to prove it isn't moving once its stopped (or failed to start moving).
-            elif moving_axes == 0:
-                # Update the movement status of all alive axes, since none are reported as moving.
-                log.info('No axes have been marked or reported as moving. Skipping movement inquiry.')
+        job = MP_792_Move(axis, segments)
+        self._pending_l[axis].append(job)
+        self._sched_cv.notify_all()
+        return job
 
     # Axis needs to be set by passing MP_792.AXES[axis] + b'\r' command every time we do anything.
     def set_axis_cmd(self, axis: int):
         return MP_792.AXES[axis] + b'\r'
 
     def home(self, axis: int)->bool:
-        # Deny the home is any axis is busy.
-        if any(self._is_homing) or any(self._is_moving_l) or any(self._backlash_lock_l):
-            log.warn(f'Device is busy: an axis is already homing ({self._is_homing}) or moving ({self._is_moving_l}) or locked for backlash ({self._backlash_lock_l}).')
-            return False
+        with self._sched_cv:
+            # Deny the home if this axis is busy, or if homing now would exceed the number of axes allowed to move.
+            if self._is_homing[axis] or axis in self._active or self._pending_l[axis] or (len(self._active) + sum(self._is_homing) >= MP_792.MAX_MOVING_AXES):
+                log.warn(f'Device is busy: an axis is already homing ({self._is_homing}) or moving ({self._is_moving_l}).')
+                return False
+
+            self._is_homing[axis] = True
 
         # Set the movement speed for homing.
         self._enact_speed_factor(self._home_speed_mult_l[axis], axis)
@@ -200,8 +366,7 @@ class MP_792:
         HOME_TIME = 5*60 # 5 minutes - homing will timeout after 5 minutes
 
         log.info('Beginning home for 792 axis %d.'%(axis))
-        self._is_homing[axis] = True
-        self._is_moving_l[axis] = True # we set the movement, movement_status_thread will unset
+        self._is_moving_l[axis] = True
 
         if axis == 2:
             spd = 5000
@@ -224,16 +389,13 @@ class MP_792:
 
         start_time = time.time()
         success = True
-        # Set movement to true again just in case.
-        self._is_moving_l[axis] = True
         while True:
             current_time = time.time()
 
             log.info('Time spent homing:', current_time - start_time)
 
-            # moving = self._is_moving(axis)
             time.sleep(0.5)
-            moving = any(self._is_moving_l)
+            moving = self._is_moving(axis)
 
             limstat = self.s.xfer([self.set_axis_cmd(axis), b']'], custom_delay=MP_792.WR_DLY)
             limstat = limstat.decode('utf-8')
@@ -255,9 +417,9 @@ class MP_792:
                 log.error('Homing failed.')
                 self.s.xfer([self.set_axis_cmd(axis), b'@'], custom_delay=MP_792.WR_DLY)
                 
-                self._is_homing[axis] = False
                 # Reset the movement speed.
                 self._enact_speed_factor(self._move_speed_mult_l[axis], axis)
+                self._end_home(axis)
                 return False
 
             time.sleep(MP_792.WR_DLY * 5)
@@ -279,20 +441,39 @@ class MP_792:
             time.sleep(MP_792.WR_DLY * 10)
 
         self._position[axis] = 0
-        self._is_homing[axis] = False
 
         # Reset the movement speed.
         self._enact_speed_factor(self._move_speed_mult_l[axis], axis)
+        self._end_home(axis)
 
         return True
 
+    def _end_home(self, axis: int):
+        with self._sched_cv:
+            self._planned_l[axis] = self._position[axis]
+            self._is_homing[axis] = False
+            self._is_moving_l[axis] = False
+            # Moves queued on other axes may have been waiting for this one.
+            self._sched_cv.notify_all()
+
     def get_position(self, axis: int):
         return self._position[axis]
 
+    # Must be called with _sched_cv held.
+    def _cancel(self, axis: int):
+        self.stop_queued_l[axis] = 1
+
+        # Cancel this axis's queued moves. The scheduler finishes the active one once the axis reports stopped.
+        for job in list(self._pending_l[axis]):
+            job.segments.clear()
+            job.success = False
+            if self._active.get(axis) is not job:
+                self._finish(job)
+
     # Triple-redundant serial stop command.
-    # TODO: Needs to stop all axes simultaneously since the 'switch' inside will mess up whats doing what.
     def stop(self, axis: int):
-        self.stop_queued_l[axis] = 1
+        with self._sched_cv:
+            self._cancel(axis)
 
         self.s.xfer([self.set_axis_cmd(axis), b'@'], custom_delay=MP_792.WR_DLY)
 
@@ -309,70 +490,44 @@ class MP_792:
         log.info('Stopping.')
         time.sleep(MP_792.WR_DLY)
 
-        self._is_moving_l[axis] = False
-        self._is_homing[axis] = False
+        with self._sched_cv:
+            self._planned_l[axis] = self._position[axis]
+            self._is_moving_l[axis] = False
+            self._is_homing[axis] = False
+
+    # Stops the selected (i.e. last commanded) axis ahead of any queued communication and cancels every queued move.
+    # Other axes should still be stopped with stop(axis) afterwards.
+    def emergency_stop(self)->float:
+        t = self.s.preempt(b'@')
 
-    # Publicly callable is_moving() function.
+        with self._sched_cv:
+            for axis in range(self.num_axes):
+                self._cancel(axis)
+
+        return t
+
+    # Publicly callable is_moving() function. Reports busy while the axis has anything queued.
     def is_moving(self, axis: int):
-        if self._backlash_lock_l[axis]:
-            log.info('is_moving is returning true because the Backlash lock is active.')
+        if self._is_homing[axis]:
             return True
-        elif self._is_homing[axis]:
+        elif self._pending_l[axis]:
             return True
         else:
             return self._is_moving_l[axis]
 
-    # Internal-calling only.
+    # Internal-calling only. Queries the controller for the axis's movement status.
     def _is_moving(self, axis: int):
-
-        sum_moving = sum(self._is_moving_l)
-        sum_homing = sum(self._is_homing)
-
-        if sum_moving > 1:
-            log.fatal(f'Multiple axes are moving: {self._is_moving_l}.')
-            exit(-1)
-            raise RuntimeError('Multiple axes are moving.')
-        
-        if sum_homing > 1:
-            log.fatal(f'Multiple axes are homing: {self._is_homing}.')
-            exit(-1)
-            raise RuntimeError('Multiple axes are homing.')
-
-        # We want to deny access to the device if 
-        # - a different axis is moving.
-        # - this axis is mid-backlash.
-        # It doesn't matter if this axis is listed as moving or not.
-        # This will prevent switching to another axis mid-move.
-
-        _is_moving_others = [v for i, v in enumerate(self._is_moving_l) if not i == axis]
-        _is_homing_others = [v for i, v in enumerate(self._is_homing) if not i == axis]
-        _backlash_lock_others = [v for i, v in enumerate(self._backlash_lock_l) if not i == axis]
-        # This function, the INTERNAL movement query, needs to return truly whether its moving or not. I dont care about backlash locks. We can check for that ourselves. The EXTERNAL movement function is more of an "is busy", and should return true if backlashing.
-
-        if any(_is_moving_others) or any(_is_homing_others) or any(_backlash_lock_others):
-            log.info(f'Device is busy: another axis besides #{axis} is already homing ({self._is_homing}) or moving ({self._is_moving_l}) or locked for backlash ({self._backlash_lock_l}).')
-            log.info(f'Returning the previous movement status of this axis (axis {axis}).')
-            return self._is_moving_l[axis]
-        
-        # # Check that the axis we are trying to operate on is the axis that is already busy. If so let it through.
-        # if (any(self._is_homing) or any(self._is_moving_l) or any(self._backlash_lock_l)) and not (self._is_homing[axis] or self._is_moving_l[axis] or self._backlash_lock_l[axis]):
-        #     log.info(f'Device is busy: another axis is already homing ({self._is_homing}) or moving ({self._is_moving_l}) or locked for backlash ({self._backlash_lock_l}).')
-        #     return True
-        
         status = self.s.xfer([self.set_axis_cmd(axis), b'^'], custom_delay=MP_792.WR_DLY)
         status = status.decode('utf-8').rstrip()
 
         log.debug('792 _status:', status)
-        time.sleep(MP_792.WR_DLY)
 
         if ('0' in status) and ('+' not in status and '-' not in status):
             self._is_moving_l[axis] = False
-            log.debug("Returning from _is_moving")
             log.info('792 Axis %d IS NOT moving because status1: %s'%(axis, status))
             return False
         else:
             self._is_moving_l[axis] = True
-            log.debug("Returning from _is_moving")
             log.info('792 Axis %d IS YES moving because status1: %s'%(axis, status))
             return True
         
@@ -380,83 +535,34 @@ class MP_792:
         return self._is_homing[axis]
 
     # Moves to a position, in steps, based on the software's understanding of where it last was.
+    # Blocks until this axis's move is done; moves on other axes may be queued from other threads meanwhile.
     def move_to(self, position: int, axis: int, backlash: int):
-        # If anything is moving or homing, prevent a move.
-        if any(self._is_homing) or any(self._is_moving_l) or any(self._backlash_lock_l):
-            log.warn(f'Device is busy: an axis is already homing ({self._is_homing}) or moving ({self._is_moving_l}) or locked for backlash ({self._backlash_lock_l}).')
-            return
-        
-        self._enact_speed_factor(self._move_speed_mult_l[axis], axis)
-        
-        # Reset the stop queued such that we dont immediately stop from an old stop request.
-        # Otherwise, this enables us to cancel backlash, etc, when stops are desired.
-        self.stop_queued_l[axis] = 0
-
         log.debug('MOVE-DEBUG: Performing a move with backlash value: ', backlash)
 
-        steps = position - self._position[axis]
-
-        if (steps < 0) and (backlash > 0):
-            self._backlash_lock_l[axis] = True
-
-            try:
-                if self.stop_queued_l[axis] == 0:
-                    log.debug('MOVE-DEBUG: Performing overshoot manuever.')
-                    self.move_relative(steps - backlash, axis, backlash_bypass=True)
-                
-                if self.stop_queued_l[axis] == 0:
-                    log.debug('MOVE-DEBUG: Performing backlash correction.')
-                    self.move_relative(backlash, axis, backlash_bypass=True)
-                    
-                log.debug('MOVE-DEBUG: Move complete.')
-            except Exception as e:
-                self._backlash_lock_l[axis] = False
-                raise e
-
-            self._backlash_lock_l[axis] = False
-        else:
-            log.debug('MOVE-DEBUG: Performing backlash-free move.')
-            self.move_relative(steps, axis)
+        job = self.submit_move(position, axis, backlash)
+        if not self._wait_move(job):
+            # A move cancelled by stop() has no error and is not a failure.
+            if job.error is not None:
+                raise RuntimeError(job.error)
+            return
 
-        # Reset the stop queue.
-        self.stop_queued_l[axis] = 0
+        log.debug('MOVE-DEBUG: Move complete.')
 
     def move_relative(self, steps: int, axis: int, backlash_bypass: bool = False):
-        if any(self._is_homing) or any(self._is_moving_l) or (any(self._backlash_lock_l) and not backlash_bypass):
-            log.warn(f'Device is busy: another axis is already homing ({self._is_homing}) or moving ({self._is_moving_l}) or locked for backlash ({self._backlash_lock_l}).')
-            return False
-
-        self._enact_speed_factor(self._move_speed_mult_l[axis], axis)
-
-        self._is_moving_l[axis] = True
-
-        log.info('Being told to move %d steps.'%(steps))
-
-        if steps > 0:
-            log.info('Moving...')
-            log.debug(b'+%d\r'%(steps))
-            self.s.xfer([self.set_axis_cmd(axis), b'+%d'%(steps)], custom_delay=MP_792.WR_DLY)
-            
-            time.sleep(MP_792.WR_DLY)
-        elif steps < 0:
-            log.info('Moving...')
-            log.debug(b'-%d\r'%(steps * -1))
-            self.s.xfer([self.set_axis_cmd(axis), b'-%d'%(steps * -1)], custom_delay=MP_792.WR_DLY)
-            
-            time.sleep(MP_792.WR_DLY)
-        else:
-            log.info('Not moving (0 steps).')
-        self._position[axis] += steps
-
-        # Blocks until the move is complete (this may not even be necessary..?).
-        while True:
-            log.debug('BLOCKING until movement is completed.')
-            time.sleep(0.5)
-            if not self._is_moving_l[axis]:
-                log.info('Found to be NOT MOVING.')
-                break
-        log.debug('FINISHED BLOCKING because moving is', self._is_moving_l)
-        time.sleep(MP_792.WR_DLY)
+        with self._sched_cv:
+            job = self._queue(axis, [steps], self._planned_l[axis] + steps)
+        return self._wait_move(job)
+
+    # Waits up to MOVE_TIMEOUT for a queued move. A move which times out is failed and its axis stopped.
+    def _wait_move(self, job: MP_792_Move)->bool:
+        if job.done.wait(MP_792.MOVE_TIMEOUT):
+            return job.success
+
+        log.error('Axis %d move timed out after %d seconds.'%(job.axis, MP_792.MOVE_TIMEOUT))
+        with self._sched_cv:
+            self._fail(job.axis, 'Axis %d move timed out after %d seconds.'%(job.axis, MP_792.MOVE_TIMEOUT))
+        self.stop(job.axis)
+        return False
 
     def set_home_speed_mult(self, speed, axis: int):
         log.debug(f'Setting home speed multiplier for axis {axis} to {speed}.')
@@ -480,14 +586,20 @@ class MP_792:
         elif vel_int < MP_792.MIN_VEL:
             vel_int = MP_792.MIN_VEL
 
+        # Skip the round-trip if the axis is already at this velocity.
+        if self._enacted_vel_l[axis] == vel_int:
+            return
+
         msg = f'V{str(vel_int)}'
         rx = self.s.xfer([self.set_axis_cmd(axis), msg.encode('utf-8')], custom_delay=MP_792.WR_DLY).decode('utf-8')
+        self._enacted_vel_l[axis] = vel_int
 
         log.debug('_enact_speed_factor: (post)', vel_int)
 
     def _reset_speed_factor(self, speed_factor, axis: int):
         msg = f'V{str(MP_792.DEF_VEL)}'
         rx = self.s.xfer([self.set_axis_cmd(axis), msg.encode('utf-8')], custom_delay=MP_792.WR_DLY).decode('utf-8')
+        self._enacted_vel_l[axis] = MP_792.DEF_VEL
 
     def short_name(self):
         return self.s_name
@@ -497,6 +609,7 @@ class MP_792:
 
 class MP_792_DUMMY:
     AXES = [b'A0', b'A8', b'A16', b'A24']
+    WR_DLY = 0.05
 
     def __init__(self, port: serial.Serial, axes: int = 4):
         self.num_axes = axes
@@ -581,7 +694,8 @@ class MP_792_DUMMY:
         log.info('Stopping.')
         time.sleep(MP_792_DUMMY.WR_DLY)
 
-        
+    def emergency_stop(self)->float:
+        return time.perf_counter()
 
     def _is_moving(self, axis: int):
         # self.set_axis(axis)
@@ -595,22 +709,26 @@ class MP_792_DUMMY:
     def is_homing(self, axis: int):
         return self._is_homing[axis]
 
-    # Moves to a position, in steps, based on the software's understanding of where it last was.
-    def move_to(self, position: int, axis: int, backlash: int):
-        # self.set_axis(axis)
-
-        # Set the movement speed for moving.
-        self._enact_speed_factor(self._move_speed_mult_l[axis], axis)
-
+    def submit_move(self, position: int, axis: int, backlash: int = 0)->MP_792_Move:
         steps = position - self._position[axis]
 
         if (steps < 0) and (backlash > 0):
-            self.move_relative(steps - backlash, axis)
-            self.move_relative(backlash, axis)
+            segments = [steps - backlash, backlash]
         else:
+            segments = [steps]
+
+        job = MP_792_Move(axis, segments)
+        for steps in segments:
             self.move_relative(steps, axis)
+        job.segments.clear()
+        job.done.set()
+        return job
+
+    # Moves to a position, in steps, based on the software's understanding of where it last was.
+    def move_to(self, position: int, axis: int, backlash: int):
+        self.submit_move(position, axis, backlash).wait()
 
-    def move_relative(self, steps: int, axis: int):
+    def move_relative(self, steps: int, axis: int, backlash_bypass: bool = False):
         # self.set_axis(axis)
 
         # Set the movement speed for moving.
@@ -622,6 +740,7 @@ class MP_792_DUMMY:
             log.debug('BLOCKING')
             time.sleep(MP_792.WR_DLY * 5)
         log.debug('FINISHED BLOCKING')
+        return True
 
     def set_home_speed_mult(self, speed, axis: int):
         log.info(f'Setting home speed multiplier for axis {axis} to {speed}.')
@@ -658,6 +777,26 @@ class MP_792_DUMMY:
     def long_name(self):
         return self.l_name
 
+class MP_792_SIM(MP_789A_4_SIM):
+    """ Serial-level simulator of a 792 Multi-Axis Controller.
+
+    Same command set as the 789A-4 simulator, applied to whichever axis was last selected with A0 / A8 / A16 / A24.
+    """
+
+    HOME_STATUS = b'128'
+
+    def __init__(self, steps_per_sec: float = 20000, home_time: float = 0.5, timeout: float = 0.5, axes: int = 4):
+        super().__init__(steps_per_sec, home_time, timeout, axes)
+
+    def _command(self, cmd: str):
+        axis_cmd = cmd.encode('utf-8')
+        if axis_cmd in MP_792.AXES:
+            self._axis = MP_792.AXES.index(axis_cmd)
+            self._reply(axis_cmd + b'\r\n#\r\n')
+        else:
+            super()._command(cmd)
+
+
 """ 
 McPherson Model 789A-4 Scan Controller Command Set
 
@@ -684,3 +823,31 @@ X                   Examine Parameters
 -                   Index Scan In Down Direction
 ^                   Read Moving Status
 """
+
+if __name__ == '__main__':
+    log.register()
+
+    # Measures stop latency against the simulator: time from the stop request to the first byte received by the
+    # controller, while the scheduler is keeping the port busy with a move.
+    sim = safe_serial.register_virtual_port('MP792_SIM', MP_792_SIM(steps_per_sec=1000))
+    dev = MP_792('MP792_SIM')
+
+    latencies = []
+    for i in range(10):
+        job = dev.submit_move(dev.get_position(0) + 2000, 0)
+        time.sleep(0.3)
+
+        t = time.perf_counter()
+        dev.emergency_stop()
+        latencies.append(sim.first_rx_after(t) - t)
+        dev.stop(0)
+        job.wait(MP_792.MOVE_TIMEOUT)
+
+    log.info('Stop latency: mean %.2f ms, max %.2f ms.'%(1000 * sum(latencies) / len(latencies), 1000 * max(latencies)))
+
+    # Fails the run if any stop took longer than the 20 ms all-stop target to reach the controller.
+    STOP_LATENCY_TARGET = 0.020
+    if max(latencies) > STOP_LATENCY_TARGET:
+        log.error('Stop latency exceeds the %.0f ms target.'%(1000 * STOP_LATENCY_TARGET))
+        sys.exit(1)
+    log.info('Stop latency is within the %.0f ms target.'%(1000 * STOP_LATENCY_TARGET))
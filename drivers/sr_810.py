@@ -32,11 +32,15 @@
 from io import TextIOWrapper
 import sys
 import glob
+import numpy as np
 from time import sleep
 from utilities import ports_finder
 from utilities import safe_serial
 from utilities import log
 
+# X, Y, R (V) and theta (deg), all taken at the same instant.
+SR810_RECORD = np.dtype([('X', 'f8'), ('Y', 'f8'), ('R', 'f8'), ('THETA', 'f8')])
+
 class SR810:
     def __init__(self, man_port: str = None):
         # if samples < 2:
@@ -95,6 +99,7 @@ class SR810:
             log.info('Time constant is 300ms.')
         else:
             log.warn('Time constant is not 300ms!')
+        self._time_constant = SR810.oflt_to_seconds(buf, 9)
 
         # Set the low pass filter slope.
         self.s.write(b'OFSL 1')
@@ -200,12 +205,43 @@ class SR810:
         log.info('Init complete')
 
     def detect(self):
-        self.s.write(b'OUTP ? 1')
-        X = self.s.read(128).decode('utf-8').rstrip()
-        if X == '': X = 0
-        self.val_X = float(X)
+        return float(self.detect_record()['X'])
+
+    def detect_record(self):
+        """ Reads X, Y, R and theta in a single SNAP? query so that they are simultaneous.
+
+        Returns:
+            np.void: A record of dtype SR810_RECORD.
+        """
+        # 1 for X, 2 for Y, 3 for R, 4 for theta.
+        self.s.write(b'SNAP ? 1,2,3,4')
+        buf = self.s.read(128).decode('utf-8').rstrip()
 
-        return self.val_X
+        rec = np.zeros((), dtype=SR810_RECORD)
+        try:
+            rec['X'], rec['Y'], rec['R'], rec['THETA'] = [float(v) for v in buf.split(',')]
+        except ValueError:
+            log.warn('Malformed SNAP? reply:', buf)
+        self.val_X = float(rec['X'])
+
+        return rec[()]
+
+    @staticmethod
+    def oflt_to_seconds(oflt: str, default: int)->float:
+        # OFLT i selects 10 us, 30 us, 100 us, 300 us, ... 30 ks.
+        try:
+            i = int(oflt)
+        except ValueError:
+            i = default
+        return (1, 3)[i % 2] * 10**((i // 2) - 5)
+
+    def time_constant(self, refresh: bool = False)->float:
+        """ Returns the lock-in time constant, in seconds. Queried from the instrument if `refresh` is set.
+        """
+        if refresh:
+            self.s.write(b'OFLT?')
+            self._time_constant = SR810.oflt_to_seconds(self.s.read(128).decode('utf-8').rstrip(), 9)
+        return self._time_constant
 
     def __del__(self):
         if self.s is not None:
@@ -219,15 +255,23 @@ class SR810:
 
 class SR810_DUMMY:
     def __init__(self, man_port: str = None):
-        pass
+        self.prev_mes = 0
 
     def detect(self):
-        import numpy as np
+        return float(self.detect_record()['X'])
+
+    def detect_record(self):
+        rec = np.zeros((), dtype=SR810_RECORD)
+        rec['X'] = self.prev_mes + np.random.normal(0, 1)
+        rec['Y'] = np.random.normal(0, 0.1)
+        rec['R'] = np.hypot(rec['X'], rec['Y'])
+        rec['THETA'] = np.degrees(np.arctan2(rec['Y'], rec['X']))
+        self.prev_mes = float(rec['X'])
 
-        mes = self.prev_mes + np.random.normal(0, 1)
-        self.prev_mes = mes
+        return rec[()]
 
-        return mes
+    def time_constant(self, refresh: bool = False)->float:
+        return 0.3
 
     def __del__(self):
         pass
@@ -33,11 +33,15 @@ from io import TextIOWrapper
 import sys
 import glob
 import serial
+import numpy as np
 from time import sleep
 from utilities import ports_finder
 from utilities import safe_serial
 from utilities import log
 
+# X, Y, R (V) and theta (deg), all taken at the same instant.
+SR860_RECORD = np.dtype([('X', 'f8'), ('Y', 'f8'), ('R', 'f8'), ('THETA', 'f8')])
+
 class SR860:
     # def __init__(self, man_port: str = None):
     def __init__(self, port: serial.Serial):
@@ -135,6 +139,7 @@ class SR860:
             log.info('Time constant is 300ms.')
         else:
             log.warn('Time constant is not 300ms!')
+        self._time_constant = SR860.oflt_to_seconds(buf, 11)
 
         # Set the low pass filter slope.
         self.s.write(b'OFSL 1')
@@ -205,11 +210,26 @@ class SR860:
         log.info('Init complete')
 
     def detect(self):
-        # 0 for X, 1 for Y.
-        self.s.write(b'OUTP? 0')
-        X = self.s.read(128).decode('utf-8').rstrip()
-        if X == '': X = 0
-        self.val_X = float(X)
+        return float(self.detect_record()['X'])
+
+    def detect_record(self):
+        """ Reads X, Y and theta in a single SNAP? query so that they are simultaneous. R is computed from X and Y, since
+        SNAP? takes at most three parameters.
+
+        Returns:
+            np.void: A record of dtype SR860_RECORD.
+        """
+        # 0 for X, 1 for Y, 3 for theta.
+        self.s.write(b'SNAP? 0,1,3')
+        buf = self.s.read(128).decode('utf-8').rstrip()
+
+        rec = np.zeros((), dtype=SR860_RECORD)
+        try:
+            rec['X'], rec['Y'], rec['THETA'] = [float(v) for v in buf.split(',')]
+        except ValueError:
+            log.warn('Malformed SNAP? reply:', buf)
+        rec['R'] = np.hypot(rec['X'], rec['Y'])
+        self.val_X = float(rec['X'])
 
         self.s.write(b'ERRS?')
         buf = self.s.read(128).decode('utf-8').rstrip()
@@ -219,7 +239,24 @@ class SR860:
             log.warn('Error detected!')
             log.warn('Error: %s'%(buf))
 
-        return self.val_X
+        return rec[()]
+
+    @staticmethod
+    def oflt_to_seconds(oflt: str, default: int)->float:
+        # OFLT i selects 1 us, 3 us, 10 us, 30 us, ... 30 ks.
+        try:
+            i = int(oflt)
+        except ValueError:
+            i = default
+        return (1, 3)[i % 2] * 10**((i // 2) - 6)
+
+    def time_constant(self, refresh: bool = False)->float:
+        """ Returns the lock-in time constant, in seconds. Queried from the instrument if `refresh` is set.
+        """
+        if refresh:
+            self.s.write(b'OFLT?')
+            self._time_constant = SR860.oflt_to_seconds(self.s.read(128).decode('utf-8').rstrip(), 11)
+        return self._time_constant
 
     def __del__(self):
         if self.s is not None:
@@ -236,12 +273,20 @@ class SR860_DUMMY:
         self.prev_mes = 0
 
     def detect(self):
-        import numpy as np
+        return float(self.detect_record()['X'])
+
+    def detect_record(self):
+        rec = np.zeros((), dtype=SR860_RECORD)
+        rec['X'] = self.prev_mes + np.random.normal(0, 1)
+        rec['Y'] = np.random.normal(0, 0.1)
+        rec['R'] = np.hypot(rec['X'], rec['Y'])
+        rec['THETA'] = np.degrees(np.arctan2(rec['Y'], rec['X']))
+        self.prev_mes = float(rec['X'])
 
-        mes = self.prev_mes + np.random.normal(0, 1)
-        self.prev_mes = mes
+        return rec[()]
 
-        return mes
+    def time_constant(self, refresh: bool = False)->float:
+        return 0.3
     
     def __del__(self):
         pass
@@ -1,5 +1,6 @@
 # %%
 from __future__ import annotations
+import time
 from abc import abstractmethod
 from typing import List, Optional, SupportsFloat as Numeric
 
@@ -62,6 +63,16 @@ class StageDevice:
     def stop(self):
         pass
 
+    def emergency_stop(self)->Optional[float]:
+        """Stop the device as quickly as possible, ahead of any other queued communication.
+
+        Returns:
+            Optional[float]: time.perf_counter() timestamp at which the stop was issued, or None if the device cannot be stopped.
+        """
+        t = time.perf_counter()
+        self.stop()
+        return t
+
     @abstractmethod
     def is_moving(self)->bool:
         pass
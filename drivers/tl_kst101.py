@@ -29,6 +29,7 @@ import time
 from typing import Iterable, List
 from time import sleep
 from utilities import log
+from utilities.ttl_cache import cached
 from threading import Lock
 
 from .thorlabs_net import *
@@ -74,6 +75,8 @@ class ThorlabsKST101(StageDevice):
     def backend(self)->str:
         return 'Thorlabs'
 
+    # BuildDeviceList() rescans USB; don't let the device manager hammer it.
+    @cached(name='Kinesis devices', ttl=0.25, maxsize=1)
     def list_devices():
         build_device_list()
         return get_device_list()
@@ -118,19 +121,26 @@ class ThorlabsKST101(StageDevice):
             for s in ser:
                 if s in ThorlabsKST101.OPEN_DEVICES:
                     return ThorlabsKST101.OPEN_DEVICES[s]
-                try:
-                    device = KCubeStepper.CreateKCubeStepper(s)
-                    device.Connect(s)
-                    out.append(ThorlabsKST101._get_device_info(device))
-                    device.Disconnect()
-                except Exception as e:
-                    raise RuntimeError(
-                        f'Could not get device info for serial {s}. {e}')
+                out.append(ThorlabsKST101._query_device_info(s))
 
             if len(out) == 1:
                 return out[0]
             return out
 
+    # Device info does not change while a device stays plugged in, and each query connects to and disconnects from it.
+    @staticmethod
+    @cached(name='Kinesis device info', ttl=300, maxsize=32)
+    def _query_device_info(s: str) -> dict:
+        try:
+            device = KCubeStepper.CreateKCubeStepper(s)
+            device.Connect(s)
+            info = ThorlabsKST101._get_device_info(device)
+            device.Disconnect()
+            return info
+        except Exception as e:
+            raise RuntimeError(
+                f'Could not get device info for serial {s}. {e}')
+
     def __init__(self, ser=int, pollingIntervalMs: int = 250):
         """Create an instance of Thorlabs KST101 Stepper Motor Controller
 
@@ -264,6 +274,12 @@ class ThorlabsKST101(StageDevice):
         time.sleep(5)
         self.home() # KST201 requires a homing after a stop, otherwise it doesnt move at all.
 
+    def emergency_stop(self)->float:
+        # Halts without deceleration. Does not re-home; follow with stop() to recover the stage.
+        t = time.perf_counter()
+        self._dev.StopImmediate()
+        return t
+
     @wrap_result()
     def _get_state(self):
         return self._dev.State
@@ -377,6 +393,9 @@ class KSTDummy(StageDevice):
         log.info('Stopping.')
         time.sleep(KSTDummy.WR_DLY)
 
+    def emergency_stop(self)->float:
+        return time.perf_counter()
+
     def is_moving(self):
         log.debug('func: is_moving')
         return self._moving
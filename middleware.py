@@ -27,8 +27,8 @@
 import os
 import sys
 import time
+from collections import deque, namedtuple
 from utilities import log
-from collections import deque
 
 #%%
 
@@ -48,10 +48,12 @@ from email.charset import QP
 from time import sleep
 # from io import TextIOWrapper
 # import math as m
-# import numpy as np
+import numpy as np
 # import datetime as dt
 from utilities import safe_serial
 import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import matplotlib
 matplotlib.use('Qt5Agg')
@@ -63,10 +65,13 @@ from drivers import tl_kst101 as tlkt
 from drivers import ki_picoammeter as ki_pico
 from drivers import mp_789a_4 as mp789
 from drivers import mp_792 as mp792
+from drivers import mp_747 as mp747
 from drivers import sr_810 as sr810
 from drivers import sr_860 as sr860
 
 from utilities import ports_finder
+from utilities import port_watcher
+from utilities import ttl_cache
 
 # Motion Controller Types
 # 0 - KST101
@@ -77,34 +82,128 @@ from utilities import ports_finder
 # TODO: Need to implement external triggers when certain actions occur. Should also consider adding a trigger-only faux 'device.'
 
 class DevFinder:
-    def __init__(self):
+    # Identification probes are mostly sleeping, so one thread per port is cheap.
+    PROBE_WORKERS = 8
+
+    # Kinesis devices do not show up as serial ports, so their list is still polled.
+    APT_PERIOD = 2.0
+
+    # Ports which could not be identified are probed again this often, in case their instrument has been switched on.
+    UNKNOWN_REPROBE_PERIOD = 10.0
+
+    def __init__(self, identity_cache_path: str = None):
         self.done = False
         self._master_dev_list = []
 
+        # Instruments seen on previous runs; ports found in here are not probed at all.
+        if identity_cache_path is None:
+            identity_cache_path = os.path.join(appDir, 'devids.ini')
+        self._identities = port_watcher.IdentityCache(identity_cache_path)
+
+        # (port, hwid) -> label, for this run. Ports which could not be identified are left out, so they are probed again.
+        self._probe_cache = ttl_cache.TTLCache('identity probes', maxsize=64)
+
+        # Port -> (hwid, label) for the ports currently present.
+        self._id_cache = {}
+        self._id_cache_lock = threading.Lock()
+        self._probe_pool = ThreadPoolExecutor(max_workers=DevFinder.PROBE_WORKERS, thread_name_prefix='probe')
+
+        # Port -> new hwid, or None if the port went away; filled by the PortWatcher.
+        self._pending = {}
+        self._pending_cv = threading.Condition()
+
         self.device_tid = threading.Thread(target=self.device_t)
         self.device_tid.start()
 
+        self._watcher = port_watcher.PortWatcher(self._port_event)
+
     def __del__(self):
+        self.stop()
+
+    def stop(self):
+        if self.done:
+            return
         self.done = True
+        with self._pending_cv:
+            self._pending_cv.notify_all()
         self.device_tid.join()
+        self._watcher.stop()
+        self._probe_pool.shutdown(wait=False)
+
+    def _port_event(self, event: str, port: str, hwid: str):
+        ports_finder.invalidate_caches()
+        with self._pending_cv:
+            self._pending[port] = None if event == port_watcher.PORT_REMOVED else hwid
+            self._pending_cv.notify_all()
 
     def device_t(self):
+        last_reprobe = time.monotonic()
         while not self.done:
-            port_list = ports_finder.find_serial_ports()
-            dev_name_list = port_list
+            with self._pending_cv:
+                if len(self._pending) == 0:
+                    self._pending_cv.wait(DevFinder.APT_PERIOD)
+                pending, self._pending = self._pending, {}
+
+            # Hotplug only reports the adapter, not the instrument behind it. Ports a driver has open are left alone.
+            if time.monotonic() - last_reprobe >= DevFinder.UNKNOWN_REPROBE_PERIOD:
+                last_reprobe = time.monotonic()
+                with self._id_cache_lock:
+                    for port, (hwid, label) in self._id_cache.items():
+                        if label == '(Unknown)' and not safe_serial.port_in_use(port):
+                            pending.setdefault(port, hwid)
+
+            probes = {}
+            for port, hwid in pending.items():
+                if hwid is None:
+                    with self._id_cache_lock:
+                        self._id_cache.pop(port, None)
+                    continue
+
+                label = self._probe_cache.get((port, hwid))
+                if label is None:
+                    label = self._identities.get(port, hwid)
+                if label is not None:
+                    with self._id_cache_lock:
+                        self._id_cache[port] = (hwid, label)
+                else:
+                    probes[port] = (hwid, self._probe_pool.submit(self.discern_comport, port))
 
-            for i, port in enumerate(port_list):
-                dev_name_list[i] = port_list[i] + ' ' + self.discern_comport(port_list[i])
+            if len(probes) > 0:
+                log.debug('DevFinder probing:', list(probes.keys()))
+            for port, (hwid, probe) in probes.items():
+                try:
+                    label = probe.result()
+                except Exception as e:
+                    log.warn('Probe of %s failed:'%(port), e)
+                    label = '(Unknown)'
+                with self._id_cache_lock:
+                    self._id_cache[port] = (hwid, label)
+                # An unidentified port may just be an adapter whose instrument is switched off; keep probing it.
+                if label != '(Unknown)':
+                    self._probe_cache.put((port, hwid), label)
+                    self._identities.put(port, hwid, label)
+
+            with self._id_cache_lock:
+                dev_name_list = [port + ' ' + self._id_cache[port][1] for port in sorted(self._id_cache.keys())]
 
             apt_list = ports_finder.find_apt_ports()
 
             self._master_dev_list = dev_name_list + apt_list
 
-            sleep(2)
-
     def get_dev_list(self):
         return self._master_dev_list
 
+    def invalidate(self, port: str = None):
+        """ Forgets the identity of `port`, or of every port, including the on-disk record, and probes it again.
+        """
+        with self._id_cache_lock:
+            ports = {p: hwid for p, (hwid, _) in self._id_cache.items() if port is None or p == port}
+
+        for p, hwid in ports.items():
+            self._probe_cache.invalidate((p, hwid))
+            self._identities.forget(p)
+            self._port_event(port_watcher.PORT_CHANGED, p, hwid)
+
     def discern_comport(self, comport: str):
         s = safe_serial.SafeSerial(comport, 9600, timeout=1)
         sleep(0.5)
@@ -121,9 +220,7 @@ class DevFinder:
             s.close()
             return '(MP 789A-4 or MP 792)'
         else:
-            # Check if a Keithley 6485 is on this comport.
-            s.write(b'*RST')
-            sleep(0.5)
+            # Check if a Keithley 6485 is on this comport. *IDN? alone identifies it; no need to reset the instrument.
             s.write(b'*IDN?')
             sleep(0.5)
             raw = s.read(128)
@@ -160,10 +257,146 @@ def new_motion_controller(dummy: bool, dev_model: str, man_port: str = None):
     log.debug('devs:', devs)
     return devs
 
+class MotionMonitor:
+    """Estimates an axis's velocity and acceleration from positions sampled at a steady rate.
+
+    Fed raw driver positions, in steps, by the MotionController refresher thread. Settling uses hysteresis: the axis is
+    only considered settled after `settle_samples` consecutive samples at or below `settle_velocity`, and becomes
+    unsettled on the first sample above `unsettle_velocity` or when a move is started. Settling speeds are measured
+    outside a deadband, so that an idle encoder jittering by a step between samples reads as still.
+    """
+
+    # Steps. Position changes of at most this much between two samples count as no motion when settling.
+    DEFAULT_DEADBAND = 1.0
+    # Steps per second, measured outside the deadband.
+    DEFAULT_SETTLE_VELOCITY = 5.0
+    # Steps per second, measured outside the deadband.
+    DEFAULT_UNSETTLE_VELOCITY = 25.0
+
+    def __init__(self, alpha: float = 0.5, settle_velocity: float = DEFAULT_SETTLE_VELOCITY, unsettle_velocity: float = DEFAULT_UNSETTLE_VELOCITY, settle_samples: int = 3, deadband: float = DEFAULT_DEADBAND):
+        """_summary_
+
+        Args:
+            alpha (float, optional): Weight of the newest sample in the velocity and acceleration moving averages. Defaults to 0.5.
+            settle_velocity (float, optional): Speed, in steps per second, at or below which a sample counts towards settling. Defaults to 5.0.
+            unsettle_velocity (float, optional): Speed, in steps per second, above which the axis is no longer settled. Defaults to 25.0.
+            settle_samples (int, optional): Consecutive slow samples needed to settle. Defaults to 3.
+            deadband (float, optional): Position change, in steps, ignored between two samples when measuring settling speed. Defaults to 1.0.
+        """
+        self.alpha = alpha
+        self.settle_velocity = settle_velocity
+        self.unsettle_velocity = max(unsettle_velocity, settle_velocity)
+        self.settle_samples = settle_samples
+        self.deadband = deadband
+
+        self._lock = threading.Lock()
+        self._last = None # (timestamp, position)
+        self._velocity = 0.0
+        self._acceleration = 0.0
+        self._slow_samples = settle_samples
+        self._settled = True
+
+    def update(self, t: float, position: float):
+        """Adds a position sample.
+
+        Args:
+            t (float): Sample time, in seconds.
+            position (float): Position at `t`.
+        """
+        with self._lock:
+            if self._last is not None and t > self._last[0]:
+                dt = t - self._last[0]
+                v = (position - self._last[1]) / dt
+                prev_velocity = self._velocity
+                self._velocity += self.alpha * (v - self._velocity)
+                self._acceleration += self.alpha * (((self._velocity - prev_velocity) / dt) - self._acceleration)
+
+                speed = max(abs(position - self._last[1]) - self.deadband, 0.0) / dt
+                if speed > self.unsettle_velocity:
+                    self._settled = False
+                    self._slow_samples = 0
+                elif speed <= self.settle_velocity:
+                    self._slow_samples += 1
+                    if self._slow_samples >= self.settle_samples:
+                        self._settled = True
+                        self._velocity = 0.0
+                        self._acceleration = 0.0
+
+            self._last = (t, position)
+
+    def unsettle(self):
+        """Marks the axis as unsettled, e.g. because a move was just commanded.
+        """
+        with self._lock:
+            self._settled = False
+            self._slow_samples = 0
+
+    def reset(self):
+        """Marks the axis as settled and forgets its motion, e.g. because its position can no longer be sampled.
+        """
+        with self._lock:
+            self._settled = True
+            self._slow_samples = self.settle_samples
+            self._velocity = 0.0
+            self._acceleration = 0.0
+
+    def settled(self) -> bool:
+        return self._settled
+
+    def get_velocity(self) -> float:
+        return self._velocity
+
+    def get_acceleration(self) -> float:
+        return self._acceleration
+
+    def get_position(self) -> float:
+        last = self._last
+        return None if last is None else last[1]
+
+    def eta_to_target(self, target: float) -> float:
+        """Estimates the time until the axis reaches `target` at its current velocity.
+
+        Returns:
+            float: Seconds; 0 if at `target`, or None if the axis is not heading towards it.
+        """
+        with self._lock:
+            if self._last is None:
+                return None
+
+            remaining = target - self._last[1]
+            if remaining == 0:
+                return 0.0
+            if self._settled or self._velocity == 0 or (remaining > 0) != (self._velocity > 0):
+                return None
+            return remaining / self._velocity
+
 class MotionController:
     """Provides a layer of abstraction for communication with motion controller drivers.
     """
-    SupportedDevices = ['TL KST101/201', 'MP 789A-4', 'MP 792']
+    SupportedDevices = ['TL KST101/201', 'MP 789A-4', 'MP 792', 'MP 747']
+
+    # Seconds from an all-stop request to the first stop command issued, per controller.
+    ALL_STOP_TARGET = 0.020
+
+    # Move time model used by scan plans until a real move has been timed: fixed overhead plus distance / rate.
+    DEFAULT_MOVE_RATE = 1000.0
+    MOVE_OVERHEAD = 0.5
+
+    # Every live MotionController, so that all_stop() can reach all of them. Weak, so that controllers dropped on
+    # reconnect or shutdown fall out of it instead of being stopped through stale handles.
+    _registry = weakref.WeakSet()
+    _registry_lock = threading.Lock()
+
+    # Position / state reads are served from a cache at most this many seconds old.
+    DEFAULT_POSITION_TTL = 0.2
+    # While any axis is in motion, one shared thread refreshes its cache this often.
+    REFRESH_PERIOD = 0.1
+    # Consecutive failed refreshes after which an axis is no longer polled.
+    REFRESH_RETRIES = 10
+
+    _refresh_cv = threading.Condition()
+    _refresh_active = set()
+    _refresher_tid = None
 
     def __init__(self, dummy: bool, dev_model: str, man_port: str = None, axis: int = 0, parent = None):
         """_summary_
@@ -193,7 +426,17 @@ class MotionController:
         self._port = None
         self._axis = 0
         self._multi_axis = False
-        self._position_history = deque([0] * 5, maxlen=5) 
+        self._monitor = MotionMonitor()
+        self._refresh_failures = 0
+        self._target = None
+
+        # Learned indexing speed, in steps per second; see estimate_move_time().
+        self._move_rate = None
+
+        # Cached (timestamp, raw driver position, driver moving) as of the last hardware read; None when invalid.
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        self._position_ttl = MotionController.DEFAULT_POSITION_TTL
 
         self._max_pos = 9999
         self._min_pos = -9999
@@ -239,6 +482,14 @@ class MotionController:
                 pass
             else:
                 self._motor_ctrl = mp789.MP_789A_4(man_port)
+        elif self._model == MotionController.SupportedDevices[3]:
+            if dummy:
+                # There is no MP_747_DUMMY; the driver runs against the wire-level simulator instead.
+                if man_port is None:
+                    man_port = 'MP747_SIM'
+                if man_port not in safe_serial.virtual_ports:
+                    safe_serial.register_virtual_port(man_port, mp747.MP_747_SIM())
+            self._motor_ctrl = mp747.MP_747(man_port)
         elif self._model.startswith('MP_792_AXIS_'):
             self._motor_ctrl = parent
             self._axis = axis
@@ -253,9 +504,64 @@ class MotionController:
 
         self._port = man_port
 
-    def all_stop():
-        log.info('Middleware all-stop received.')
-        log.error('All-stop currently not implemented.')
+        with MotionController._registry_lock:
+            MotionController._registry.add(self)
+
+    @staticmethod
+    def all_stop()->dict:
+        """Stops every motion controller at once.
+
+        Each driver gets its own thread, which issues an out-of-band stop (see the drivers' emergency_stop()) and then
+        the usual redundant stop() for each of its axes. Returns as soon as every driver has issued its first stop.
+
+        Returns:
+            dict: Seconds from the request to the first stop issued, keyed by driver and port. None if the driver cannot stop or did not respond.
+        """
+        t0 = time.perf_counter()
+
+        with MotionController._registry_lock:
+            controllers = list(MotionController._registry)
+
+        # Axes of a multi-axis controller share one driver and are stopped together.
+        groups = {}
+        for mc in controllers:
+            groups.setdefault(id(mc._motor_ctrl), []).append(mc)
+
+        latencies = {}
+        issued = []
+        for group in groups.values():
+            event = threading.Event()
+            issued.append(event)
+            threading.Thread(target=MotionController._stop_group, args=(group, t0, latencies, event), daemon=True).start()
+
+        for event in issued:
+            event.wait(1)
+
+        log.info('Middleware all-stop issued:', latencies)
+        for name, latency in latencies.items():
+            if latency is not None and latency > MotionController.ALL_STOP_TARGET:
+                log.warn('All-stop of %s took %.1f ms.'%(name, latency * 1000))
+
+        return latencies
+
+    @staticmethod
+    def _stop_group(group: list, t0: float, latencies: dict, issued: threading.Event):
+        driver = group[0]._motor_ctrl
+        name = '%s (%s)'%(driver.short_name(), group[0]._port)
+
+        try:
+            t = driver.emergency_stop()
+            latencies[name] = None if t is None else t - t0
+        except Exception as e:
+            latencies[name] = None
+            log.error('Emergency stop of %s failed:'%(name), e)
+        issued.set()
+
+        for mc in group:
+            try:
+                mc.stop()
+            except Exception as e:
+                log.error('Stop of %s failed:'%(name), e)
 
     # Setters.
     def set_limits(self, max_pos, min_pos):
@@ -300,7 +606,26 @@ class MotionController:
         log.debug('Steps-per-value for %s is now %f.'%(self.short_name(), self._steps_per_value))
         return self._steps_per_value
 
+    def set_position_ttl(self, ttl: float):
+        """Sets how stale a cached position or movement status may be before it is re-read from the device.
+
+        Args:
+            ttl (float): Maximum age, in seconds. 0 always reads the device.
+        """
+        self._position_ttl = ttl
+
+    def get_position_ttl(self) -> float:
+        return self._position_ttl
+
     # Getters.
+    def get_limits(self) -> tuple:
+        """Gets the software-defined movement limits of this axis.
+
+        Returns:
+            tuple[float, float]: (max_pos, min_pos), in the same order as set_limits().
+        """
+        return self._max_pos, self._min_pos
+
     def get_steps_per_value(self) -> float:
         """Gets the conversion factor from hardware steps to real-world units.
 
@@ -337,6 +662,8 @@ class MotionController:
         if self._homing:
             raise Exception("Already homing!")
         self._homing = True
+        self.invalidate_cache()
+        self._watch()
         
         if blocking:
             log.info('Starting blocking home.')
@@ -364,6 +691,84 @@ class MotionController:
             self._motor_ctrl.home()
         self._homing = False
         self._homing_thread_active = False
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """Discards the cached position and movement status so that the next read goes to the device.
+        """
+        self._cache = None
+
+    def _read_state(self) -> tuple:
+        # Returns the cached (timestamp, raw position, moving), reading the device if the cache is stale.
+        cache = self._cache
+        if cache is not None and time.time() - cache[0] <= self._position_ttl:
+            return cache
+
+        # Only one thread reads the device; others wait for and share its result.
+        with self._cache_lock:
+            cache = self._cache
+            if cache is not None and time.time() - cache[0] <= self._position_ttl:
+                return cache
+
+            if self._multi_axis:
+                raw = self._motor_ctrl.get_position(self._axis)
+                moving = self._motor_ctrl.is_moving(self._axis)
+            else:
+                raw = self._motor_ctrl.get_position()
+                moving = self._motor_ctrl.is_moving()
+
+            cache = (time.time(), raw, moving)
+            self._cache = cache
+
+        return cache
+
+    def _watch(self):
+        # Hands this axis to the shared refresher until it has stopped and settled.
+        self._monitor.unsettle()
+        with MotionController._refresh_cv:
+            MotionController._refresh_active.add(self)
+            if MotionController._refresher_tid is None:
+                MotionController._refresher_tid = threading.Thread(target=MotionController._refresher_thread, daemon=True)
+                MotionController._refresher_tid.start()
+            MotionController._refresh_cv.notify_all()
+
+    @staticmethod
+    def _refresher_thread():
+        # Keeps the caches of moving axes warm so that readers never have to wait on the hardware.
+        while True:
+            with MotionController._refresh_cv:
+                while not MotionController._refresh_active:
+                    MotionController._refresh_cv.wait()
+                active = list(MotionController._refresh_active)
+
+            for mc in active:
+                try:
+                    mc.invalidate_cache()
+                    t, raw, moving = mc._read_state()
+                    mc._monitor.update(t, raw)
+                    mc._refresh_failures = 0
+                except Exception as e:
+                    # A failed read says nothing about whether the axis has stopped, so the monitor keeps its state
+                    # (and is_moving() keeps reporting motion) while the read is retried.
+                    mc._refresh_failures += 1
+                    if mc._refresh_failures < MotionController.REFRESH_RETRIES:
+                        log.warn('Position refresh of %s failed:'%(mc.short_name()), e)
+                        continue
+                    log.error('Position refresh of %s failed %d times, no longer polling:'%(mc.short_name(), mc._refresh_failures), e)
+                    mc._refresh_failures = 0
+                    # Nothing will settle the monitor now. Leaving it unsettled would have is_moving() report motion
+                    # forever; reset, it falls back to reading the device, which raises to callers while it is failing.
+                    mc._monitor.reset()
+                    mc.invalidate_cache()
+                    with MotionController._refresh_cv:
+                        MotionController._refresh_active.discard(mc)
+                    continue
+
+                if not (moving or mc._moving or mc._homing or not mc._monitor.settled()):
+                    with MotionController._refresh_cv:
+                        MotionController._refresh_active.discard(mc)
+
+            time.sleep(MotionController.REFRESH_PERIOD)
 
     def get_position(self) -> float:
         """Returns the current position of the machine in real-world units.
@@ -375,12 +780,8 @@ class MotionController:
         if self._steps_per_value == 0:
             position = 0 + self._offset
         else:
-            if self._multi_axis:
-                position = (self._motor_ctrl.get_position(self._axis) / self._steps_per_value) - self._offset
-            else:
-                position = (self._motor_ctrl.get_position() / self._steps_per_value) - self._offset
+            position = (self._read_state()[1] / self._steps_per_value) - self._offset
 
-        self._position_history.appendleft(position)
         return position
 
     def is_homing(self) -> bool:
@@ -395,18 +796,51 @@ class MotionController:
             return self._motor_ctrl.is_homing()
 
     def is_moving(self) -> bool:
-        # An extra layer of safety: the device is considered to be moving if the position history indicates as such, even if it reports that it is not moving.
-        pos_detected_moving = not all(x == self._position_history[0] for x in self._position_history)
-        # print(self._position_history)
-        # print('Pos det mov:', pos_detected_moving)
+        # An extra layer of safety: the device is considered to be moving until its sampled position has settled, even if it reports that it is not moving.
+        return self._moving or self._homing or self._read_state()[2] or not self._monitor.settled()
 
-        if self._multi_axis:
-            self._moving = self._motor_ctrl.is_moving(self._axis) or pos_detected_moving
-            # return self._motor_ctrl.is_moving(self._axis) or pos_detected_moving
-        else:
-            self._moving = self._motor_ctrl.is_moving() or pos_detected_moving
-            # return self._motor_ctrl.is_moving() or pos_detected_moving
-        return self._moving
+    def settled(self) -> bool:
+        """Returns whether no move is in progress, the axis reports stopped and its sampled position has stopped changing.
+        """
+        return not self.is_moving()
+
+    def wait_settled(self, timeout: float = None) -> bool:
+        """Blocks until the axis has settled.
+
+        Args:
+            timeout (float, optional): Maximum wait, in seconds. Defaults to None (no limit).
+
+        Returns:
+            bool: True if settled, False on timeout.
+        """
+        start = time.time()
+        while not self.settled():
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(MotionController.REFRESH_PERIOD / 2)
+        return True
+
+    def get_velocity(self) -> float:
+        """Returns the estimated velocity in real-world units per second.
+        """
+        if self._steps_per_value == 0:
+            return 0.0
+        return self._monitor.get_velocity() / self._steps_per_value
+
+    def eta_to_target(self, target: float = None) -> float:
+        """Estimates the time until the axis reaches a position.
+
+        Args:
+            target (float, optional): Position in real-world units. Defaults to the destination of the last move_to().
+
+        Returns:
+            float: Seconds; 0 if at the target, or None if unknown or the axis is not heading towards it.
+        """
+        if target is None:
+            target = self._target
+        if target is None or self._steps_per_value == 0:
+            return None
+        return self._monitor.eta_to_target((target + self._offset) * self._steps_per_value)
 
     def move_to(self, position, block):
         # If we are supposedly moving, check if we actually are.
@@ -419,20 +853,17 @@ class MotionController:
                 # If we're actually still moving...
                 raise Exception("Already moving!")
         self._moving = True
+        self._target = position
+        self.invalidate_cache()
         log.info('Moving to position:', position, 'with blocking:', block)
 
-        if self._steps_per_value == 0:
-            self._moving = False
-            log.error('Steps-per value has not been set for this axis (%s). This value must be set in the Machine Configuration window.'%(self.short_name()))
-            raise Exception('Steps-per value has not been set for this axis. This value must be set in the Machine Configuration window.')
-        if position > self._max_pos:
+        error = self.check_target(position)
+        if error is not None:
             self._moving = False
-            log.error('Position is beyond the upper limit of this %s axis [%f < %f < %f].'%(self.short_name(), self._min_pos, position, self._max_pos))
-            raise Exception('Position is beyond the upper limit of this %s axis [%f < %f < %f].'%(self.short_name(), self._min_pos, position, self._max_pos))
-        if position < self._min_pos:
-            self._moving = False
-            log.error('Position is beyond the lower limit of this %s axis [%f < %f < %f].'%(self.short_name(), self._min_pos, position, self._max_pos))
-            raise Exception('Position is beyond the lower limit of this %s axis [%f < %f < %f].'%(self.short_name(), self._min_pos, position, self._max_pos))
+            log.error(error)
+            raise Exception(error)
+
+        self._watch()
 
         if block:
             log.info('Blocking.')
@@ -443,6 +874,41 @@ class MotionController:
             move_th.start()
             return
 
+    def check_target(self, position) -> str:
+        """Checks that a move to `position` would be accepted, without moving.
+
+        Args:
+            position (float): Destination in real-world units.
+
+        Returns:
+            str: Why the move would be refused, or None if it is valid.
+        """
+        if self._steps_per_value == 0:
+            return 'Steps-per value has not been set for this axis (%s). This value must be set in the Machine Configuration window.'%(self.short_name())
+        if position > self._max_pos:
+            return 'Position is beyond the upper limit of this %s axis [%f < %f < %f].'%(self.short_name(), self._min_pos, position, self._max_pos)
+        if position < self._min_pos:
+            return 'Position is beyond the lower limit of this %s axis [%f < %f < %f].'%(self.short_name(), self._min_pos, position, self._max_pos)
+        return None
+
+    def to_steps(self, position) -> int:
+        """Converts a position in real-world units to the driver's step target."""
+        return int((position * self._steps_per_value) + (self._offset * self._steps_per_value))
+
+    def backlash_steps(self, position) -> float:
+        """Returns the backlash correction, in steps, that a move to `position` would request. 0 if disabled."""
+        backlash = (position * self._steps_per_value) - (self._min_pos * self._steps_per_value) # Steps until we hit minimum.
+        backlash *= self._manual_backlash # If we have automatic backlash correction, _manual_backlash will be set to 0. A zero sent to the move_to() function will simply disable backlash.
+        if backlash > self._max_backlash:
+            backlash = self._max_backlash
+        return backlash
+
+    def estimate_move_time(self, from_steps: int, to_steps: int) -> float:
+        """Estimates how long a move between two step targets takes, from the speed of previous moves.
+        """
+        rate = self._move_rate if self._move_rate is not None else MotionController.DEFAULT_MOVE_RATE
+        return MotionController.MOVE_OVERHEAD + abs(to_steps - from_steps) / rate
+
     def _move_to(self, position):
         # if self._steps_per_value == 0:
         #     self._moving = False
@@ -457,18 +923,29 @@ class MotionController:
         #     log.error('Position is beyond the lower limit of this %s axis [%f < %f < %f].'%(self.short_name(), self._min_pos, position, self._max_pos))
         #     raise Exception('Position is beyond the lower limit of this %s axis [%f < %f < %f].'%(self.short_name(), self._min_pos, position, self._max_pos))
 
-        backlash = (position * self._steps_per_value) - (self._min_pos * self._steps_per_value) # Steps until we hit minimum.
-        backlash *= self._manual_backlash # If we have automatic backlash correction, _manual_backlash will be set to 0. A zero sent to the move_to() function will simply disable backlash.
-        if backlash > self._max_backlash:
-            backlash = self._max_backlash
-
-        if self._multi_axis:
-            retval = self._motor_ctrl.move_to(int((position * self._steps_per_value) + (self._offset * self._steps_per_value)), self._axis, backlash)
-        else:
-            log.debug('Single-axis valid case.')
-            retval = self._motor_ctrl.move_to(int((position * self._steps_per_value) + (self._offset * self._steps_per_value)), backlash)
+        backlash = self.backlash_steps(position)
+        steps = self.to_steps(position)
+        start_steps = self._read_state()[1]
+        t0 = time.time()
 
-        self._moving = False
+        try:
+            if self._multi_axis:
+                retval = self._motor_ctrl.move_to(steps, self._axis, backlash)
+            else:
+                log.debug('Single-axis valid case.')
+                retval = self._motor_ctrl.move_to(steps, backlash)
+
+            # Learn the indexing speed from long enough moves; short ones are dominated by overhead.
+            elapsed = time.time() - t0 - MotionController.MOVE_OVERHEAD
+            distance = abs(steps - start_steps)
+            if elapsed > 0.1 and distance > 0:
+                rate = distance / elapsed
+                self._move_rate = rate if self._move_rate is None else 0.7 * self._move_rate + 0.3 * rate
+        finally:
+            # Not settled until the refresher has seen the position hold still after the move.
+            self._monitor.unsettle()
+            self._moving = False
+            self.invalidate_cache()
         return retval
     
     def stop(self):
@@ -478,6 +955,7 @@ class MotionController:
             self._motor_ctrl.stop()
 
         self._moving = False
+        self.invalidate_cache()
 
     def set_home_speed_mult(self, speed):
         log.info(f'Setting home speed multiplier to {speed}.')
@@ -505,11 +983,121 @@ class MotionController:
     pass
 
 
+# MotionGroup
+# Coordinates simultaneous moves of several MotionControllers.
+class MotionGroup:
+    """Moves several axes together and waits for all of them.
+
+    Moves on independent controllers run concurrently. Moves which share a port run one after another in the order
+    they were added, except on a controller which schedules its own axes (the MP 792), which is handed all of its moves
+    at once.
+    """
+
+    def __init__(self):
+        self._moves = []
+
+    def add(self, axis: MotionController, position: float) -> 'MotionGroup':
+        """Adds a move to the group.
+
+        Args:
+            axis (MotionController): The axis to move.
+            position (float): Destination in real-world units.
+
+        Returns:
+            MotionGroup: This group, so that calls can be chained.
+        """
+        self._moves.append((axis, position))
+        return self
+
+    def execute(self):
+        """Performs every move and blocks until all have finished.
+
+        Raises:
+            RuntimeError: Raised if any move failed; the other moves are still allowed to complete.
+        """
+        # Group moves by port; KSTs have no port and are independent of each other.
+        ports = {}
+        for axis, position in self._moves:
+            key = axis._port if axis._port is not None else id(axis._motor_ctrl)
+            ports.setdefault(key, []).append((axis, position))
+
+        lanes = []
+        for moves in ports.values():
+            if MotionGroup._self_scheduling(moves):
+                lanes += [[move] for move in moves]
+            else:
+                lanes.append(moves)
+
+        errors = []
+        threads = [threading.Thread(target=MotionGroup._run_lane, args=(lane, errors)) for lane in lanes]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+
+        if len(errors) > 0:
+            raise RuntimeError('; '.join(['%s: %s'%(name, e) for name, e in errors]))
+
+    @staticmethod
+    def _self_scheduling(moves: list) -> bool:
+        drivers = set([id(axis._motor_ctrl) for axis, position in moves])
+        axis = moves[0][0]
+        return len(drivers) == 1 and axis._multi_axis and hasattr(axis._motor_ctrl, 'submit_move')
+
+    @staticmethod
+    def _run_lane(lane: list, errors: list):
+        for axis, position in lane:
+            try:
+                axis.move_to(position, True)
+            except Exception as e:
+                log.error('Group move of %s to %s failed:'%(axis.short_name(), position), e)
+                errors.append((axis.short_name(), e))
+                return
+
+# Detector Readings
+# Averaged measurements and the running statistics used to produce them.
+
+# One averaged detector reading: mean, sample standard deviation and the number of samples taken. `channels` is the
+# averaged structured record of every channel the detector reports (see Detector.record_dtype), or None.
+Measurement = namedtuple('Measurement', ['mean', 'std', 'n', 'channels'], defaults=(None,))
+
+class RunningStats:
+    """ Welford's running mean and variance; numerically stable and O(1) per sample.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def push(self, x: float):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (x - self.mean)
+
+    def variance(self)->float:
+        if self.n < 2:
+            return 0.0
+        return self._m2 / (self.n - 1)
+
+    def std(self)->float:
+        return self.variance() ** 0.5
+
+    def sem(self)->float:
+        """ Standard error of the mean. Infinite until there are two samples. """
+        if self.n < 2:
+            return float('inf')
+        return (self.variance() / self.n) ** 0.5
+
 # Detector
 # Genericizes the type of detector.
 class Detector:
     SupportedDevices = ['KI 6485', 'SR 810', 'SR 860']
 
+    # Seconds per reading assumed by estimate_detect_time() until one has been timed.
+    DEFAULT_SAMPLE_TIME = 0.1
+
     # The detector middleware's detect() function returns the most recently detected data (because Qt needs a callback to update the graph's lines' data), but also the data is stored and can be retrieved en masse.
 
     def __init__(self, dummy: bool, dev_model: str, man_port: str = None):
@@ -517,9 +1105,29 @@ class Detector:
         self.pa = None
         self._is_dummy = False
 
+        # NumPy dtype of the records returned by the driver's detect_record(); the first field is the primary reading.
+        self.record_dtype = None
+
         self.detect_delay = 0.0
         self.per_detection_averages = 1
 
+        # Early-stopping averaging; replaces the fixed per_detection_averages when a target is set. See set_averaging_target().
+        self.target_sem = None
+        self.target_rel_sem = None
+        self.min_averages = 3
+        self.max_averages = 100
+
+        # Learned seconds per reading; see estimate_detect_time().
+        self._sample_time = None
+
+        # Adaptive settling; replaces detect_delay when enabled. See set_settle_mode().
+        self.settle_mode = False
+        self.settle_window = 5
+        self.settle_tolerance = 0.01
+        self.settle_abs_tolerance = 0.0
+        self.settle_max_wait = 10.0
+        self.settle_time_constants = 5
+
         # TODO: PLACEHOLDER! Change this to an xarray dataset...
         self.data = []
 
@@ -532,18 +1140,21 @@ class Detector:
                     self.pa = ki_pico.KI_Picoammeter(3, man_port)
                 else:
                     self.pa = ki_pico.KI_Picoammeter(3)
+            self.record_dtype = ki_pico.KI_RECORD
         elif self.model == Detector.SupportedDevices[1]:
             if dummy:
                 self.pa = sr810.SR810_DUMMY()
                 self._is_dummy = True
             else:
                 self.pa = sr810.SR810()
+            self.record_dtype = sr810.SR810_RECORD
         elif self.model == Detector.SupportedDevices[2]:
             if dummy:
                 self.pa = sr860.SR860_DUMMY()
                 self._is_dummy = True
             else:
                 self.pa = sr860.SR860(man_port)
+            self.record_dtype = sr860.SR860_RECORD
         else:
             log.error('Detector device model "%s" is not supported.'%(dev_model))
             raise Exception
@@ -551,22 +1162,174 @@ class Detector:
     # TODO: vvv Probably not necessary.
     # TODO: Need a pinger to keep the ComPort open... here or in the drivers? Probably drivers.
 
+    def set_settle_mode(self, enable: bool, window: int = 5, tolerance: float = 0.01, abs_tolerance: float = 0.0, max_wait: float = 10.0, time_constants: float = 5):
+        """Enables or disables adaptive settling, which replaces the fixed detect_delay.
+
+        When enabled, detect() samples the detector back-to-back and measures once the last `window` readings span no
+        more than `tolerance` times their mean (or `abs_tolerance`, whichever is larger), or once `max_wait` seconds
+        have passed. Lock-ins always wait at least `time_constants` time constants first.
+
+        Args:
+            enable (bool): Use adaptive settling (True) or detect_delay (False).
+            window (int, optional): Number of readings which must agree. Defaults to 5.
+            tolerance (float, optional): Allowed spread, relative to the mean. Defaults to 0.01.
+            abs_tolerance (float, optional): Allowed spread, in the detector's units. Defaults to 0.0.
+            max_wait (float, optional): Hard limit on the settling time, in seconds. Defaults to 10.0.
+            time_constants (float, optional): Minimum wait for lock-ins, in time constants. Defaults to 5.
+
+        Raises:
+            ValueError: If any of the limits is out of range.
+        """
+        if window < 2:
+            raise ValueError('Settling window must be at least 2 readings, got %s.'%(window))
+        if tolerance < 0 or abs_tolerance < 0:
+            raise ValueError('Settling tolerances must not be negative, got %s and %s.'%(tolerance, abs_tolerance))
+        if max_wait <= 0:
+            raise ValueError('Settling time limit must be positive, got %s.'%(max_wait))
+        if time_constants < 0:
+            raise ValueError('Settling time constants must not be negative, got %s.'%(time_constants))
+
+        self.settle_mode = enable
+        self.settle_window = window
+        self.settle_tolerance = tolerance
+        self.settle_abs_tolerance = abs_tolerance
+        self.settle_max_wait = max_wait
+        self.settle_time_constants = time_constants
+
+    def set_averaging_target(self, rel_sem: float = None, abs_sem: float = None, min_samples: int = 3, max_samples: int = 100):
+        """Averages each point until its standard error of the mean reaches a target, instead of a fixed count.
+
+        Sampling stops once the standard error is at or below `rel_sem` times the magnitude of the mean, or `abs_sem`,
+        whichever is larger, or once `max_samples` samples have been taken. With neither target set, the fixed
+        per_detection_averages count is used.
+
+        Args:
+            rel_sem (float, optional): Target standard error, relative to the mean. Defaults to None.
+            abs_sem (float, optional): Target standard error, in the detector's units. Defaults to None.
+            min_samples (int, optional): Samples always taken before stopping. Defaults to 3.
+            max_samples (int, optional): Hard limit on the samples per point. Defaults to 100.
+        """
+        self.target_rel_sem = rel_sem
+        self.target_sem = abs_sem
+        self.min_averages = max(2, min_samples)
+        self.max_averages = max(self.min_averages, max_samples)
+
+    def _settle(self) -> float:
+        # Blocks until the signal has settled; returns the time spent.
+        start = time.time()
+
+        if hasattr(self.pa, 'time_constant'):
+            min_wait = self.settle_time_constants * self.pa.time_constant()
+            if min_wait >= self.settle_max_wait:
+                log.warn('%s needs %g s for %g time constants, more than the %g s settling limit.'%(self.short_name(), min_wait, self.settle_time_constants, self.settle_max_wait))
+            time.sleep(min(min_wait, self.settle_max_wait))
+
+        # Always fill one window, even past the time limit, so that at least one settling check is made.
+        window = deque(maxlen=self.settle_window)
+        while len(window) < self.settle_window or time.time() - start < self.settle_max_wait:
+            window.append(self.pa.detect())
+            if len(window) < self.settle_window:
+                continue
+
+            spread = max(window) - min(window)
+            mean = sum(window) / len(window)
+            if spread <= max(self.settle_tolerance * abs(mean), self.settle_abs_tolerance):
+                log.debug('%s settled after %.3f s.'%(self.short_name(), time.time() - start))
+                return time.time() - start
+
+        log.warn('%s did not settle within %.1f s.'%(self.short_name(), self.settle_max_wait))
+        return time.time() - start
+
     # Only function used in mmc.py (.pa.detect())
     def detect(self):
-        time.sleep(self.detect_delay)
-        
-        mes = 0.0
-        if self.per_detection_averages == 1:
-            log.debug('Sampling (1/1).')
-            mes = self.pa.detect()
-        else:        
+        return self.measure().mean
+
+    def estimate_detect_time(self) -> float:
+        """Estimates the duration of one measure() call, in seconds, from the readings taken so far.
+        """
+        sample_time = self._sample_time if self._sample_time is not None else Detector.DEFAULT_SAMPLE_TIME
+        if self.settle_mode:
+            wait = self.settle_window * sample_time
+            if hasattr(self.pa, 'time_constant'):
+                wait += self.settle_time_constants * self.pa.time_constant()
+            wait = min(wait, self.settle_max_wait)
+        else:
+            wait = self.detect_delay
+
+        if self.target_sem is None and self.target_rel_sem is None:
+            samples = self.per_detection_averages
+        else:
+            # Early stopping lands somewhere between the two; assume the middle.
+            samples = (self.min_averages + self.max_averages) / 2
+        return wait + samples * sample_time
+
+    def sample(self) -> float:
+        """Takes a single reading immediately, without detect_delay, settling or averaging. Used by fly scans.
+        """
+        return self.pa.detect()
+
+    def measure(self) -> Measurement:
+        """Takes one averaged reading.
+
+        Returns:
+            Measurement: The mean, sample standard deviation and number of samples.
+        """
+        if self.settle_mode:
+            self._settle()
+        else:
+            time.sleep(self.detect_delay)
+
+        stats = RunningStats()
+        records = []
+        if self.target_sem is None and self.target_rel_sem is None:
             for i in range(self.per_detection_averages):
                 log.debug(f'Sampling ({i + 1}/{self.per_detection_averages}).')
-                mes += self.pa.detect()
-            mes /= self.per_detection_averages
+                stats.push(self._sample(records))
+        else:
+            while stats.n < self.max_averages:
+                stats.push(self._sample(records))
+                if stats.n < self.min_averages:
+                    continue
+
+                target = max(self.target_sem or 0.0, (self.target_rel_sem or 0.0) * abs(stats.mean))
+                if stats.sem() <= target:
+                    break
+            log.debug('Sampled %d times; mean %e, SEM %e.'%(stats.n, stats.mean, stats.sem()))
+
+        return Measurement(stats.mean, stats.std(), stats.n, self._average_records(records))
+
+    def _sample(self, records: list) -> float:
+        # Takes one reading; the full channel record, if the detector has one, is appended to `records`.
+        t0 = time.time()
+        if self.record_dtype is None:
+            mes = self.pa.detect()
+        else:
+            rec = self.pa.detect_record()
+            records.append(rec)
+            mes = float(rec[0])
 
+        dt = time.time() - t0
+        self._sample_time = dt if self._sample_time is None else 0.8 * self._sample_time + 0.2 * dt
         return mes
 
+    def _average_records(self, records: list):
+        if len(records) == 0:
+            return None
+
+        arr = np.array(records, dtype=self.record_dtype)
+        out = np.array(arr[-1], dtype=self.record_dtype)
+        for name in self.record_dtype.names:
+            # Integer fields are status words; keep the latest rather than averaging.
+            if arr[name].dtype.kind == 'f':
+                out[name] = arr[name].mean()
+
+        # Lock-ins: magnitude and phase of the averaged phasor, not the average magnitude and phase.
+        if {'X', 'Y', 'R', 'THETA'} <= set(self.record_dtype.names):
+            out['R'] = np.hypot(out['X'], out['Y'])
+            out['THETA'] = np.degrees(np.arctan2(out['Y'], out['X']))
+
+        return out[()]
+
     def is_dummy(self):
         return self._is_dummy
 
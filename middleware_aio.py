@@ -0,0 +1,118 @@
+#
+# @file middleware_aio.py
+# @author Mit Bailey (mitbailey@outlook.com)
+# @brief asyncio facade over the blocking middleware, for scripted experiments.
+# @version See Git tags for version information.
+# @date 2026.10.19
+#
+# @copyright Copyright (c) 2022
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+
+# Usage:
+#
+#   axis = AsyncMotionController(mc)
+#   det = AsyncDetector(detector)
+#   await axis.home()
+#   for x in positions:
+#       await axis.move_to(x)
+#       mes, _ = await asyncio.gather(det.measure(), other_axis.move_to(y))
+#
+# Cancelling a task awaiting move_to() or home() stops that axis before the CancelledError propagates.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from middleware import MotionController, Detector, Measurement
+from utilities import log
+
+# The middleware calls block for the whole move, so each concurrent operation needs its own thread. The loop's default
+# executor is sized for short tasks and would serialize a large rig.
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='aio')
+
+async def _call(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+class AsyncMotionController:
+    """Awaitable wrapper around a MotionController. Attributes not overridden here are passed through unchanged.
+    """
+
+    # Seconds to wait, after sending a stop, for the interrupted blocking call to return.
+    STOP_TIMEOUT = 5.0
+
+    def __init__(self, mc: MotionController):
+        self._mc = mc
+
+    def __getattr__(self, name):
+        return getattr(self._mc, name)
+
+    async def _stoppable(self, fn, *args):
+        # Runs a blocking motion call; if the awaiting task is cancelled, stops the axis and waits for the call to end.
+        fut = asyncio.ensure_future(_call(fn, *args))
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            log.warn('%s: operation cancelled; stopping.'%(self._mc.short_name()))
+            await _call(self._mc.stop)
+            try:
+                await asyncio.wait_for(asyncio.shield(fut), AsyncMotionController.STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.error('%s: still busy %.1f s after being stopped.'%(self._mc.short_name(), AsyncMotionController.STOP_TIMEOUT))
+            except Exception:
+                pass
+            raise
+
+    async def move_to(self, position: float):
+        """Moves to `position` (real-world units) and returns once the move has completed."""
+        return await self._stoppable(self._mc.move_to, position, True)
+
+    async def home(self):
+        """Homes the axis and returns once it is done."""
+        return await self._stoppable(self._mc.home, True)
+
+    async def wait_settled(self, timeout: float = None) -> bool:
+        """Returns once the axis has settled; False if `timeout` expired first."""
+        return await _call(self._mc.wait_settled, timeout)
+
+    async def get_position(self) -> float:
+        return await _call(self._mc.get_position)
+
+    async def stop(self):
+        await _call(self._mc.stop)
+
+    @staticmethod
+    async def all_stop() -> dict:
+        """Stops every axis on every controller; see MotionController.all_stop()."""
+        return await _call(MotionController.all_stop)
+
+class AsyncDetector:
+    """Awaitable wrapper around a Detector. Attributes not overridden here are passed through unchanged.
+
+    A reading cannot be interrupted; if the awaiting task is cancelled, the reading in progress finishes in the
+    background and is discarded.
+    """
+
+    def __init__(self, detector: Detector):
+        self._det = detector
+
+    def __getattr__(self, name):
+        return getattr(self._det, name)
+
+    async def detect(self) -> float:
+        return await _call(self._det.detect)
+
+    async def measure(self) -> Measurement:
+        return await _call(self._det.measure)
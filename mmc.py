@@ -66,12 +66,16 @@ import signal
 from utilities import version
 from middleware import Detector
 from utilities import log
+from utilities import ttl_cache
 from utilities import motion_controller_list as mcl
 from instruments.mcpherson import McPherson
 from utilities_qt import connect_devices
 from utilities_qt import update_position_displays
 from utilities_qt import scan
+from utilities.checkpoint import Checkpoint
+from utilities.queue_compiler import CompiledQueue, QueueError
 from utilities_qt.datatable import DataTableWidget
+from utilities_qt.heatmap import HeatmapWindow
 from PyQt5.QtWidgets import QGraphicsView
 import webbrowser
 from utilities.config import load_config_devman, save_config_devman, load_config, save_config, reset_config
@@ -97,7 +101,6 @@ import traceback as tb
 import os
 import hashlib
 import faulthandler
-import math
 import typing
 import subprocess
 from typing import Callable
@@ -247,8 +250,18 @@ class MMC_Main(QMainWindow):
 
         self.global_scan_id = 0
         self.scan_start_delay = 0.0
+        # Most times per second a running scan sends new points and progress to the GUI.
+        self.scan_update_rate = 20.0
+        self.fly_scan = False
+        self.adaptive_scan = False
         self.detection_delay = 0.0
         self.per_detection_averages = 1
+        # Relative standard error at which averaging stops early; 0 always takes per_detection_averages samples.
+        self.averaging_target = 0.0
+        # Adaptive settling, which replaces the detection delay when enabled; see Detector.set_settle_mode().
+        self.settle_mode = False
+        self.settle_tolerance = 0.01
+        self.settle_max_wait = 10.0
 
         try:
             self.git_hash = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('ascii').strip()
@@ -274,6 +287,9 @@ class MMC_Main(QMainWindow):
 
         self.queue_executor_thread = scan.QueueExecutor(weakref.proxy(self))
 
+        # Scan and queue progress journal; see offer_resume().
+        self.checkpoint = Checkpoint(os.path.join(appDir, 'checkpoint.jsonl'))
+
         self.autosave_next_scan = False
 
         self.application: QApplication = application
@@ -737,6 +753,8 @@ class MMC_Main(QMainWindow):
         self.operated_ref_data = None
         self.reference_active = False
         self.is_advanced_ref = False
+        # (scan ID, detector index) -> [(x, y), ...] of the running scan, in the order the points were measured.
+        self.scan_arrivals = {}
 
         self.autosave_data_bool = False
         self.pop_out_table = False
@@ -839,6 +857,10 @@ class MMC_Main(QMainWindow):
             QAction, "autosave_data")
         self.UIE_mgw_autosave_dir_qa: QAction = self.findChild(
             QAction, "autosave_dir_prompt")
+        self.UIE_mgw_fly_scan_qa: QAction = self.findChild(
+            QAction, "fly_scan")
+        self.UIE_mgw_adaptive_scan_qa: QAction = self.findChild(
+            QAction, "adaptive_scan")
         self.UIE_mgw_preferences_qa: QAction = self.findChild(
             QAction, "preferences")
         self.UIE_mgw_pop_out_table_qa: QAction = self.findChild(
@@ -1363,6 +1385,8 @@ class MMC_Main(QMainWindow):
             self.autosave_data_toggled)
         self.UIE_mgw_autosave_dir_qa.triggered.connect(
             self.autosave_dir_triggered)
+        self.UIE_mgw_fly_scan_qa.toggled.connect(self.fly_scan_toggled)
+        self.UIE_mgw_adaptive_scan_qa.toggled.connect(self.adaptive_scan_toggled)
 
         self.UIE_mgw_pop_out_table_qa.toggled.connect(
             self.pop_out_table_toggled)
@@ -1380,6 +1404,9 @@ class MMC_Main(QMainWindow):
 
         # Other stuff.
         self.scan = scan.Scan(weakref.proxy(self))
+        self.grid_scan = scan.GridScan(weakref.proxy(self))
+        self.queue_executor_thread.set_scan_obj(self.scan, self.grid_scan)
+        self.heatmap_window = None
 
         log.debug('UpdatePositionDisplays: Thread start() called.')
         self.update_position_displays_thread.start()
@@ -1592,6 +1619,53 @@ class MMC_Main(QMainWindow):
         self.show()
         self.dmw.close()
 
+        self.offer_resume()
+
+    def offer_resume(self):
+        """Offers to resume a scan or queue that was interrupted by a crash, from its checkpoint.
+        """
+        state = Checkpoint.load(self.checkpoint.path)
+        if state is None:
+            return
+
+        if state.queue is not None:
+            msg = 'The scan queue was interrupted at command %d of %d (%s).'%(state.queue_index + 1, len(state.queue), state.queue[state.queue_index])
+        else:
+            msg = 'A %s scan from %g to %g was interrupted.'%(state.scan['ctrl_axis'].lower(), state.scan['start'], state.scan['stop'])
+        if state.scan is not None:
+            msg += ' %d points of the scan had been completed.'%(len(state.points))
+
+        if self.QMessageBoxQuestion('Resume Interrupted Scan', msg + '\n\nResume where it stopped?') != QMessageBox.Yes:
+            self.checkpoint.clear()
+            return
+
+        if state.queue is not None:
+            log.info('Resuming the scan queue at command %d.'%(state.queue_index))
+            self.scan_queue = state.queue
+            self.queue_executor_thread.set_queue(state.queue, state.queue_index, state)
+            self.queue_executor_thread.start()
+            return
+
+        # The scan reads its parameters from the GUI, so put them back first.
+        ctrl_axis = scan.ScanAxis[state.scan['ctrl_axis']]
+        if ctrl_axis == scan.ScanAxis.MAIN:
+            boxes = (self.UIE_mgw_start_qdsb, self.UIE_mgw_stop_qdsb, self.UIE_mgw_step_qdsb)
+        elif ctrl_axis == scan.ScanAxis.SAMPLE:
+            boxes = (self.UIE_mgw_sm_start_set_qdsb, self.UIE_mgw_sm_end_set_qdsb, self.UIE_mgw_sm_step_set_qdsb)
+        else:
+            boxes = (self.UIE_mgw_dm_start_set_qdsb, self.UIE_mgw_dm_end_set_qdsb, self.UIE_mgw_dm_step_set_qdsb)
+        for box, key in zip(boxes, ('start', 'stop', 'step')):
+            box.setValue(state.scan[key])
+        self.UIE_mgw_sm_scan_type_qcb.setCurrentIndex(state.scan['scan_type'])
+        self.UIE_mgw_enabled_detectors_qcb.setCurrentIndex(state.scan['which_detector'])
+
+        log.info('Resuming the interrupted scan.')
+        self.scanRunning = True
+        self.disable_movement_sensitive_buttons(True)
+        self.scan.ctrl_axis = ctrl_axis
+        self.scan.resume = state
+        self.scan.start()
+
     def clear_all_graphs(self):
         self.table_result.plotsClearedCb()
         self.table_result.updatePlots(-1)
@@ -1670,7 +1744,7 @@ class MMC_Main(QMainWindow):
                   self.asamp_axis_dev_name, self.tsamp_axis_dev_name, self.detector_axis_dev_name, len(self.mtn_ctrls), self.fw_max_pos, self.fw_min_pos, self.smr_max_pos, self.smr_min_pos, self.sma_max_pos, self.sma_min_pos, self.smt_max_pos, self.smt_min_pos, self.dr_max_pos, self.dr_min_pos, self.fw_offset, self.st_offset, self.sr_offset, self.sa_offset, self.dr_offset, md_sp, fw_sp, sr_sp, sa_sp, st_sp, dr_sp, list_of_move_mults, list_of_home_mults)
 
         save_config(path, self.mes_sign, self.autosave_data_bool, self.data_save_directory, self.model_index, self.grating_density, self.zero_ofst, self.max_pos, self.min_pos, self.main_axis_index, self.filter_axis_index, self.rsamp_axis_index, self.asamp_axis_index, self.tsamp_axis_index, self.detector_axis_index, self.main_axis_dev_name, self.filter_axis_dev_name, self.rsamp_axis_dev_name,
-                    self.asamp_axis_dev_name, self.tsamp_axis_dev_name, self.detector_axis_dev_name, len(self.mtn_ctrls), self.fw_max_pos, self.fw_min_pos, self.smr_max_pos, self.smr_min_pos, self.sma_max_pos, self.sma_min_pos, self.smt_max_pos, self.smt_min_pos, self.dr_max_pos, self.dr_min_pos, self.fw_offset, self.st_offset, self.sr_offset, self.sa_offset, self.dr_offset, md_sp, fw_sp, sr_sp, sa_sp, st_sp, dr_sp, list_of_move_mults, list_of_home_mults)
+                    self.asamp_axis_dev_name, self.tsamp_axis_dev_name, self.detector_axis_dev_name, len(self.mtn_ctrls), self.fw_max_pos, self.fw_min_pos, self.smr_max_pos, self.smr_min_pos, self.sma_max_pos, self.sma_min_pos, self.smt_max_pos, self.smt_min_pos, self.dr_max_pos, self.dr_min_pos, self.fw_offset, self.st_offset, self.sr_offset, self.sa_offset, self.dr_offset, md_sp, fw_sp, sr_sp, sa_sp, st_sp, dr_sp, list_of_move_mults, list_of_home_mults, scan_update_rate=self.scan_update_rate)
 
     def load_config(self, path: str, is_import: bool):
         # Replaces default grating equation values with the values found in the config.ini file.
@@ -1697,6 +1771,7 @@ class MMC_Main(QMainWindow):
         self.autosave_data_bool = load_dict['autosaveData']
         log.debug('load_dict[autosaveData]:', load_dict['autosaveData'])
         self.data_save_directory = load_dict['dataSaveDirectory']
+        self.scan_update_rate = load_dict['scanUpdateRate']
         self.model_index = load_dict["modelIndex"]
         self.grating_density = load_dict["gratingDensity"]
         self.zero_ofst = load_dict["zeroOffset"]
@@ -1940,8 +2015,26 @@ class MMC_Main(QMainWindow):
                 'Cannot Execute Scan Queue', 'No queue file loaded.')
             return
 
+        # The whole queue is checked, and timed against the devices, before any of it runs. Scans measure with the
+        # detectors selected in the main window.
+        which_detector = self.UIE_mgw_enabled_detectors_qcb.currentIndex()
+        if which_detector == 0:
+            active_detectors = self.detectors
+        else:
+            active_detectors = [self.detectors[which_detector - 1]]
+        try:
+            program = CompiledQueue.compile(self.scan_queue)
+            estimate = program.estimate(self.motion_controllers, active_detectors, start_delay=self.scan_start_delay)
+        except QueueError as e:
+            log.error('Cannot Execute Scan Queue: %s'%(e))
+            self.QMessageBoxCritical('Cannot Execute Scan Queue', 'The queue was not started:\n\n%s'%(e))
+            return
+
+        if self.QMessageBoxQuestion('Execute Scan Queue', '%d commands.\n%s\nStart the queue?'%(len(program), estimate.summary())) != QMessageBox.Yes:
+            return
+
         log.info('Queue Executor Thread starting.')
-        self.queue_executor_thread.set_queue(self.scan_queue)
+        self.queue_executor_thread.set_queue(program.texts)
         self.queue_executor_thread.start()
 
     def collapse_ref(self):
@@ -2582,6 +2675,20 @@ class MMC_Main(QMainWindow):
             log.error('Cannot change autosave data setting while a scan is running.')
             # self.UIE_mgw_autosave_data_qa.setChecked(self.autosave_data_bool)
 
+    def fly_scan_toggled(self, state):
+        if not self.scanRunning:
+            self.fly_scan = state
+        else:
+            log.error('Cannot change fly scan setting while a scan is running.')
+        self.UIE_mgw_fly_scan_qa.setChecked(self.fly_scan)
+
+    def adaptive_scan_toggled(self, state):
+        if not self.scanRunning:
+            self.adaptive_scan = state
+        else:
+            log.error('Cannot change adaptive scan setting while a scan is running.')
+        self.UIE_mgw_adaptive_scan_qa.setChecked(self.adaptive_scan)
+
     def pop_out_table_toggled(self, state):
         self.pop_out_table = state
 
@@ -2673,6 +2780,39 @@ class MMC_Main(QMainWindow):
         self.table_list[det_idx].insertData(
             det_idx, self.global_scan_id, None, None, metadata)
 
+        self.scan_arrivals = {key: points for key, points in self.scan_arrivals.items() if key[0] == self.global_scan_id}
+        self.scan_arrivals[(self.global_scan_id, det_idx)] = []
+
+    def grid_data_begin(self, axis_names: list, axis_values: list, detector_names: list):
+        if self.heatmap_window is not None:
+            self.heatmap_window.close()
+        self.heatmap_window = HeatmapWindow('Grid Scan %d'%(self.num_scans + 1), axis_names, axis_values, detector_names, self)
+        self.heatmap_window.show()
+
+    def grid_data_update(self, det_idx: int, index: tuple, value: float):
+        if self.heatmap_window is not None:
+            self.heatmap_window.update_point(det_idx, index, value)
+
+    def scan_data_chunk(self, which_detector: int, scan_idx: int, det_indices: list, xdata: np.ndarray, ydata: np.ndarray):
+        """ Takes the points a scan measured since its last update; see Scan.SIGNAL_data_chunk.
+
+        Args:
+            which_detector (int): Index of the active detector combo box when the scan began.
+            scan_idx (int): Global scan ID.
+            det_indices (list): Index of each column's detector.
+            xdata (np.ndarray): Positions, one row per point and one column per detector.
+            ydata (np.ndarray): Values, shaped like xdata.
+        """
+        if self.reference_active:
+            # Referencing pairs up the detectors point by point, so the points are taken in the order they were measured.
+            for x_row, y_row in zip(xdata, ydata):
+                for det_idx, x, y in zip(det_indices, x_row, y_row):
+                    self.scan_data_update(which_detector, scan_idx, det_idx, float(x), float(y))
+        else:
+            # One insert, and one table refresh, per detector per chunk.
+            for col, det_idx in enumerate(det_indices):
+                self.table_list[det_idx].insertDataAt(det_idx, scan_idx, xdata[:, col], ydata[:, col])
+
     # This function is called via a signal emission from scan.py.
     # The data is actually stored in datatable.py's recordedData.
     def scan_data_update(self, which_detector: int, scan_idx: int, det_idx: int, xdata: float, ydata: float):
@@ -2688,26 +2828,30 @@ class MMC_Main(QMainWindow):
         self.table_list[det_idx].insertDataAt(det_idx, scan_idx, xdata, ydata)
 
         if self.reference_active:
-            # Get the corresponding self.operated_ref_data element iff the 'x' matches.
-            this_len = len(
-                self.table_list[det_idx].recordedData[(scan_idx, det_idx)]['x'])
-            this_x = self.table_list[det_idx].recordedData[(
-                scan_idx, det_idx)]['x'][this_len - 1]
-            operated_ref_x = self.operated_ref_data['x'][this_len - 1]
+            # Adaptive scans insert points between earlier ones, so the newest point is not necessarily the last one in
+            # the table. Points are matched to the reference data by position, and to each other by arrival order.
+            self.scan_arrivals.setdefault((scan_idx, det_idx), []).append((xdata, ydata))
 
-            if not math.isclose(this_x, operated_ref_x):
+            if self.is_advanced_ref:
+                # Then let's get the points measured so far.
+                samp_points = self.scan_arrivals.get((scan_idx, self.sample_det_idx), [])
+                ref_points = self.scan_arrivals.get((scan_idx, self.ref_det_idx), [])
+                samp_len = len(samp_points)
+                ref_len = len(ref_points)
+                this_x = samp_points[-1][0] if samp_len > 0 else xdata
+            else:
+                this_x = xdata
+
+            # Get the corresponding self.operated_ref_data element iff the 'x' matches.
+            ref_at = np.flatnonzero(np.isclose(self.operated_ref_data['x'], this_x))
+            if len(ref_at) == 0:
                 log.error(
-                    f"Cannot perform referencing because x-values {this_x} and {operated_ref_x} are not close.")
+                    f"Cannot perform referencing because the reference data has no point at x = {this_x}.")
                 return
 
-            operated_ref_y = self.operated_ref_data['y'][this_len - 1]
+            operated_ref_y = self.operated_ref_data['y'][ref_at[0]]
 
             if self.is_advanced_ref:
-                # Then let's get the lengths of the recorded data.
-                samp_len = len(self.table_list[self.sample_det_idx].recordedData[(
-                    scan_idx, self.sample_det_idx)]['x'])
-                ref_len = len(self.table_list[self.ref_det_idx].recordedData[(
-                    scan_idx, self.ref_det_idx)]['x'])
 
                 # ~ Case: Sample First ~
                 #
@@ -2732,10 +2876,8 @@ class MMC_Main(QMainWindow):
 
                 if (samp_len == ref_len) and (samp_len > 0):
                     # Get the latest values from the sample and reference scans.
-                    numerator = self.table_list[self.sample_det_idx].recordedData[(
-                        scan_idx, self.sample_det_idx)]['y'][-1]
-                    denominator = self.table_list[self.ref_det_idx].recordedData[(
-                        scan_idx, self.ref_det_idx)]['y'][-1]
+                    numerator = samp_points[-1][1]
+                    denominator = ref_points[-1][1]
                     # quotient = numerator/denominator
 
                     # result = operated_ref_y * quotient
@@ -2743,7 +2885,7 @@ class MMC_Main(QMainWindow):
                     result = numerator / (denominator * operated_ref_y)
 
                     self.table_result.insertDataAt(
-                        self.sample_det_idx, scan_idx, xdata, result)
+                        self.sample_det_idx, scan_idx, this_x, result)
 
             elif not self.is_advanced_ref:
                 if self.UIE_mgw_setop_qcb.currentIndex() == 0:
@@ -2907,18 +3049,7 @@ class MMC_Main(QMainWindow):
             self.scanRunning = False
             return
 
-        if self.motion_controllers.main_drive_axis is not None:
-            self.motion_controllers.main_drive_axis.stop()
-        if self.motion_controllers.filter_wheel_axis is not None:
-            self.motion_controllers.filter_wheel_axis.stop()
-        if self.motion_controllers.detector_rotation_axis is not None:
-            self.motion_controllers.detector_rotation_axis.stop()
-        if self.motion_controllers.sample_rotation_axis is not None:
-            self.motion_controllers.sample_rotation_axis.stop()
-        if self.motion_controllers.sample_translation_axis is not None:
-            self.motion_controllers.sample_translation_axis.stop()
-        if self.motion_controllers.sample_angle_axis is not None:
-            self.motion_controllers.sample_angle_axis.stop()
+        MotionController.all_stop()
 
     def anim_mgw_mda_load_spinner_start(self, run: bool):
         if run and not self.anim_mgw_mda_load_spinner_running:
@@ -3296,6 +3427,14 @@ class MMC_Main(QMainWindow):
                 QDoubleSpinBox, 'detection_delay')
             self.UIE_mcw_per_detection_averages_qsb: QSpinBox = self.machine_conf_win.findChild(
                 QSpinBox, 'per_detection_averages')
+            self.UIE_mcw_averaging_target_qdsb: QDoubleSpinBox = self.machine_conf_win.findChild(
+                QDoubleSpinBox, 'averaging_target')
+            self.UIE_mcw_settle_mode_qckbx: QCheckBox = self.machine_conf_win.findChild(
+                QCheckBox, 'settle_mode')
+            self.UIE_mcw_settle_tolerance_qdsb: QDoubleSpinBox = self.machine_conf_win.findChild(
+                QDoubleSpinBox, 'settle_tolerance')
+            self.UIE_mcw_settle_max_wait_qdsb: QDoubleSpinBox = self.machine_conf_win.findChild(
+                QDoubleSpinBox, 'settle_max_wait')
 
             self.UIE_mcw_scan_start_delay_qdsb.valueChanged.connect(
                 self.update_scan_start_delay)
@@ -3303,6 +3442,14 @@ class MMC_Main(QMainWindow):
                 self.update_detection_delay)
             self.UIE_mcw_per_detection_averages_qsb.valueChanged.connect(
                 self.update_per_detection_averages)
+            self.UIE_mcw_averaging_target_qdsb.valueChanged.connect(
+                self.update_averaging_target)
+            self.UIE_mcw_settle_mode_qckbx.stateChanged.connect(
+                self.update_settle_mode)
+            self.UIE_mcw_settle_tolerance_qdsb.valueChanged.connect(
+                self.update_settle_mode)
+            self.UIE_mcw_settle_max_wait_qdsb.valueChanged.connect(
+                self.update_settle_mode)
 
             self.UIE_mcw_model_qcb: QComboBox = self.machine_conf_win.findChild(
                 QComboBox, 'models')
@@ -3450,6 +3597,10 @@ class MMC_Main(QMainWindow):
         self.UIE_mcw_detection_delay_qdsb.setValue(self.detection_delay)
         self.UIE_mcw_per_detection_averages_qsb.setValue(
             self.per_detection_averages)
+        self.UIE_mcw_averaging_target_qdsb.setValue(self.averaging_target * 100)
+        self.UIE_mcw_settle_tolerance_qdsb.setValue(self.settle_tolerance * 100)
+        self.UIE_mcw_settle_max_wait_qdsb.setValue(self.settle_max_wait)
+        self.UIE_mcw_settle_mode_qckbx.setChecked(self.settle_mode)
 
         self.UIE_mcw_model_qcb.setCurrentIndex(self.model_index)
 
@@ -3565,6 +3716,19 @@ class MMC_Main(QMainWindow):
             if det is not None:
                 det.detect_delay = self.detection_delay
 
+    def update_settle_mode(self):
+        self.settle_mode = self.UIE_mcw_settle_mode_qckbx.isChecked()
+        self.settle_tolerance = self.UIE_mcw_settle_tolerance_qdsb.value() / 100
+        self.settle_max_wait = self.UIE_mcw_settle_max_wait_qdsb.value()
+        log.info("Adaptive settling %s: tolerance %g, time limit %g s." %
+                 ('enabled' if self.settle_mode else 'disabled', self.settle_tolerance, self.settle_max_wait))
+        for det in self.detectors:
+            if det is not None:
+                try:
+                    det.set_settle_mode(self.settle_mode, tolerance=self.settle_tolerance, max_wait=self.settle_max_wait)
+                except ValueError as e:
+                    log.error('Could not set the settling mode of %s: %s' % (det.short_name(), e))
+
     def update_scan_start_delay(self):
         log.info("Scan start delay changed to: %s ms" %
                  (self.UIE_mcw_scan_start_delay_qdsb.value()))
@@ -3574,9 +3738,23 @@ class MMC_Main(QMainWindow):
         log.info("Per detection averages changed to: %s" %
                  (self.UIE_mcw_per_detection_averages_qsb.value()))
         self.per_detection_averages = self.UIE_mcw_per_detection_averages_qsb.value()
+        self.apply_detection_averaging()
+
+    def update_averaging_target(self):
+        log.info("Averaging target changed to: %s %% SEM" %
+                 (self.UIE_mcw_averaging_target_qdsb.value()))
+        self.averaging_target = self.UIE_mcw_averaging_target_qdsb.value() / 100
+        self.apply_detection_averaging()
+
+    def apply_detection_averaging(self):
+        # With a target set, the per-detection averages become the most samples a point may take.
         for det in self.detectors:
             if det is not None:
                 det.per_detection_averages = self.per_detection_averages
+                if self.averaging_target > 0:
+                    det.set_averaging_target(rel_sem=self.averaging_target, max_samples=self.per_detection_averages)
+                else:
+                    det.set_averaging_target()
 
     def reference_operation_changed(self):
         self.reference_operation = self.UIE_mcw_operation_qcb.currentIndex()
@@ -4291,6 +4469,9 @@ if __name__ == '__main__':
 
             # Cleanup.
             del mainWindow
+            ttl_cache.report()
+            # A reboot rediscovers devices from scratch.
+            ttl_cache.invalidate_all()
 
     except Exception as e:
         log.error('A GLOBAL EXCEPTION HAS BEEN DETECTED:')
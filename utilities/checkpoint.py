@@ -0,0 +1,183 @@
+#
+# @file checkpoint.py
+# @author Mit Bailey (mitbailey@outlook.com)
+# @brief On-disk journal of scan and queue progress, so that an interrupted run can be resumed.
+# @version See Git tags for version information.
+# @date 2026.10.19
+#
+# @copyright Copyright (c) 2022
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+
+# The journal is a JSON-lines file, appended to and fsync'd one record at a time so that whatever was written before a
+# crash survives it. Records:
+#
+#   {"type": "queue", "queue": [...]}         A queue started.
+#   {"type": "queue_index", "index": i}       Command i of the queue is starting.
+#   {"type": "scan", "params": {...}}         A scan started; params describe it well enough to restart it.
+#   {"type": "point", "value": v, ...}        A scan point was measured and written to the data files. For grid
+#                                             scans, v is the point's grid index.
+#   {"type": "scan_end"}                      The scan ran to completion or was stopped by the user.
+#
+# The file is deleted once there is nothing left to resume.
+
+import os
+import json
+import threading
+from collections import namedtuple
+from utilities import log
+
+# What load() found. `queue` is None if no queue was running; `scan` is None if no scan was left unfinished. `points`
+# are the "point" records of the unfinished scan, in the order they were measured.
+ResumeState = namedtuple('ResumeState', ['queue', 'queue_index', 'scan', 'points'])
+
+class Checkpoint:
+    """ Writes the progress journal; see the format notes at the top of this file. Thread-safe.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._in_queue = False
+
+    def begin_queue(self, queue: list):
+        """ Starts a new journal for `queue`. When resuming, the caller re-records the progress it is resuming from. """
+        with self._lock:
+            self._in_queue = True
+            self._truncate()
+            self._append({'type': 'queue', 'queue': list(queue)})
+
+    def queue_index(self, index: int):
+        with self._lock:
+            self._append({'type': 'queue_index', 'index': index})
+
+    def end_queue(self):
+        with self._lock:
+            self._in_queue = False
+            self._remove()
+
+    def suspend_queue(self):
+        """ Stops treating scans as part of the queue, but keeps its journal so that it can still be resumed. Scans
+        started afterwards replace the journal. """
+        with self._lock:
+            self._in_queue = False
+
+    def begin_scan(self, params: dict):
+        """ Records a scan starting. Outside a queue this starts a new journal. """
+        with self._lock:
+            if not self._in_queue:
+                self._truncate()
+            self._append({'type': 'scan', 'params': params})
+
+    def point(self, value, positions: list, rows: list):
+        """ Records a completed point. Call once its data has reached the data files.
+
+        Args:
+            value (float | tuple): The planned scan position, or a grid scan point's index.
+            positions (list): Axis positions read back at the point.
+            rows (list): Per active detector, the values recorded for the point.
+        """
+        with self._lock:
+            value = [int(i) for i in value] if isinstance(value, tuple) else float(value)
+            self._append({'type': 'point', 'value': value, 'positions': [None if p is None else float(p) for p in positions], 'rows': [[float(v) for v in row] for row in rows]})
+
+    def end_scan(self):
+        with self._lock:
+            if self._in_queue:
+                self._append({'type': 'scan_end'})
+            else:
+                self._remove()
+
+    def clear(self):
+        """ Discards the journal, e.g. when the user declines to resume. """
+        with self._lock:
+            self._in_queue = False
+            self._remove()
+
+    # Called with the lock held.
+    def _append(self, record: dict):
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            log.warn('Could not write scan checkpoint %s:'%(self.path), e)
+
+    # Called with the lock held.
+    def _truncate(self):
+        self._remove()
+        try:
+            self._file = open(self.path, 'w')
+        except OSError as e:
+            log.warn('Could not create scan checkpoint %s:'%(self.path), e)
+
+    # Called with the lock held.
+    def _remove(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warn('Could not remove scan checkpoint %s:'%(self.path), e)
+
+    @staticmethod
+    def load(path: str) -> ResumeState:
+        """ Reads a journal left behind by an interrupted run.
+
+        A truncated last line, from a crash mid-write, is ignored.
+
+        Returns:
+            ResumeState: What can be resumed, or None if there is nothing to resume.
+        """
+        try:
+            with open(path, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            log.warn('Could not read scan checkpoint %s:'%(path), e)
+            return None
+
+        queue, queue_index, scan, points = None, 0, None, []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                log.warn('Ignoring a damaged scan checkpoint record.')
+                continue
+
+            kind = record.get('type')
+            if kind == 'queue':
+                queue = record['queue']
+            elif kind == 'queue_index':
+                queue_index = record['index']
+                scan, points = None, []
+            elif kind == 'scan':
+                scan, points = record['params'], []
+            elif kind == 'point':
+                points.append(record)
+            elif kind == 'scan_end':
+                scan, points = None, []
+
+        if queue is None and scan is None:
+            return None
+        return ResumeState(queue, queue_index, scan, points)
@@ -151,7 +151,7 @@ def reset_config(path: str):
         log.error('For some reason the log file failed to be created.')
 
 # TODO: Change this to taking a dictionary or something, this many arguments is ridiculous.
-def save_config(path: str, mes_sign: int = 1, autosave_data: bool = True, data_save_directory: str = './data/', model_index: int = 0, current_grating_density: float = 1200.0, zero_ofst: float = 1, max_pos: float = 600.0, min_pos: float = -40.0, main_axis_index: int = 1, filter_axis_index: int = 0, rsamp_axis_index: int = 0, asamp_axis_index: int = 0, tsamp_axis_index: int = 0, detector_axis_index: int = 0, main_axis_dev_name: str = 'Loaded Config Name Empty', filter_axis_dev_name: str = 'Loaded Config Name Empty', rsamp_axis_dev_name: str = 'Loaded Config Name Empty', asamp_axis_dev_name: str = 'Loaded Config Name Empty', tsamp_axis_dev_name: str = 'Loaded Config Name Empty', detector_axis_dev_name: str = 'Loaded Config Name Empty', num_axes: int = 0, fw_max_pos: float = 9999.0, fw_min_pos: float = -9999.0, smr_max_pos: float = 9999.0, smr_min_pos: float = -9999.0, sma_max_pos: float = 9999.0, sma_min_pos: float = -9999.0, smt_max_pos: float = 9999.0, smt_min_pos: float = -9999.0, dr_max_pos: float = 9999.0, dr_min_pos: float = -9999.0, fw_offset: float = 0.0, st_offset: float = 0.0, sr_offset: float = 0.0, sa_offset: float = 0.0, dr_offset: float = 0.0, md_sp: float = 0.0, fw_sp: float = 0.0, sr_sp: float = 0.0, sa_sp: float = 0.0, st_sp: float = 0.0, dr_sp: float = 0.0, list_of_move_mults: list = [], list_of_home_mults: list = []) -> bool:
+def save_config(path: str, mes_sign: int = 1, autosave_data: bool = True, data_save_directory: str = './data/', model_index: int = 0, current_grating_density: float = 1200.0, zero_ofst: float = 1, max_pos: float = 600.0, min_pos: float = -40.0, main_axis_index: int = 1, filter_axis_index: int = 0, rsamp_axis_index: int = 0, asamp_axis_index: int = 0, tsamp_axis_index: int = 0, detector_axis_index: int = 0, main_axis_dev_name: str = 'Loaded Config Name Empty', filter_axis_dev_name: str = 'Loaded Config Name Empty', rsamp_axis_dev_name: str = 'Loaded Config Name Empty', asamp_axis_dev_name: str = 'Loaded Config Name Empty', tsamp_axis_dev_name: str = 'Loaded Config Name Empty', detector_axis_dev_name: str = 'Loaded Config Name Empty', num_axes: int = 0, fw_max_pos: float = 9999.0, fw_min_pos: float = -9999.0, smr_max_pos: float = 9999.0, smr_min_pos: float = -9999.0, sma_max_pos: float = 9999.0, sma_min_pos: float = -9999.0, smt_max_pos: float = 9999.0, smt_min_pos: float = -9999.0, dr_max_pos: float = 9999.0, dr_min_pos: float = -9999.0, fw_offset: float = 0.0, st_offset: float = 0.0, sr_offset: float = 0.0, sa_offset: float = 0.0, dr_offset: float = 0.0, md_sp: float = 0.0, fw_sp: float = 0.0, sr_sp: float = 0.0, sa_sp: float = 0.0, st_sp: float = 0.0, dr_sp: float = 0.0, list_of_move_mults: list = [], list_of_home_mults: list = [], scan_update_rate: float = 20.0) -> bool:
 
     log.debug(path, mes_sign, autosave_data, data_save_directory, model_index, current_grating_density, zero_ofst, max_pos, min_pos, main_axis_index, filter_axis_index, rsamp_axis_index, asamp_axis_index, tsamp_axis_index, detector_axis_index, main_axis_dev_name, filter_axis_dev_name, rsamp_axis_dev_name, asamp_axis_dev_name, tsamp_axis_dev_name, detector_axis_dev_name, num_axes, fw_max_pos, fw_min_pos, smr_max_pos, smr_min_pos, sma_max_pos, sma_min_pos, smt_max_pos, smt_min_pos, dr_max_pos, dr_min_pos, fw_offset, st_offset, sr_offset, sa_offset, dr_offset, md_sp, fw_sp, sr_sp, sa_sp, st_sp, dr_sp)
     
@@ -165,7 +165,8 @@ def save_config(path: str, mes_sign: int = 1, autosave_data: bool = True, data_s
         
     save_config['INTERFACE'] = {'measurementSign': mes_sign, 
                                 'autosaveData': autosave_data_str,
-                                'dataSaveDirectory': data_save_directory}
+                                'dataSaveDirectory': data_save_directory,
+                                'scanUpdateRate': str(scan_update_rate)}
     save_config['INSTRUMENT'] = {'modelIndex': model_index,
                                  'gratingDensity': str(current_grating_density),
                                  'zeroOffset': str(zero_ofst), 
@@ -288,6 +289,16 @@ def load_config(path: str, is_import: bool) -> dict:
                 data_save_directory = config['INTERFACE']['dataSaveDirectory']
             except Exception as e:
                 log.error('Invalid directory, %s'%(e))
+
+            # Absent from configurations saved by older versions.
+            scan_update_rate = 20.0
+            try:
+                scan_update_rate = config['INTERFACE'].getfloat('scanUpdateRate', fallback=20.0)
+            except Exception as e:
+                log.error('Invalid scan update rate, %s'%(e))
+            if scan_update_rate <= 0:
+                log.error('Invalid scan update rate %f'%(scan_update_rate))
+                scan_update_rate = 20.0
             
             main_axis_index = int(config['CONNECTIONS']['mainAxisIndex'])
             filter_axis_index = int(config['CONNECTIONS']['filterAxisIndex'])
@@ -339,6 +350,7 @@ def load_config(path: str, is_import: bool) -> dict:
         "measurementSign": mes_sign,
         "autosaveData": autosave_data,
         "dataSaveDirectory": data_save_directory,
+        "scanUpdateRate": scan_update_rate,
         "modelIndex": model_index,
         "gratingDensity": current_grating_density,
         "zeroOffset": zero_ofst,
@@ -0,0 +1,211 @@
+#
+# @file port_watcher.py
+# @author Mit Bailey (mitbailey@outlook.com)
+# @brief Event-driven serial port discovery and a persistent cache of what is attached to each port.
+# @version See Git tags for version information.
+# @date 2026.10.19
+#
+# @copyright Copyright (c) 2022
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+
+import os
+import sys
+import time
+import select
+import ctypes
+import threading
+import configparser as confp
+from utilities import log
+from utilities import ports_finder
+
+PORT_ADDED = 'added'
+PORT_REMOVED = 'removed'
+PORT_CHANGED = 'changed'
+
+class _DevNotify:
+    """ inotify watch on /dev; lets PortWatcher sleep until a device node is created or removed. Linux only.
+    """
+    IN_ATTRIB = 0x004
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    # udev creates the node before it has finished setting it up; wait this long for the burst of events to end.
+    DEBOUNCE = 0.2
+
+    def __init__(self, path: str = '/dev'):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self._fd, path.encode(), _DevNotify.IN_CREATE | _DevNotify.IN_DELETE | _DevNotify.IN_ATTRIB) < 0:
+            os.close(self._fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on %s'%(path))
+
+    def wait(self, timeout: float)->bool:
+        """ Blocks until something under /dev changes or `timeout` expires. Returns True if something changed. """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        time.sleep(_DevNotify.DEBOUNCE)
+        self._drain()
+        return True
+
+    def _drain(self):
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._fd)
+
+class PortWatcher:
+    """ Reports serial ports appearing, disappearing or changing hardware, without opening any of them.
+
+    Diffs the OS port enumeration (see ports_finder.list_serial_hwids()). On Linux the diff is triggered by inotify on
+    /dev, with a slow poll as a backstop (virtual ports never touch /dev); elsewhere it is polled. `callback(event, port,
+    hwid)` is called from the watcher thread with event PORT_ADDED, PORT_REMOVED or PORT_CHANGED. Every port present
+    at start-up is reported as added.
+    """
+    POLL_PERIOD = 2.0
+    INOTIFY_POLL_PERIOD = 10.0
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._ports = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.done = False
+
+        self._notify = None
+        if sys.platform.startswith('linux'):
+            try:
+                self._notify = _DevNotify('/dev')
+            except Exception as e:
+                log.warn('inotify unavailable, polling for serial ports instead:', e)
+
+        self.watch_tid = threading.Thread(target=self._watch_thread, daemon=True)
+        self.watch_tid.start()
+
+    def stop(self):
+        self.done = True
+        self._wake.set()
+        self.watch_tid.join()
+        if self._notify is not None:
+            self._notify.close()
+
+    def ports(self)->dict:
+        """ Returns the ports currently present, mapped to their hardware IDs. """
+        with self._lock:
+            return dict(self._ports)
+
+    def rescan(self):
+        """ Requests an immediate rescan, e.g. after registering a virtual port. """
+        self._wake.set()
+
+    def _watch_thread(self):
+        while not self.done:
+            self._wake.clear()
+            try:
+                self._diff()
+            except Exception as e:
+                log.error('Serial port enumeration failed:', e)
+
+            if self._notify is not None:
+                # Short select()s so that rescan() and stop() are still honoured promptly.
+                deadline = time.monotonic() + PortWatcher.INOTIFY_POLL_PERIOD
+                while not self.done and not self._wake.is_set() and time.monotonic() < deadline:
+                    if self._notify.wait(0.25):
+                        break
+            else:
+                self._wake.wait(PortWatcher.POLL_PERIOD)
+
+    def _diff(self):
+        current = ports_finder.list_serial_hwids()
+
+        with self._lock:
+            previous = self._ports
+            self._ports = current
+
+        events = []
+        for port, hwid in current.items():
+            if port not in previous:
+                events.append((PORT_ADDED, port, hwid))
+            elif previous[port] != hwid:
+                events.append((PORT_CHANGED, port, hwid))
+        for port, hwid in previous.items():
+            if port not in current:
+                events.append((PORT_REMOVED, port, hwid))
+
+        for event in events:
+            log.debug('Serial port %s: %s (%s)'%(event[0], event[1], event[2]))
+            try:
+                self._callback(*event)
+            except Exception as e:
+                log.error('Port event handler failed:', e)
+
+class IdentityCache:
+    """ Remembers, across runs, which instrument answered on a given port and hardware ID.
+
+    Stored as an INI file with one section per (port, hwid) pair. Virtual ports are never stored.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ini = confp.ConfigParser(interpolation=None)
+        try:
+            self._ini.read(path)
+        except confp.Error as e:
+            log.warn('Discarding unreadable identity cache %s:'%(path), e)
+            self._ini = confp.ConfigParser(interpolation=None)
+
+    @staticmethod
+    def _key(port: str, hwid: str)->str:
+        return '%s %s'%(port, hwid)
+
+    def get(self, port: str, hwid: str):
+        """ Returns the cached label for `port`, or None if it has not been seen with this hwid. """
+        with self._lock:
+            key = IdentityCache._key(port, hwid)
+            if self._ini.has_section(key):
+                return self._ini[key].get('label')
+            return None
+
+    def put(self, port: str, hwid: str, label: str):
+        if hwid == 'VIRTUAL':
+            return
+        with self._lock:
+            self._ini[IdentityCache._key(port, hwid)] = {'label': label}
+            self._save()
+
+    def forget(self, port: str, hwid: str = None):
+        """ Drops `port` with the given hwid, or with any hwid if `hwid` is None. """
+        with self._lock:
+            for key in self._ini.sections():
+                if key == IdentityCache._key(port, hwid) or (hwid is None and key.startswith(port + ' ')):
+                    self._ini.remove_section(key)
+            self._save()
+
+    # Called with the lock held.
+    def _save(self):
+        try:
+            with open(self.path, 'w') as f:
+                self._ini.write(f)
+        except OSError as e:
+            log.warn('Could not save identity cache %s:'%(self.path), e)
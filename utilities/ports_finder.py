@@ -27,11 +27,8 @@ import glob
 import serial
 from drivers import tl_kst101 as tlkt
 import serial.tools.list_ports
-
-from time import perf_counter_ns
-
-APT_START = None
-APT_DEVICELIST = []
+from utilities import safe_serial
+from utilities.ttl_cache import cached
 
 # Unknown if this works on Linux.
 def find_com_ports():
@@ -50,6 +47,12 @@ def find_serial_ports():
         :returns:
             A list of the serial ports available on the system
     """
+    # Simulated devices are always available.
+    return _find_os_serial_ports() + list(safe_serial.virtual_ports.keys())
+
+# Opening every candidate port is slow, and every driver calls find_serial_ports() while connecting.
+@cached(name='serial ports', ttl=2.0, maxsize=1)
+def _find_os_serial_ports():
     if sys.platform.startswith('win'):
         ports = ['COM%s' % (i + 1) for i in range(256)]
     elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
@@ -67,8 +70,20 @@ def find_serial_ports():
             result.append(port)
         except (OSError, serial.SerialException):
             pass
+
     return result
 
+def list_serial_hwids()->dict:
+    """ Enumerates serial ports from the OS without opening them.
+
+    Returns:
+        dict: Port name to hardware ID (e.g. 'USB VID:PID=06CD:0121 SER=... LOCATION=...'). Virtual ports map to 'VIRTUAL'.
+    """
+    hwids = {p.device: p.hwid for p in serial.tools.list_ports.comports()}
+    for port in safe_serial.virtual_ports.keys():
+        hwids[port] = 'VIRTUAL'
+    return hwids
+
 """
 struct TLI_DeviceInfo
 {
@@ -85,26 +100,22 @@ struct TLI_DeviceInfo
     short maxChannels;
 };
 """
+@cached(name='APT ports', ttl=0.25, maxsize=1)
 def find_apt_ports():
-    global APT_START, APT_DEVICELIST
-    if APT_START is None:
-        APT_START = perf_counter_ns()
-    else:
-        now = perf_counter_ns()
-        print("Time since last APT port search: %d ns %f ms"%(now - APT_START, (now - APT_START) * 1e-6))
-        if (now - APT_START)*1e-9 < 0.25:
-            return APT_DEVICELIST
-        APT_START = now
-
     serials = tlkt.ThorlabsKST101.list_devices()
 
     devices = []
     for dev in serials:
         info = tlkt.ThorlabsKST101.get_device_info(dev)
         devices.append(f'{info["serial_no"]} {info["model_no"]} {info["fw_ver"]}')
-    APT_DEVICELIST = devices
     return devices
 
+def invalidate_caches():
+    """ Forgets cached port lists. Call when ports are known to have come or gone.
+    """
+    _find_os_serial_ports.cache.invalidate()
+    find_apt_ports.cache.invalidate()
+
 def generate_virtual_ports(num):
     virt_dev_list = []
     for i in range(num):
@@ -0,0 +1,375 @@
+#
+# @file queue_compiler.py
+# @author Mit Bailey (mitbailey@outlook.com)
+# @brief Parses and validates whole queue files, expands their loops and estimates how long they will take.
+# @version See Git tags for version information.
+# @date 2026.10.19
+#
+# @copyright Copyright (c) 2022
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+
+# On top of the commands QueueExecutor runs, queue files may contain blocks, which may be nested:
+#
+#   REPEAT <count>                      Runs the enclosed lines <count> times.
+#   ...
+#   END
+#
+#   SWEEP <name> <start> <stop> <step>  Runs the enclosed lines once per value, with $<name> replaced by the value.
+#   ...
+#   END
+#
+# CompiledQueue.compile() expands these into plain commands, so the executor never sees them.
+
+import re
+from collections import namedtuple
+
+from utilities import log
+from utilities.scan_plan import ScanPlan, ScanPlanError, GridPlan
+from utilities.scan_engine import prep_position
+
+# Queue and grid scan axis codes, mapped to the MotionControllerList attribute holding the axis.
+AXIS_CODES = {'MDA': 'main_drive_axis', 'SRA': 'sample_rotation_axis', 'SAA': 'sample_angle_axis', 'STA': 'sample_translation_axis', 'DRA': 'detector_rotation_axis'}
+
+# Axes RUN can scan.
+RUN_AXES = ('MDA', 'SRA', 'STA', 'DRA')
+
+# Everything a queue command can hold. A scan measures with every axis where the queue put it, so it holds them all, as
+# does WAIT, which is a barrier.
+QUEUE_RESOURCES = frozenset(AXIS_CODES.keys()) | {'DETECTORS', 'SCAN'}
+
+# One command to run. `line` is its 1-based line in the queue file and `source` that line as written, before loops and
+# sweep variables were expanded; `text` is the command itself.
+QueueCommand = namedtuple('QueueCommand', ['line', 'source', 'text', 'args'])
+
+# One queue command, with what it uses. Commands whose resources overlap run in queue order; the others may run at the
+# same time. `after` holds the indices of the commands that must finish first.
+QueueTask = namedtuple('QueueTask', ['index', 'cmd', 'args', 'resources', 'after'])
+
+# Estimated time of one queue file line: `count` commands were expanded from it, taking `duration` seconds in all.
+LineEstimate = namedtuple('LineEstimate', ['line', 'source', 'count', 'duration'])
+
+class QueueError(Exception):
+    """ Raised by CompiledQueue with every problem found, one per line. """
+    def __init__(self, problems: list):
+        self.problems = problems
+        super().__init__('\n'.join(problems))
+
+def command_resources(args: list) -> frozenset:
+    """ Returns what a queue command holds while it runs; see QUEUE_RESOURCES. """
+    if args[0] == 'MOVE' and len(args) > 1 and args[1] in AXIS_CODES:
+        return frozenset([args[1]])
+    elif args[0] == 'SAVENEXT':
+        # Applies to the next scan, so it stays between the scans around it.
+        return frozenset(['SCAN'])
+    # RUN, GRID and WAIT, and unknown commands, which fail in order when they are reached.
+    return QUEUE_RESOURCES
+
+def build_graph(queue: list, start: int = 0) -> list:
+    """Turns queue lines into QueueTasks, skipping comments, blank lines and the lines before `start`.
+
+    Each task comes after the latest earlier task holding each of its resources; that is enough, since those tasks come
+    after anything earlier that they conflict with.
+    """
+    tasks = []
+    last = {}
+    for idx, cmd in enumerate(queue):
+        if idx < start or cmd.startswith('#') or cmd == '':
+            continue
+        args = cmd.split(' ')
+        resources = command_resources(args)
+        after = frozenset(last[r] for r in resources if r in last)
+        tasks.append(QueueTask(idx, cmd, args, resources, after))
+        for r in resources:
+            last[r] = idx
+    return tasks
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '%dh %02dm %02ds'%(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    elif seconds >= 60:
+        return '%dm %02ds'%(seconds // 60, seconds % 60)
+    return '%ds'%(seconds)
+
+class QueueEstimate:
+    """ What CompiledQueue.estimate() found: per-command and per-line times, and the total. """
+
+    def __init__(self, durations: list, lines: list, total: float):
+        self.durations = durations
+        self.lines = lines
+        self.total = total
+
+    def summary(self) -> str:
+        """ The estimate as text for the user: the total, then every line that takes time. """
+        text = 'Estimated time: %s.\n'%(format_duration(self.total))
+        serial = sum(self.durations)
+        if serial - self.total >= 1:
+            text += '(%s saved by moving independent axes together.)\n'%(format_duration(serial - self.total))
+        text += '\n'
+        for est in self.lines:
+            if est.duration <= 0:
+                continue
+            count = ' (x%d)'%(est.count) if est.count > 1 else ''
+            text += 'Line %d%s: %s - %s\n'%(est.line, count, est.source, format_duration(est.duration))
+        return text
+
+class CompiledQueue:
+    """ A queue file parsed, validated and expanded before anything runs.
+
+    Build one with CompiledQueue.compile(); `texts` are the commands for QueueExecutor.
+    """
+
+    def __init__(self, commands: list):
+        self.commands = commands
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    @property
+    def texts(self) -> list:
+        return [cmd.text for cmd in self.commands]
+
+    @staticmethod
+    def compile(lines: list):
+        """ Parses a whole queue file, expanding REPEAT and SWEEP blocks and checking every command's syntax.
+
+        Args:
+            lines (list): The queue file's lines.
+
+        Raises:
+            QueueError: With every problem found, each prefixed by its line number. Nothing has run.
+
+        Returns:
+            CompiledQueue: The expanded queue.
+        """
+        problems = []
+        lines = [line.strip() for line in lines]
+        program, end = [], -1
+        while True:
+            block, end = CompiledQueue._parse_block(lines, end + 1, problems)
+            program += block
+            if end >= len(lines):
+                break
+            problems.append('Line %d: END without a matching REPEAT or SWEEP.'%(end + 1))
+
+        commands = []
+        CompiledQueue._expand(program, {}, commands, problems)
+        if problems:
+            raise QueueError(problems)
+        return CompiledQueue(commands)
+
+    @staticmethod
+    def _parse_block(lines: list, idx: int, problems: list) -> tuple:
+        # Parses from lines[idx] up to a closing END or the end of the file. Returns the block, as (line index, args)
+        # for commands and (line index, args, body) for nested blocks, and the index of the END or len(lines).
+        block = []
+        while idx < len(lines):
+            line = lines[idx]
+            if line == '' or line.startswith('#'):
+                idx += 1
+                continue
+            args = line.split()
+            if args[0] == 'END':
+                return block, idx
+            elif args[0] in ('REPEAT', 'SWEEP'):
+                body, end = CompiledQueue._parse_block(lines, idx + 1, problems)
+                if end >= len(lines):
+                    problems.append('Line %d: %s without a matching END.'%(idx + 1, args[0]))
+                block.append((idx, args, body))
+                idx = end + 1
+            else:
+                block.append((idx, line.split(' ')))
+                idx += 1
+        return block, idx
+
+    @staticmethod
+    def _expand(block: list, variables: dict, commands: list, problems: list):
+        for item in block:
+            idx, args = item[0], item[1]
+            if len(item) == 3:
+                for values in CompiledQueue._loop_values(idx, args, variables, problems):
+                    CompiledQueue._expand(item[2], {**variables, **values}, commands, problems)
+                continue
+
+            text = CompiledQueue._substitute(idx, ' '.join(args), variables, problems)
+            if text is None:
+                continue
+            cmd = QueueCommand(idx + 1, ' '.join(args), text, text.split(' '))
+            error = CompiledQueue._check_command(cmd.args)
+            if error is not None:
+                problems.append('Line %d: %s'%(cmd.line, error))
+                continue
+            commands.append(cmd)
+
+    @staticmethod
+    def _loop_values(idx: int, args: list, variables: dict, problems: list) -> list:
+        # The variable bindings of each pass through a REPEAT or SWEEP block. A bad block is reported and runs no passes.
+        args = CompiledQueue._substitute(idx, ' '.join(args), variables, problems)
+        if args is None:
+            return []
+        args = args.split()
+        try:
+            if args[0] == 'REPEAT':
+                if len(args) != 2 or int(args[1]) < 1:
+                    raise ValueError('expected REPEAT <count>, with a count of at least 1.')
+                return [{}] * int(args[1])
+            if len(args) != 5 or not re.fullmatch(r'[A-Za-z_]\w*', args[1]):
+                raise ValueError('expected SWEEP <name> <start> <stop> <step>.')
+            values = ScanPlan.scan_values(float(args[2]), float(args[3]), float(args[4]))
+            return [{args[1]: value} for value in values]
+        except ValueError as e:
+            problems.append('Line %d: %s'%(idx + 1, e))
+            return []
+
+    @staticmethod
+    def _substitute(idx: int, text: str, variables: dict, problems: list) -> str:
+        # Replaces $name with the value of the sweep variable `name`.
+        undefined = [name for name in re.findall(r'\$(\w+)', text) if name not in variables]
+        if undefined:
+            problems.append('Line %d: undefined variable $%s.'%(idx + 1, undefined[0]))
+            return None
+        return re.sub(r'\$(\w+)', lambda m: '%.15g'%(variables[m.group(1)]), text)
+
+    @staticmethod
+    def _check_command(args: list) -> str:
+        # Returns what is wrong with a plain command, or None.
+        def numbers(values):
+            try:
+                return [float(v) for v in values]
+            except ValueError as e:
+                raise ValueError('%s is not a number.'%(str(e).split(': ')[-1]))
+
+        try:
+            if args[0] == 'RUN':
+                if len(args) != 5:
+                    return 'expected RUN <axis> <start> <stop> <step>.'
+                if args[1] not in RUN_AXES:
+                    return 'cannot scan axis %s; expected one of %s.'%(args[1], ', '.join(RUN_AXES))
+                if numbers(args[2:])[2] == 0:
+                    return 'step size must be non-zero.'
+            elif args[0] == 'MOVE':
+                if len(args) != 3:
+                    return 'expected MOVE <axis> <position>.'
+                if args[1] not in AXIS_CODES:
+                    return 'unknown axis %s; expected one of %s.'%(args[1], ', '.join(AXIS_CODES))
+                numbers(args[2:])
+            elif args[0] == 'GRID':
+                if (len(args) - 1) % 4 != 0 or len(args) < 9:
+                    return 'expected GRID <axis> <start> <stop> <step> for at least two axes.'
+                for i in range(1, len(args), 4):
+                    if args[i] not in AXIS_CODES:
+                        return 'unknown axis %s; expected one of %s.'%(args[i], ', '.join(AXIS_CODES))
+                    if args[i] in args[1:i:4]:
+                        return 'axis %s is listed more than once.'%(args[i])
+                    if numbers(args[i + 1:i + 4])[2] == 0:
+                        return 'step size must be non-zero.'
+            elif args[0] == 'WAIT':
+                if len(args) != 2:
+                    return 'expected WAIT <seconds>.'
+                if numbers(args[1:])[0] < 0:
+                    return 'cannot wait a negative time.'
+            elif args[0] == 'SAVENEXT':
+                if len(args) < 2 or args[1] == '':
+                    return 'expected SAVENEXT <directory>.'
+            else:
+                return 'unknown command %s.'%(args[0])
+        except ValueError as e:
+            return str(e)
+        return None
+
+    def estimate(self, motion_controllers, detectors: list, hold: float = 1.0, start_delay: float = 0.0) -> QueueEstimate:
+        """ Dry-runs the queue against the devices' timing models, checking every move and scan against their axes.
+
+        Axis positions are tracked from where each axis is now through every command, so that each move is timed from
+        where the queue will have left it. Commands that QueueExecutor runs concurrently overlap in the total.
+
+        Args:
+            motion_controllers (MotionControllerList): The connected axes.
+            detectors (list): The detectors scans will read.
+            hold (float, optional): Settling time after each scan's preparatory move; see ScanEngine. Defaults to 1.
+            start_delay (float, optional): The scan start delay. Defaults to 0.
+
+        Raises:
+            QueueError: If a command uses an axis that is not connected, or moves or scans out of its limits.
+
+        Returns:
+            QueueEstimate: The estimate.
+        """
+        problems = []
+        position = {}
+
+        def axis(code):
+            mc = getattr(motion_controllers, AXIS_CODES[code], None)
+            if mc is None:
+                raise ValueError('axis %s is not connected.'%(code))
+            if code not in position:
+                position[code] = mc.to_steps(mc.get_position())
+            return mc
+
+        durations = []
+        for cmd in self.commands:
+            args = cmd.args
+            duration = 0.0
+            try:
+                if args[0] == 'MOVE':
+                    mc = axis(args[1])
+                    error = mc.check_target(float(args[2]))
+                    if error is not None:
+                        raise ValueError(error)
+                    target = mc.to_steps(float(args[2]))
+                    duration = mc.estimate_move_time(position[args[1]], target)
+                    position[args[1]] = target
+                elif args[0] == 'RUN':
+                    mc = axis(args[1])
+                    start, stop, step = float(args[2]), float(args[3]), float(args[4])
+                    prep = prep_position(mc, start)
+                    plan = ScanPlan.compile(start, stop, step, [(mc, 1)], detectors, prep)
+                    duration = mc.estimate_move_time(position[args[1]], mc.to_steps(prep)) + hold + start_delay + plan.duration() - plan.prep_duration
+                    position[args[1]] = plan[-1].targets[0]
+                elif args[0] == 'GRID':
+                    spec = [(axis(args[i]), float(args[i + 1]), float(args[i + 2]), float(args[i + 3])) for i in range(1, len(args), 4)]
+                    plan = GridPlan.compile(spec, detectors)
+                    duration = plan.duration()
+                    for a, i in enumerate(range(1, len(args), 4)):
+                        position[args[i]] = plan.points[-1].targets[a]
+                elif args[0] == 'WAIT':
+                    duration = float(args[1])
+            except ScanPlanError as e:
+                problems += ['Line %d: %s'%(cmd.line, problem) for problem in e.problems]
+            except ValueError as e:
+                problems.append('Line %d: %s'%(cmd.line, e))
+            durations.append(duration)
+
+        if problems:
+            raise QueueError(problems)
+
+        # Each command starts once everything it depends on has finished.
+        finish = {}
+        for task in build_graph(self.texts):
+            finish[task.index] = max([finish[i] for i in task.after], default=0.0) + durations[task.index]
+        total = max(finish.values(), default=0.0)
+
+        lines = {}
+        for cmd, duration in zip(self.commands, durations):
+            est = lines.get(cmd.line, LineEstimate(cmd.line, cmd.source, 0, 0.0))
+            lines[cmd.line] = est._replace(count=est.count + 1, duration=est.duration + duration)
+
+        log.info('Queue estimate: %d commands, %.0f s.'%(len(self.commands), total))
+        return QueueEstimate(durations, [lines[k] for k in sorted(lines)], total)
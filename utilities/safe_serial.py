@@ -24,12 +24,17 @@
 
 import time
 import serial
-from threading import Lock
+from abc import ABC, abstractmethod
+from collections import deque
+from threading import Lock, Condition
 from utilities import log
 # from _typeshed import ReadableBuffer
 
 safe_ports = {}
 
+# Simulated devices, keyed by the port name they answer on. See VirtualSerial below and the *_SIM classes in the drivers.
+virtual_ports = {}
+
 # Likely unnecessary.
 def safe_close(port):
     log.info('safe_close: Closing port:', port)
@@ -38,18 +43,40 @@ def safe_close(port):
 # The overall idea here is to implement one mutex lock per port. A direct call to SafeSerial would create an arbitrary number of locks per port. Calling this function ensures that only have one lock per port by returning the SafeSerial object in charge of the port if we already have one, or creating a new one if we do not.
 def SafeSerial(port: str, baudrate: int, timeout: float = ...):
     if port not in safe_ports.keys():
-        safe_ports[port] = _SafeSerial(port, baudrate, timeout)
+        safe_ports[port] = _SafeSerial(port, baudrate, timeout, device=virtual_ports.get(port))
     return safe_ports[port]
 
+# Whether `port` is currently held open through SafeSerial, i.e. a connected driver is talking to it.
+def port_in_use(port: str) -> bool:
+    s = safe_ports.get(port)
+    return s is not None and hasattr(s, '_s') and s._s.is_open
+
+# Makes a simulated device available on a virtual port name. Drivers opening that port through SafeSerial() will talk to the simulator instead of hardware.
+def register_virtual_port(port: str, device):
+    log.info('Registering virtual port:', port)
+    virtual_ports[port] = device
+    return device
+
+def unregister_virtual_port(port: str):
+    if port in virtual_ports:
+        del virtual_ports[port]
+    if port in safe_ports:
+        del safe_ports[port]
+
+class SerialPreempted(RuntimeError):
+    """ Raised by xfer() for a transaction abandoned because preempt() wrote over it. Its reply, if any, cannot be
+    trusted.
+    """
+
 class _SafeSerial:
     READ_DELAY = 0.05
     READ_SIZE = 128
 
-    def __init__(self, port: str, baudrate: int, timeout: float = ...):
+    def __init__(self, port: str, baudrate: int, timeout: float = ..., device = None):
         print('Creating SafeSerial on port:', port)
 
         retries = 0
-        while True:
+        while device is None:
             try:
                 self._s = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
                 break
@@ -62,7 +89,18 @@ class _SafeSerial:
                     return
                 continue
 
+        if device is not None:
+            self._s = device
+
         self._m = Lock()
+
+        # Held only for the duration of a single write so that preempt() never waits on a whole transaction.
+        self._wm = Lock()
+
+        # Incremented by preempt(); transactions started under an older epoch are abandoned.
+        self._epoch = 0
+        # Set by preempt(); the reply to the preempting message is discarded before the port is next used.
+        self._drain = False
         # if self._s.is_open:
         #     log.warn('Port is already open. Closing and reopening.')
         #     self._s.close()
@@ -73,42 +111,47 @@ class _SafeSerial:
 
     def __del__(self):
         log.info('SafeSerial destructor called.')
-        self._m.acquire()
-        log.info('Destroying SafeSerial.')
-        self._s.close()
+        with self._m:
+            log.info('Destroying SafeSerial.')
+            self._s.close()
 
+    # Releases the lock afterwards; otherwise dropping a closed port (e.g. when it is unplugged) deadlocks in __del__.
     def close(self):
         log.info('SafeSerial close called.')
-        self._m.acquire()
-        log.info('Closing SafeSerial.')
-        self._s.close()
+        with self._m:
+            log.info('Closing SafeSerial.')
+            self._s.close()
 
     # Mutex-protected.
     # TODO: Delete this.
-    def write(self, buf):
+    def write(self, buf, eol: bytes = b'\r\n'):
         self._m.acquire() 
+        self._drain_preempt(_SafeSerial.READ_DELAY)
 
-        buf = buf + b'\r\n'
+        buf = buf + eol
 
         log.info('SafeSerial Write:', buf)
 
-        retval = self._s.write(buf)
+        with self._wm:
+            retval = self._s.write(buf)
         self._m.release()
         return retval
 
     # INTERNAL USE ONLY
     # Mutex pre-acquired.
-    def _write(self, buf):
-        buf = buf + b'\r\n'
+    def _write(self, buf, eol: bytes = b'\r\n'):
+        buf = buf + eol
 
         log.info('SafeSerial Write:', buf)
 
-        retval = self._s.write(buf)
+        with self._wm:
+            retval = self._s.write(buf)
         return retval
 
     # Prefixed with a small delay.
     def read(self, size: int = READ_SIZE):
         self._m.acquire() 
+        self._drain_preempt(_SafeSerial.READ_DELAY)
         time.sleep(_SafeSerial.READ_DELAY)
         retval = self._s.read(size)
         log.info('Serial RX:', retval)
@@ -119,8 +162,8 @@ class _SafeSerial:
 
     # INTERNAL USE ONLY
     # Mutex pre-acquired.
-    def _read(self, size: int = READ_SIZE):
-        time.sleep(_SafeSerial.READ_DELAY)
+    def _read(self, size: int = READ_SIZE, delay: float = READ_DELAY):
+        time.sleep(delay)
         retval = self._s.read(size)
         log.info('Serial RX:', retval)
 
@@ -132,29 +175,141 @@ class _SafeSerial:
         if custom_delay > delay:
             delay = custom_delay
 
+        # A transaction queued behind the lock when preempt() is called must not go out after it.
+        epoch = self._epoch
+
         self._m.acquire()
 
         log.info('Serial xfer called with TX:', tx_buf)
 
-        for i, msg in enumerate(tx_buf):
-            # self._s.write(msg)
-            self._write(msg)
-            log.info(f'Serial xfer TX[{i}]: {msg}')
+        retval = b''
+        try:
+            for i, msg in enumerate(tx_buf):
+                if self._epoch != epoch:
+                    log.warn('Serial xfer preempted; dropping TX:', tx_buf[i:])
+                    raise SerialPreempted('Serial transfer preempted by a stop.')
 
-            time.sleep(delay)
-    
-            # retval = self._s.read(rx_buf_size)
-            retval = self._read(rx_buf_size)
-            log.info('Serial xfer RX:', retval)
+                self._drain_preempt(delay)
 
-            time.sleep(delay)
+                # self._s.write(msg)
+                self._write(msg)
+                log.info(f'Serial xfer TX[{i}]: {msg}')
 
-        self._m.release()
+                time.sleep(delay)
+        
+                # retval = self._s.read(rx_buf_size)
+                retval = self._read(rx_buf_size)
+                log.info('Serial xfer RX:', retval)
+
+                time.sleep(delay)
+
+            # A preempt during the last read may have put the reply to the preempting message in `retval`.
+            if self._epoch != epoch:
+                log.warn('Serial xfer preempted; discarding RX:', retval)
+                raise SerialPreempted('Serial transfer preempted by a stop.')
+        finally:
+            self._m.release()
 
         return retval
 
+    # INTERNAL USE ONLY
+    # Mutex pre-acquired. Discards whatever the device sent in reply to a preempting message.
+    def _drain_preempt(self, delay: float):
+        if not self._drain:
+            return
+
+        # Give the reply time to arrive; _wm is only taken for the flush so that another preempt is never held up.
+        time.sleep(delay)
+        with self._wm:
+            self._s.reset_input_buffer()
+            self._drain = False
+
+    def preempt(self, buf, eol: bytes = b'\r\n')->float:
+        """ Writes immediately, without waiting for the transaction holding the port.
+
+        Transactions waiting on the port, and the one in progress, are abandoned and raise SerialPreempted. The reply
+        to `buf` is discarded before the port is next used. Meant for stop commands, which must not queue behind
+        other traffic.
+
+        Args:
+            buf (bytes): The message to write.
+            eol (bytes, optional): Line ending appended to `buf`. Defaults to b'\\r\\n'.
+
+        Returns:
+            float: time.perf_counter() timestamp taken as the message was handed to the port.
+        """
+
+        self._epoch += 1
+        with self._wm:
+            t = time.perf_counter()
+            self._s.write(buf + eol)
+            self._drain = True
+
+        # Logging is slow; only do it once the bytes are out.
+        log.info('SafeSerial Preempt:', buf)
+        return t
+
     def _lock_override(self):
         self._m.acquire()
 
     def _release_override(self):
-        self._m.release()
\ No newline at end of file
+        self._m.release()
+
+class VirtualSerial(ABC):
+    """ Stand-in for serial.Serial used by the hardware simulators.
+
+    Implements the subset of the pyserial API which _SafeSerial relies on. Subclasses implement `_receive()` to react to
+    bytes written by the host and call `_reply()` to queue bytes for the host to read. Every write is timestamped in
+    `rx_log` so that wire-level timing (e.g. stop latency) can be measured.
+    """
+
+    def __init__(self, timeout: float = 0.5):
+        self.timeout = timeout
+        self.is_open = True
+        self.rx_log = deque(maxlen=4096)
+        self._out = bytearray()
+        self._cv = Condition()
+
+    def write(self, buf):
+        now = time.perf_counter()
+        with self._cv:
+            self.rx_log.append((now, bytes(buf)))
+            self._receive(bytes(buf))
+            self._cv.notify_all()
+        return len(buf)
+
+    def read(self, size: int = 1):
+        # Like pyserial, block until `size` bytes are available or the timeout expires.
+        deadline = time.monotonic() + self.timeout
+        with self._cv:
+            while len(self._out) < size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cv.wait(remaining)
+            retval = bytes(self._out[:size])
+            del self._out[:size]
+        return retval
+
+    def reset_input_buffer(self):
+        with self._cv:
+            self._out.clear()
+
+    def close(self):
+        self.is_open = False
+
+    def first_rx_after(self, t: float):
+        """ Returns the timestamp of the first write received at or after `t`, or None. """
+        with self._cv:
+            for ts, _ in self.rx_log:
+                if ts >= t:
+                    return ts
+        return None
+
+    # Called with the condition held.
+    def _reply(self, buf):
+        self._out += buf
+
+    @abstractmethod
+    def _receive(self, buf: bytes):
+        pass
@@ -0,0 +1,719 @@
+#
+# @file scan_engine.py
+# @author Mit Bailey (mitbailey@outlook.com)
+# @brief Runs a compiled scan against device handles and reports to pluggable sinks; no GUI required.
+# @version See Git tags for version information.
+# @date 2026.10.19
+#
+# @copyright Copyright (c) 2022
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+
+# The engine knows nothing about widgets or the main window. Everything it learns goes to its sinks, called in the order
+# given and from the engine's threads; a GUI sink must hand off to its own thread (e.g. by emitting Qt signals).
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from enum import Enum
+
+import numpy as np
+
+from utilities import version
+from utilities import log
+from utilities.scan_plan import ScanPlan, ScanPlanError, GridPlan
+from middleware import MotionGroup, Measurement
+
+class ScanAxis(Enum):
+    MAIN = 0
+    SAMPLE = 1
+    DETECTOR = 2
+    MULTI = 3
+
+class SampleScanType(Enum):
+    ROTATION = 0
+    TRANSLATION = 1
+    THETA2THETA = 2
+
+def prep_position(axis, start: float) -> float:
+    """ Returns the preparatory position a scan of `axis` from `start` visits before its first point. """
+    # Only perform zeroing manuever if we are the KST-x01.
+    return 0 if 'KST' in axis.short_name() else start * 0.85
+
+def timed_sample(detector):
+    """ Returns (time at the middle of the reading, reading). """
+    t0 = time.time()
+    mes = detector.sample()
+    return ((t0 + time.time()) / 2, mes)
+
+def timed_detect(detector):
+    """ Returns the Measurement and the time at the middle of its acquisition. """
+    t0 = time.time()
+    meas = detector.measure()
+    return meas, (t0 + time.time()) / 2
+
+def channel_names(detector) -> tuple:
+    if detector.record_dtype is None:
+        return ()
+    return detector.record_dtype.names
+
+def channel_values(meas) -> tuple:
+    if meas.channels is None:
+        return ()
+    return tuple(meas.channels.item())
+
+def blank_channels(detector):
+    """ Returns a channel record for readings taken without their channels: NaN, or 0 for integer status fields. """
+    if detector.record_dtype is None:
+        return None
+    rec = np.zeros((), dtype=detector.record_dtype)
+    for name in detector.record_dtype.names:
+        if rec[name].dtype.kind == 'f':
+            rec[name] = np.nan
+    return rec[()]
+
+class ScanSink:
+    """ Receives a ScanEngine's events. Every method does nothing by default; override the ones you need. """
+
+    def begin(self, engine):
+        """ The scan is about to acquire; `engine` has its detectors and plan set. Not called if the preparatory move
+        fails. """
+        pass
+
+    def status(self, text: str):
+        pass
+
+    def point(self, value: float, positions: list, rows: list, restored: bool = False):
+        """ A point was measured.
+
+        Args:
+            value (float): The planned scan position.
+            positions (list): Each planned axis's position, read back at the point.
+            rows (list): Per detector, (position, mean, std, n, timestamp, *channels).
+            restored (bool, optional): The point was measured before an interruption and is being replayed from a
+                checkpoint. Defaults to False.
+        """
+        pass
+
+    def progress(self, percent: float, remaining: float):
+        pass
+
+    def error(self, title: str, message: str):
+        pass
+
+    def end(self, failed: bool):
+        """ The scan is over. `failed` is set if it ended on an error rather than by completing or being stopped. Only
+        called if begin() was. """
+        pass
+
+class CsvSink(ScanSink):
+    """ Writes one CSV per detector, flushed to disk point by point, and a full-precision .npy of each at the end. """
+
+    def __init__(self, filenames: list, steps_per_value: float, zero_ofst: float, tstamp, append: bool = False):
+        self.filenames = filenames
+        self.steps_per_value = steps_per_value
+        self.zero_ofst = zero_ofst
+        self.tstamp = tstamp
+        self.append = append
+        self._files = []
+        self._engine = None
+
+    def begin(self, engine):
+        self._engine = engine
+        for filename, detector in zip(self.filenames, engine.detectors):
+            os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+            f = open(filename, 'a' if self.append else 'w')
+            if f.tell() == 0:
+                f.write('# DATA RECORDED IN SOFTWARE VERSION: %sv%s\n'%(version.__short_name__, version.__version__))
+                f.write('# %s\n'%(self.tstamp.strftime('%Y-%m-%d %H:%M:%S')))
+                f.write('# Steps/mm: %f\n'%(self.steps_per_value))
+                f.write('# mm/nm: %e; lambda_0 (nm): %e\n'%(0, self.zero_ofst))
+                channel_cols = ''.join(',%s'%(name) for name in channel_names(detector))
+                f.write('# Position (step),Position (nm),Mean Current(A),Std Dev(A),Samples,Timestamp (s)%s\n'%(channel_cols))
+            self._files.append(f)
+
+    def point(self, value: float, positions: list, rows: list, restored: bool = False):
+        # Restored points are already in the files.
+        if restored:
+            return
+        for f, row in zip(self._files, rows):
+            channel_vals = ''.join(',%g'%(val) for val in row[5:])
+            f.write('%d,%e,%e,%e,%d,%.6f%s\n'%(positions[0], positions[0] - self.zero_ofst, row[1], row[2], row[3], row[4], channel_vals))
+        # The point only counts as done once its data is on disk.
+        for f in self._files:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def end(self, failed: bool):
+        for i, f in enumerate(self._files):
+            np.save(os.path.splitext(f.name)[0] + '.npy', self._engine.records(i))
+            f.close()
+        self._files = []
+
+class CheckpointSink(ScanSink):
+    """ Journals the scan to a checkpoint.Checkpoint so that it can be resumed. Place it after the sinks that write the
+    data, so that a point is journalled only once it is on disk. """
+
+    def __init__(self, checkpoint, params: dict):
+        self.checkpoint = checkpoint
+        self.params = params
+
+    def begin(self, engine):
+        self.checkpoint.begin_scan(self.params)
+
+    def point(self, value: float, positions: list, rows: list, restored: bool = False):
+        # A resumed scan starts a fresh journal, so its restored points are recorded again.
+        self.checkpoint.point(value, positions, rows)
+
+    def end(self, failed: bool):
+        # A scan that failed part-way keeps its checkpoint so it can be resumed once the fault is cleared.
+        if not failed:
+            self.checkpoint.end_scan()
+
+class ScanEngine:
+    """ Runs a compiled ScanPlan: moves the planned axes to each point, measures the detectors and reports each point
+    to the sinks.
+
+    Args:
+        plan (ScanPlan): The scan. Its axes are moved, and read back, at every point.
+        detectors (list): Detectors measured at every point.
+        sinks (list, optional): ScanSink instances, called in order. Defaults to [].
+        prep (float, optional): Preparatory position, in scan units, visited first. Defaults to None.
+        fly (bool, optional): Acquire during one continuous move of the (single) planned axis. Defaults to False.
+        adaptive (bool, optional): Add points where the signal changes fastest once the plan is done. Defaults to False.
+        mes_sign (float, optional): Multiplies every mean. Defaults to 1.
+        hold (float, optional): Seconds to settle after the preparatory move. Defaults to 1.
+        start_delay (float, optional): Further seconds to wait before the first point. Defaults to 0.
+        done_points (list, optional): "point" checkpoint records of a scan being resumed; their values are not measured
+            again. Defaults to None.
+        keep_running (callable, optional): Polled between points; the scan stops once it returns False. Defaults to
+            None.
+    """
+
+    # Detector sampling rate during fly scans, in Hz.
+    FLY_SAMPLE_RATE = 10.0
+
+    # Adaptive refinement: a change of this fraction of the signal range marks a feature; steps are halved at most
+    # ADAPTIVE_MAX_DEPTH times; the whole scan takes at most ADAPTIVE_BUDGET times the coarse pass's points.
+    ADAPTIVE_THRESHOLD = 0.05
+    ADAPTIVE_MAX_DEPTH = 4
+    ADAPTIVE_BUDGET = 4
+
+    def __init__(self, plan: ScanPlan, detectors: list, sinks: list = None, prep: float = None, fly: bool = False, adaptive: bool = False, mes_sign: float = 1, hold: float = 1.0, start_delay: float = 0.0, done_points: list = None, keep_running = None):
+        self.plan = plan
+        self.detectors = list(detectors)
+        self.sinks = list(sinks) if sinks is not None else []
+        self.prep = prep
+        self.fly = fly
+        self.adaptive = adaptive
+        self.mes_sign = mes_sign
+        self.hold = hold
+        self.start_delay = start_delay
+        self.done_points = list(done_points) if done_points is not None else []
+        self._keep_running = keep_running if keep_running is not None else (lambda: True)
+        self._stopped = False
+
+        self.xdata = [[] for _ in self.detectors]
+        self.ydata = [[] for _ in self.detectors]
+        self.recdata = [[] for _ in self.detectors]
+
+        self._total = len(plan)
+        self._done = 0
+        self._percent = 0.0
+        self._t_start = None
+
+    @property
+    def running(self) -> bool:
+        return not self._stopped and self._keep_running()
+
+    def stop(self):
+        """ Stops the scan after the current point. Thread-safe. """
+        self._stopped = True
+
+    def _emit(self, event: str, *args):
+        for sink in self.sinks:
+            getattr(sink, event)(*args)
+
+    def _move(self, value: float):
+        # Every planned axis to its share of `value`, together if there is more than one.
+        if len(self.plan.axes) == 1:
+            mc, scale = self.plan.axes[0]
+            mc.move_to(scale * value, True)
+        else:
+            group = MotionGroup()
+            for mc, scale in self.plan.axes:
+                group.add(mc, scale * value)
+            group.execute()
+
+    def run(self) -> bool:
+        """ Runs the scan to completion, a stop or an error.
+
+        Returns:
+            bool: False if it ended on an error, which has been reported to the sinks.
+        """
+        if self.prep is not None:
+            self._emit('status', 'ZEROING')
+            try:
+                log.info('Moving to', self.prep)
+                self._move(self.prep)
+                log.info('Done with', self.prep)
+            except Exception as e:
+                log.error('Exception: Move Failure - Axis failed to move: %s'%(e))
+                self._emit('error', 'Move Failure', 'Axis failed to move: %s'%(e))
+                return False
+
+        log.info('Holding for %g seconds.'%(self.hold + self.start_delay))
+        self._emit('status', 'HOLDING')
+        time.sleep(self.hold + self.start_delay)
+
+        self._emit('begin', self)
+
+        # Put the points completed before the interruption back in the data arrays.
+        done_values = []
+        for rec in self.done_points:
+            done_values.append(self._restore(rec))
+            self._emit('point', done_values[-1], rec['positions'], rec['rows'], True)
+        if len(done_values) > 0:
+            log.info('Resuming scan: %d points already done.'%(len(done_values)))
+
+        failed = False
+        try:
+            failed = not self._acquire(done_values)
+        finally:
+            # Every sink gets to finish, even if one before it cannot; a checkpoint must not be left open because a
+            # data file failed to save.
+            for sink in self.sinks:
+                try:
+                    sink.end(failed)
+                except Exception as e:
+                    log.error('Exception: %s failed to finish the scan: %s'%(type(sink).__name__, e))
+                    failed = True
+        return not failed
+
+    def _restore(self, rec: dict):
+        # Puts a checkpointed point back in the data arrays; returns its value.
+        for i, row in enumerate(rec['rows']):
+            self.xdata[i].append(row[0])
+            self.ydata[i].append(row[1])
+            self.recdata[i].append(tuple(row))
+        return rec['value']
+
+    def _acquire(self, done_values: list) -> bool:
+        # Detectors sit on separate ports, so they are sampled concurrently; each point then costs the slowest detector rather than the sum of them.
+        detect_pool = ThreadPoolExecutor(max_workers=max(1, len(self.detectors)), thread_name_prefix='detect')
+
+        # Persistence and sink updates for a point run here while the next point moves; one worker keeps them in order.
+        record_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='record')
+        pending_record = None
+        self._t_start = time.time()
+
+        # Fly scans acquire everything during one continuous move; the loop below then only records the rebinned points.
+        fly_points = None
+        ok = True
+        if self.fly:
+            try:
+                fly_points = self._fly_scan(self.plan.axes[0][0], self.plan.values, detect_pool)
+            except Exception as e:
+                log.error('Move Failure - Axis failed to move: %s'%(e))
+                self._emit('error', 'Move Failure', 'Axis failed to move: %s'%(e))
+                fly_points = []
+                ok = False
+
+        def points():
+            # The planned points, then, in adaptive mode, passes of points added where the coarser data changes fastest.
+            # Refinement follows the first detector's data, so a scan without detectors is not refined.
+            yield from self.plan
+            if not self.adaptive or fly_points is not None or len(self.plan) < 2 or not self.xdata:
+                return
+
+            min_step = abs(self.plan[1].value - self.plan[0].value) / 2**ScanEngine.ADAPTIVE_MAX_DEPTH
+            budget = (ScanEngine.ADAPTIVE_BUDGET - 1) * len(self.plan)
+            while self.running and budget > 0:
+                # Refinement works from the recorded data, so the last point has to be recorded first.
+                if pending_record is not None:
+                    wait([pending_record])
+                values = ScanPlan.refine_values(self.xdata[0], self.ydata[0], ScanEngine.ADAPTIVE_THRESHOLD, min_step, budget)
+                if len(values) == 0:
+                    break
+                # Each pass runs in the scan's direction, so the only reversal is the return to its first point.
+                if self.plan[-1].value < self.plan[0].value:
+                    values = values[::-1]
+                try:
+                    refinement = ScanPlan.from_values(values, self.plan.axes, self.detectors)
+                except ScanPlanError as e:
+                    log.error('Adaptive refinement stopped: %s'%(e))
+                    break
+
+                budget -= len(refinement)
+                self._total += len(refinement)
+                log.info('Adaptive refinement: %d more points (%d in total).'%(len(refinement), self._total))
+                yield from refinement
+
+        for point in points():
+            idx, dpos = point.index, point.value
+
+            if any(np.isclose(dpos, done) for done in done_values):
+                log.debug('Point %f was completed before the scan was interrupted.'%(dpos))
+                self._done += 1
+                continue
+
+            if fly_points is not None:
+                if idx >= len(fly_points):
+                    break
+                positions, results = [fly_points[idx][0]], fly_points[idx][1]
+                if results is None:
+                    log.warn('No fly scan samples near %f; skipping it.'%(dpos))
+                    self._done += 1
+                    continue
+            else:
+                if not self.running:
+                    log.warn('Scan stopped before %f.'%(dpos))
+                    break
+                self._emit('status', 'MOVING')
+                try:
+                    log.debug('Moving to', dpos)
+                    self._move(dpos)
+                except Exception as e:
+                    log.error('Move Failure - Axis failed to move: %s'%(e))
+                    self._emit('error', 'Move Failure', 'Axis failed to move: %s'%(e))
+                    ok = False
+                    break
+                self._emit('status', 'SAMPLING')
+
+                # The detectors and the axes are on different ports, so the positions are read while they sample.
+                detections = [detect_pool.submit(timed_detect, detector) for detector in self.detectors]
+                positions = [mc.get_position() for mc, _ in self.plan.axes]
+                results = [detection.result() for detection in detections]
+
+            # Recording point N overlaps moving to and detecting point N+1. Waiting for the previous record first keeps
+            # at most one point in flight, so a slow disk or GUI applies back-pressure instead of queueing the scan.
+            if pending_record is not None and pending_record.exception() is not None:
+                log.error('Failed to record a scan point: %s'%(pending_record.exception()))
+            pending_record = record_pool.submit(self._record_point, dpos, positions, results)
+
+        if pending_record is not None and pending_record.exception() is not None:
+            log.error('Failed to record a scan point: %s'%(pending_record.exception()))
+        record_pool.shutdown(wait=True)
+        detect_pool.shutdown(wait=True)
+        return ok
+
+    def _record_point(self, value, positions, results):
+        # Data arrays, sinks and progress for the point planned at `value`. Runs on the record pool, one point at a time
+        # and in scan order, while the scan thread moves on to the next point.
+        rows = []
+        for i, (meas, tstamp) in enumerate(results):
+            # With several planned axes (theta-2theta), detectors after the first are placed by the second axis.
+            x = positions[min(i, len(positions) - 1)]
+            y = self.mes_sign * meas.mean
+            row = (x, y, meas.std, meas.n, tstamp) + channel_values(meas)
+            self.xdata[i].append(x)
+            self.ydata[i].append(y)
+            self.recdata[i].append(row)
+            rows.append(row)
+        self._emit('point', value, positions, rows, False)
+        self._advance()
+
+    def _advance(self):
+        # Counts a recorded point and reports the progress.
+        self._done += 1
+        fraction = self._done / self._total
+        elapsed = time.time() - self._t_start
+        # Adaptive passes add points, which lowers the fraction done; the bar holds until the scan catches up with it.
+        self._percent = max(self._percent, fraction * 100.0)
+        self._emit('progress', self._percent, elapsed / fraction - elapsed)
+
+    def _fly_scan(self, axis, scanrange, detect_pool) -> list:
+        """Acquires a scan of one axis during one continuous move.
+
+        The axis travels from the first to the last point at its configured move speed while the detectors are sampled
+        every 1 / FLY_SAMPLE_RATE seconds. The axis's position is read alongside each round of samples; this track is
+        the velocity model which places each sample, by interpolation at its timestamp. Samples are then averaged into
+        bins centred on the scan points.
+
+        Returns:
+            list: (position, [(Measurement, timestamp) per detector]) for each scan point; the list is None for points
+            with no samples.
+        """
+        self._emit('status', 'MOVING')
+        axis.move_to(scanrange[0], True)
+
+        track_t = []
+        track_x = []
+        samples = [[] for _ in self.detectors]
+
+        # Every position must come from the device at the moment it is asked for, not from the cache.
+        ttl = axis.get_position_ttl()
+        axis.set_position_ttl(0)
+
+        def mark():
+            t0 = time.time()
+            x = axis.get_position()
+            track_t.append((t0 + time.time()) / 2)
+            track_x.append(x)
+
+        self._emit('status', 'FLYING')
+        try:
+            mark()
+            axis.move_to(scanrange[-1], False)
+            t_cmd = time.time()
+
+            span = scanrange[-1] - scanrange[0]
+            period = 1.0 / ScanEngine.FLY_SAMPLE_RATE
+            next_t = time.time()
+            while True:
+                sampling = [detect_pool.submit(timed_sample, detector) for detector in self.detectors]
+                mark()
+                for i, sample in enumerate(sampling):
+                    samples[i].append(sample.result())
+
+                if span != 0:
+                    self._percent = max(self._percent, min(max((track_x[-1] - scanrange[0]) / span, 0), 1) * 100.0)
+                    self._emit('progress', self._percent, 0.0)
+
+                if not self.running:
+                    log.warn('Fly scan stopped at %f.'%(track_x[-1]))
+                    axis.stop()
+                    break
+                if not axis.is_moving():
+                    break
+
+                next_t += period
+                time.sleep(max(0.0, next_t - time.time()))
+            mark()
+        finally:
+            axis.set_position_ttl(ttl)
+
+        track_t, track_x = ScanEngine._velocity_model(np.array(track_t), np.array(track_x), t_cmd)
+        log.info('Fly scan: %d samples over %.1f s.'%(len(samples[0]) if len(samples) > 0 else 0, track_t[-1] - track_t[0]))
+
+        # Fly samples are single readings without their channels; the records keep their columns, as NaN.
+        binned = [ScanEngine._rebin(track_t, track_x, np.array(det_samples), scanrange, blank_channels(detector)) for detector, det_samples in zip(self.detectors, samples)]
+
+        points = []
+        for idx, dpos in enumerate(scanrange):
+            results = [b[idx] for b in binned]
+            points.append((dpos, None if any(r is None for r in results) else results))
+        return points
+
+    @staticmethod
+    def _velocity_model(track_t, track_x, t_cmd) -> tuple:
+        # Returns (times, positions) to interpolate sample positions from.
+        x0 = track_x[0]
+        x1 = track_x[-1]
+        lo, hi = min(x0, x1), max(x0, x1)
+        arrival = track_t[np.argmax(track_x == x1)]
+
+        # Open-loop drives (e.g. the 789A-4) only report where they were sent. Assume constant velocity from the
+        # command to the first reading at the destination.
+        if np.count_nonzero((track_x > lo) & (track_x < hi)) < 2:
+            return np.array([t_cmd, arrival]), np.array([x0, x1])
+
+        # Otherwise use the readings themselves, each value at the time it first appeared. The start position is
+        # taken at the moment it was last seen, i.e. when the drive actually left.
+        depart = np.flatnonzero(track_x != x0)[0] - 1
+        keep = [depart] + [k for k in range(depart + 1, len(track_x)) if track_x[k] != track_x[k - 1]]
+        return track_t[keep], track_x[keep]
+
+    @staticmethod
+    def _rebin(track_t, track_x, det_samples, grid, channels = None) -> list:
+        # Places (timestamp, value) samples along the drive track and averages them into bins centred on `grid`.
+        # Every Measurement carries `channels`.
+        if len(det_samples) == 0:
+            return [None] * len(grid)
+
+        x = np.interp(det_samples[:, 0], track_t, track_x)
+        edges = np.concatenate(([grid[0] - (grid[1] - grid[0]) / 2 if len(grid) > 1 else grid[0] - 0.5], (grid[1:] + grid[:-1]) / 2, [grid[-1] + (grid[-1] - grid[-2]) / 2 if len(grid) > 1 else grid[0] + 0.5]))
+        if edges[0] > edges[-1]:
+            # Scanning downwards.
+            bins = len(grid) - np.digitize(x, edges[::-1])
+        else:
+            bins = np.digitize(x, edges) - 1
+
+        out = []
+        for k in range(len(grid)):
+            sel = bins == k
+            n = int(np.count_nonzero(sel))
+            if n == 0:
+                out.append(None)
+                continue
+            values = det_samples[sel, 1]
+            out.append((Measurement(float(values.mean()), float(values.std(ddof=1)) if n > 1 else 0.0, n, channels), float(det_samples[sel, 0].mean())))
+        return out
+
+    def records(self, which_detector: int) -> np.ndarray:
+        """Returns everything recorded for one detector as a NumPy structured array.
+
+        Args:
+            which_detector (int): Index into the engine's detectors.
+
+        Returns:
+            np.ndarray: Fields POSITION, MEAN, STD, N and TIMESTAMP, followed by the detector's channels.
+        """
+        fields = [('POSITION', 'f8'), ('MEAN', 'f8'), ('STD', 'f8'), ('N', 'i4'), ('TIMESTAMP', 'f8')]
+        detector = self.detectors[which_detector]
+        if detector.record_dtype is not None:
+            fields += detector.record_dtype.descr
+        return np.array(self.recdata[which_detector], dtype=np.dtype(fields))
+
+class GridCsvSink(ScanSink):
+    """ Writes one CSV per detector of a GridEngine's points, flushed to disk point by point, and a .npz of each
+    detector's grid arrays at the end. """
+
+    def __init__(self, filenames: list, codes: list, grid: list, tstamp, append: bool = False):
+        self.filenames = filenames
+        self.codes = codes
+        self.grid = grid
+        self.tstamp = tstamp
+        self.append = append
+        self._files = []
+        self._engine = None
+
+    def begin(self, engine):
+        self._engine = engine
+        for filename, detector in zip(self.filenames, engine.detectors):
+            os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+            f = open(filename, 'a' if self.append else 'w')
+            if f.tell() == 0:
+                f.write('# DATA RECORDED IN SOFTWARE VERSION: %sv%s\n'%(version.__short_name__, version.__version__))
+                f.write('# %s\n'%(self.tstamp.strftime('%Y-%m-%d %H:%M:%S')))
+                f.write('# Grid: %s\n'%('; '.join('%s %g to %g step %g'%(tuple(a)) for a in self.grid)))
+                channel_cols = ''.join(',%s'%(name) for name in channel_names(detector))
+                f.write('# %s,Mean Current(A),Std Dev(A),Samples,Timestamp (s)%s\n'%(','.join(self.codes), channel_cols))
+            self._files.append(f)
+
+    def point(self, value: tuple, positions: list, rows: list, restored: bool = False):
+        if restored:
+            return
+        naxes = len(positions)
+        for f, row in zip(self._files, rows):
+            channel_vals = ''.join(',%g'%(val) for val in row[naxes + 4:])
+            f.write('%s,%e,%e,%d,%.6f%s\n'%(','.join('%e'%(p) for p in row[:naxes]), row[naxes], row[naxes + 1], row[naxes + 2], row[naxes + 3], channel_vals))
+        for f in self._files:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def end(self, failed: bool):
+        axes = {'axis%d'%(a): values for a, values in enumerate(self._engine.plan.axis_values)}
+        for i, f in enumerate(self._files):
+            np.savez(os.path.splitext(f.name)[0] + '.npz', mean=self._engine.mean[i], std=self._engine.std[i], n=self._engine.count[i], axis_codes=np.array(self.codes), **axes)
+            f.close()
+        self._files = []
+
+class GridEngine(ScanEngine):
+    """ Runs a compiled GridPlan, point by point in its serpentine order, and reports to the same sinks as ScanEngine.
+
+    The sinks see each point's grid index as its `value`, every grid axis's read-back position as `positions`, and rows
+    of (*positions, mean, std, n, timestamp, *channels). The results are also kept in `mean`, `std` and `count`: arrays
+    shaped like the grid, one per detector.
+
+    Args:
+        plan (GridPlan): The grid.
+        detectors (list): Detectors measured at every point.
+        sinks (list, optional): ScanSink instances, called in order. Defaults to [].
+        mes_sign (float, optional): Multiplies every mean. Defaults to 1.
+        done_points (list, optional): "point" checkpoint records of a grid scan being resumed; their points are not
+            measured again. Defaults to None.
+        keep_running (callable, optional): Polled between points; the scan stops once it returns False. Defaults to
+            None.
+    """
+
+    def __init__(self, plan: GridPlan, detectors: list, sinks: list = None, mes_sign: float = 1, done_points: list = None, keep_running = None):
+        super().__init__(plan, detectors, sinks, mes_sign=mes_sign, hold=0.0, done_points=done_points, keep_running=keep_running)
+        self.mean = [np.full(plan.shape, np.nan) for _ in self.detectors]
+        self.std = [np.full(plan.shape, np.nan) for _ in self.detectors]
+        self.count = [np.zeros(plan.shape, dtype=int) for _ in self.detectors]
+
+    def _restore(self, rec: dict):
+        index = tuple(rec['value'])
+        naxes = len(self.plan.axes)
+        for i, row in enumerate(rec['rows']):
+            self.mean[i][index] = row[naxes]
+            self.std[i][index] = row[naxes + 1]
+            self.count[i][index] = row[naxes + 2]
+            self.recdata[i].append(tuple(row))
+        return index
+
+    def _acquire(self, done_values: list) -> bool:
+        detect_pool = ThreadPoolExecutor(max_workers=max(1, len(self.detectors)), thread_name_prefix='detect')
+        mcs = [axis[0] for axis in self.plan.axes]
+        self._t_start = time.time()
+
+        ok = True
+        for point in self.plan:
+            if point.index in done_values:
+                log.debug('Grid point %s was completed before the scan was interrupted.'%(point.index,))
+                self._done += 1
+                continue
+
+            if not self.running:
+                log.warn('Grid scan stopped.')
+                break
+
+            # Usually only the innermost axis moves; the others move at the end of a row.
+            self._emit('status', 'MOVING')
+            try:
+                moving = [(mc, value) for mc, value, moves in zip(mcs, point.values, point.moves) if moves]
+                if len(moving) == 1:
+                    moving[0][0].move_to(moving[0][1], True)
+                elif len(moving) > 1:
+                    group = MotionGroup()
+                    for mc, value in moving:
+                        group.add(mc, value)
+                    group.execute()
+            except Exception as e:
+                log.error('Move Failure - Axis failed to move: %s'%(e))
+                self._emit('error', 'Move Failure', 'Axis failed to move: %s'%(e))
+                ok = False
+                break
+
+            self._emit('status', 'SAMPLING')
+            detections = [detect_pool.submit(timed_detect, detector) for detector in self.detectors]
+            positions = [mc.get_position() for mc in mcs]
+            results = [detection.result() for detection in detections]
+            self._record_point(point.index, positions, results)
+
+        detect_pool.shutdown(wait=True)
+        return ok
+
+    def _record_point(self, index, positions, results):
+        rows = []
+        for i, (meas, tstamp) in enumerate(results):
+            value = self.mes_sign * meas.mean
+            self.mean[i][index] = value
+            self.std[i][index] = meas.std
+            self.count[i][index] = meas.n
+            row = tuple(positions) + (value, meas.std, meas.n, tstamp) + channel_values(meas)
+            self.recdata[i].append(row)
+            rows.append(row)
+        self._emit('point', index, positions, rows, False)
+        self._advance()
+
+    def records(self, which_detector: int) -> np.ndarray:
+        """Returns every point recorded for one detector, in the order measured, as a NumPy structured array.
+
+        Args:
+            which_detector (int): Index into the engine's detectors.
+
+        Returns:
+            np.ndarray: Fields POSITION0, POSITION1, ... (one per grid axis, outermost first), MEAN, STD, N and
+            TIMESTAMP, followed by the detector's channels.
+        """
+        fields = [('POSITION%d'%(a), 'f8') for a in range(len(self.plan.axes))]
+        fields += [('MEAN', 'f8'), ('STD', 'f8'), ('N', 'i4'), ('TIMESTAMP', 'f8')]
+        detector = self.detectors[which_detector]
+        if detector.record_dtype is not None:
+            fields += detector.record_dtype.descr
+        return np.array(self.recdata[which_detector], dtype=np.dtype(fields))
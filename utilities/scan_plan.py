@@ -0,0 +1,305 @@
+#
+# @file scan_plan.py
+# @author Mit Bailey (mitbailey@outlook.com)
+# @brief Compiles scans and grid scans into per-point hardware targets, validated before anything moves.
+# @version See Git tags for version information.
+# @date 2026.10.19
+#
+# @copyright Copyright (c) 2022
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+
+from collections import namedtuple
+import numpy as np
+
+# One scan point. `targets` and `backlash` hold, per planned axis, the step target and backlash correction that the
+# move will send; `detectors` are the detectors read at this point; `duration` is the expected seconds to move there
+# and measure.
+PlanPoint = namedtuple('PlanPoint', ['index', 'value', 'targets', 'backlash', 'detectors', 'duration'])
+
+class ScanPlanError(Exception):
+    """ Raised by ScanPlan.compile() with every problem found, one per line. """
+    def __init__(self, problems: list):
+        self.problems = problems
+        super().__init__('\n'.join(problems))
+
+class ScanPlan:
+    """ A scan compiled ahead of time: every point's position on every axis, in steps, plus the detectors to read and
+    the time it is expected to take.
+
+    Build one with ScanPlan.compile(); iterating yields PlanPoint in scan order.
+    """
+
+    def __init__(self, axes: list, points: list, prep_duration: float):
+        self.axes = axes
+        self.points = points
+        self.prep_duration = prep_duration
+
+    def __len__(self):
+        return len(self.points)
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def __getitem__(self, idx):
+        return self.points[idx]
+
+    @property
+    def values(self)->np.ndarray:
+        """ The scan positions, in the units of the scanned axis. """
+        return np.array([p.value for p in self.points])
+
+    def duration(self, from_index: int = 0)->float:
+        """ Expected seconds to run the scan from point `from_index` to the end. The preparatory move is included when
+        starting from the beginning. """
+        total = sum(p.duration for p in self.points[from_index:])
+        if from_index == 0:
+            total += self.prep_duration
+        return total
+
+    @staticmethod
+    def scan_values(start: float, stop: float, step: float)->np.ndarray:
+        """ Returns the positions from `start` towards `stop`, `step` apart, never passing `stop`.
+
+        `stop` is the last point when the range is a whole number of steps; otherwise the last point is the final step
+        short of it. The point count is computed once, with a small tolerance, so floating-point error cannot add a
+        point past `stop` or drop the last one as np.arange(start, stop + step, step) can. A `step` with the wrong
+        sign for the direction is reversed.
+        """
+        if step == 0:
+            raise ValueError('Step size must be non-zero.')
+        step = abs(step) if stop >= start else -abs(step)
+        n = int(np.floor((stop - start) / step + 1e-9)) + 1
+        return start + step * np.arange(n)
+
+    @staticmethod
+    def compile(start: float, stop: float, step: float, axes: list, detectors: list = None, prep: float = None):
+        """ Compiles a scan, checking every point on every axis against its limits and calibration.
+
+        Args:
+            start (float): First position, in the units of the scanned axis.
+            stop (float): Last position.
+            step (float): Distance between points.
+            axes (list): (MotionController, scale) pairs. Each axis is sent `scale` times the scan position, so a
+                theta-2theta scan is [(sample_rotation, 1), (detector_rotation, 2)].
+            detectors (list, optional): Detectors read at every point. Defaults to [].
+            prep (float, optional): Preparatory position visited before the first point; validated and timed too.
+                Defaults to None.
+
+        Raises:
+            ScanPlanError: If any axis is uncalibrated, any point is out of its limits, or the step is finer than the
+                axis can resolve. Nothing has moved.
+
+        Returns:
+            ScanPlan: The compiled plan.
+        """
+        return ScanPlan.from_values(ScanPlan.scan_values(start, stop, step), axes, detectors, prep)
+
+    @staticmethod
+    def from_values(values, axes: list, detectors: list = None, prep: float = None):
+        """ Compiles a scan over explicit positions, visited in the order given. See compile().
+
+        Raises:
+            ScanPlanError: If any axis is uncalibrated, any point is out of its limits, or two points are closer than
+                the axis can resolve. Nothing has moved.
+
+        Returns:
+            ScanPlan: The compiled plan.
+        """
+        values = np.asarray(values, dtype=float)
+        detectors = list(detectors) if detectors is not None else []
+        problems = []
+        min_step = np.min(np.abs(np.diff(values))) if len(values) > 1 else None
+
+        for mc, scale in axes:
+            # Uncalibrated axes fail every point for the same reason; report them once.
+            error = mc.check_target(scale * values[0])
+            if error is not None and mc.get_steps_per_value() == 0:
+                problems.append(error)
+                continue
+            if prep is not None:
+                error = mc.check_target(scale * prep)
+                if error is not None:
+                    problems.append('Preparatory move: ' + error)
+            # One problem per axis, however many points are out of range.
+            outside = [value for value in values if mc.check_target(scale * value) is not None]
+            if len(outside) > 0:
+                max_pos, min_pos = mc.get_limits()
+                problems.append('%d of %d points (%g to %g) are beyond the limits of the %s axis [%f : %f].'%(len(outside), len(values), min(outside), max(outside), mc.short_name(), min_pos / scale, max_pos / scale))
+            # np.diff of e.g. 0.1-spaced values comes out a hair under 0.1; that is still exactly one step.
+            if min_step is not None and abs(scale * min_step * mc.get_steps_per_value()) < 1 - 1e-9:
+                problems.append('Step size %g is finer than one motor step on the %s axis (%g steps per unit).'%(min_step, mc.short_name(), mc.get_steps_per_value()))
+
+        if problems:
+            raise ScanPlanError(problems)
+
+        detect_time = max([det.estimate_detect_time() for det in detectors], default=0.0)
+
+        # Each axis starts from where the previous point left it; axes move together, so a point costs the slowest.
+        current = []
+        for mc, scale in axes:
+            current.append(mc.to_steps(scale * prep) if prep is not None else mc.to_steps(mc.get_position()))
+
+        prep_duration = 0.0
+        if prep is not None:
+            prep_duration = max([mc.estimate_move_time(mc.to_steps(mc.get_position()), steps) for (mc, _), steps in zip(axes, current)], default=0.0)
+
+        points = []
+        for idx, value in enumerate(values):
+            targets = tuple(mc.to_steps(scale * value) for mc, scale in axes)
+            backlash = tuple(mc.backlash_steps(scale * value) for mc, scale in axes)
+            move_time = max([mc.estimate_move_time(cur, tgt) for (mc, _), cur, tgt in zip(axes, current, targets)], default=0.0)
+            points.append(PlanPoint(idx, float(value), targets, backlash, tuple(detectors), move_time + detect_time))
+            current = list(targets)
+
+        return ScanPlan(axes, points, prep_duration)
+
+    @staticmethod
+    def refine_values(x, y, threshold: float, min_step: float, budget: int)->np.ndarray:
+        """ Picks the points to add to a scan so that features are sampled more finely than the baseline around them.
+
+        An interval between neighbouring points is split at its midpoint when the signal changes across it by more than
+        `threshold` of the signal's full range (gradient), or when either end is a point whose second difference
+        exceeds that (curvature, which catches peak tops that the gradient misses). Intervals that would be split
+        below `min_step` are left alone. Call again with the new data to refine further.
+
+        Args:
+            x (array): Positions measured so far, in any order.
+            y (array): Signal at each position.
+            threshold (float): Fraction of the signal range that counts as a feature.
+            min_step (float): Smallest spacing to create.
+            budget (int): Maximum number of points to return; the strongest features win.
+
+        Returns:
+            np.ndarray: New positions, ascending. Empty once nothing is left to refine.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if len(x) < 3 or budget <= 0:
+            return np.array([])
+        order = np.argsort(x)
+        x, y = x[order], y[order]
+
+        span = np.ptp(y)
+        if span == 0:
+            return np.array([])
+
+        # Score every interval by the larger of its gradient and the curvature at either end.
+        score = np.abs(np.diff(y)) / span
+        curvature = np.abs(y[:-2] - 2 * y[1:-1] + y[2:]) / span
+        score[:-1] = np.maximum(score[:-1], curvature)
+        score[1:] = np.maximum(score[1:], curvature)
+
+        split = (score > threshold) & (np.diff(x) >= 2 * min_step)
+        candidates = np.flatnonzero(split)
+        if len(candidates) > budget:
+            candidates = np.sort(candidates[np.argsort(score[candidates])[::-1][:budget]])
+
+        return (x[candidates] + x[candidates + 1]) / 2
+
+# One grid point. `index` is its position in the grid; `values`, `targets` and `moves` hold, per grid axis, the
+# position, the step target and whether that axis has to move to get here from the previous point.
+GridPoint = namedtuple('GridPoint', ['index', 'values', 'targets', 'moves', 'detectors', 'duration'])
+
+class GridPlan:
+    """ A multi-axis grid scan compiled ahead of time, in serpentine order.
+
+    Each axis sweeps in alternate directions on successive passes of the axes outside it, so consecutive points differ
+    in exactly one index by one: no return moves, and the inner axis only reverses at the end of each row.
+    """
+
+    def __init__(self, axes: list, axis_values: list, points: list):
+        self.axes = axes
+        self.axis_values = axis_values
+        self.points = points
+
+    def __len__(self):
+        return len(self.points)
+
+    def __iter__(self):
+        return iter(self.points)
+
+    @property
+    def shape(self)->tuple:
+        return tuple(len(v) for v in self.axis_values)
+
+    def duration(self, from_index: int = 0)->float:
+        return sum(p.duration for p in self.points[from_index:])
+
+    @staticmethod
+    def serpentine(shape: tuple)->list:
+        """ Returns every index of an array of `shape` in serpentine order, outermost axis first. """
+        if len(shape) == 0:
+            return [()]
+        inner = GridPlan.serpentine(shape[1:])
+        order = []
+        for i in range(shape[0]):
+            order += [(i,) + idx for idx in (inner if i % 2 == 0 else inner[::-1])]
+        return order
+
+    @staticmethod
+    def compile(axes: list, detectors: list = None):
+        """ Compiles a grid scan, checking every position of every axis before anything moves.
+
+        Args:
+            axes (list): (MotionController, start, stop, step) per grid axis, outermost first.
+            detectors (list, optional): Detectors read at every point. Defaults to [].
+
+        Raises:
+            ScanPlanError: If an axis is listed more than once, or any axis is uncalibrated, out of its limits or asked
+                for a step finer than it can resolve. Nothing has moved.
+
+        Returns:
+            GridPlan: The compiled plan.
+        """
+        detectors = list(detectors) if detectors is not None else []
+        axis_values = []
+        problems = []
+
+        # One controller cannot hold two grid positions at once.
+        mcs = [axis[0] for axis in axes]
+        for i, mc in enumerate(mcs):
+            if any(other is mc for other in mcs[:i]):
+                problems.append('%s: listed more than once in the grid.'%(mc.short_name()))
+        if problems:
+            raise ScanPlanError(problems)
+
+        for mc, start, stop, step in axes:
+            # Each axis is checked over its own positions; the grid only combines them.
+            try:
+                plan = ScanPlan.compile(start, stop, step, [(mc, 1)])
+                axis_values.append(plan.values)
+            except ScanPlanError as e:
+                problems += e.problems
+            except ValueError as e:
+                problems.append('%s: %s'%(mc.short_name(), e))
+
+        if problems:
+            raise ScanPlanError(problems)
+
+        detect_time = max([det.estimate_detect_time() for det in detectors], default=0.0)
+        current = [mc.to_steps(mc.get_position()) for mc in mcs]
+
+        points = []
+        for index in GridPlan.serpentine(tuple(len(v) for v in axis_values)):
+            values = tuple(float(axis_values[a][i]) for a, i in enumerate(index))
+            targets = tuple(mc.to_steps(v) for mc, v in zip(mcs, values))
+            moves = tuple(t != c for t, c in zip(targets, current))
+            move_time = max([mc.estimate_move_time(c, t) for mc, c, t, m in zip(mcs, current, targets, moves) if m], default=0.0)
+            points.append(GridPoint(index, values, targets, moves, tuple(detectors), move_time + detect_time))
+            current = list(targets)
+
+        return GridPlan(axes, axis_values, points)
@@ -0,0 +1,153 @@
+#
+# @file ttl_cache.py
+# @author Mit Bailey (mitbailey@outlook.com)
+# @brief Small thread-safe TTL/LRU cache for slow discovery and device-info queries.
+# @version See Git tags for version information.
+# @date 2026.10.19
+#
+# @copyright Copyright (c) 2022
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+
+import time
+import functools
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from utilities import log
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'evictions', 'size'])
+
+# Every cache created, by name, so that they can be reported on or flushed together.
+caches = {}
+
+_MISSING = object()
+
+class TTLCache:
+    """ Mapping whose entries expire `ttl` seconds after being stored, holding at most `maxsize` entries.
+
+    The least recently used entry is evicted when full. A `ttl` of None means entries only leave through eviction or
+    invalidate().
+    """
+
+    def __init__(self, name: str, ttl: float = None, maxsize: int = 128):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        caches[name] = self
+
+    def get(self, key, default = None):
+        """ Returns the cached value for `key`, or `default` if it is absent or expired. Counts a hit or a miss. """
+        return self._get(key, default, count=True)
+
+    def _get(self, key, default, count: bool):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                expiry, value = entry
+                if expiry is None or time.monotonic() < expiry:
+                    self._entries.move_to_end(key)
+                    if count:
+                        self._hits += 1
+                    return value
+                del self._entries[key]
+            if count:
+                self._misses += 1
+            return default
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def put(self, key, value):
+        with self._lock:
+            expiry = None if self.ttl is None else time.monotonic() + self.ttl
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key = _MISSING):
+        """ Drops `key`, or every entry if no key is given. """
+        with self._lock:
+            if key is _MISSING:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self)->CacheStats:
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, len(self._entries))
+
+def cached(name: str = None, ttl: float = None, maxsize: int = 128):
+    """ Decorator memoizing a function in a TTLCache, keyed on its arguments.
+
+    Concurrent calls with the same arguments wait for the first to finish instead of all calling through, which matters
+    for vendor APIs that are slow or not reentrant. Exceptions are not cached. The cache is available as `f.cache`.
+
+    Args:
+        name (str, optional): Name of the cache. Defaults to the function's qualified name.
+        ttl (float, optional): Seconds a result stays valid; None for no expiry. Defaults to None.
+        maxsize (int, optional): Maximum number of distinct argument sets kept. Defaults to 128.
+    """
+    def decorate(f):
+        cache = TTLCache(name if name is not None else f.__qualname__, ttl, maxsize)
+        key_locks = {}
+        key_locks_lock = Lock()
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            value = cache._get(key, _MISSING, count=False)
+            if value is not _MISSING:
+                cache._count(hit=True)
+                return value
+
+            with key_locks_lock:
+                key_lock = key_locks.setdefault(key, Lock())
+            with key_lock:
+                # Another caller may have filled it while we waited.
+                value = cache._get(key, _MISSING, count=False)
+                cache._count(hit=value is not _MISSING)
+                if value is _MISSING:
+                    value = f(*args, **kwargs)
+                    cache.put(key, value)
+            with key_locks_lock:
+                key_locks.pop(key, None)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorate
+
+def invalidate_all():
+    for cache in caches.values():
+        cache.invalidate()
+
+def report():
+    """ Logs the hit/miss statistics of every cache. """
+    for name, cache in caches.items():
+        s = cache.stats()
+        total = s.hits + s.misses
+        log.info('Cache %s: %d hits, %d misses (%.0f%% hit rate), %d evictions, %d entries.'%(name, s.hits, s.misses, 100.0 * s.hits / total if total else 0.0, s.evictions, s.size))
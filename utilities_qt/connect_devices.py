@@ -31,6 +31,8 @@ from PyQt5.QtCore import (pyqtSignal, QThread)
 from PyQt5.QtWidgets import (QMainWindow)
 
 # More Standard Imports
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib
 matplotlib.use('Qt5Agg')
 
@@ -85,78 +87,51 @@ class ConnectDevices(QThread):
         log.info('Motion controllers: %d'%(self.num_motion_controllers))
         self.SIGNAL_status.emit('Detectors: %d; Motion controllers: %d'%(self.num_detectors, self.num_motion_controllers))
 
-        load_increment = (10000 / (self.num_detectors + self.num_motion_controllers)) * 1.0
-        load = load_increment
-        self.SIGNAL_load_bar.emit(load)
-        log.debug('load:', load)
+        self._load_increment = (10000 / (self.num_detectors + self.num_motion_controllers)) * 1.0
+        self._load = self._load_increment
+        self._load_lock = threading.Lock()
+        self.SIGNAL_load_bar.emit(self._load)
+        log.debug('load:', self._load)
 
+        # Read the selections up front; the device manager's widgets must not be touched from the worker threads.
+        jobs = []
         for i in range(self.num_detectors):
-            log.info('Instantiation attempt for detector #%d.'%(i))
-            self.SIGNAL_status.emit(f'Establishing connection to detector {i} of {self.num_detectors}.')
-            try:
-                if self.other.UIEL_dmw_detector_qcb[i].currentIndex() != 0:
-                    log.info("Using manual port: %s"%(self.other.UIEL_dmw_detector_qcb[i].currentText().split(' ')[0]))
-                    # self.SIGNAL_status.emit("Connecting and configuring detector #%d on port %s."%(i, self.other.UIEL_dmw_detector_qcb[i].currentText().split(' ')[0]))
-                    self.SIGNAL_status.emit(f'Configuring motion controller {i} of {self.num_motion_controllers}.')
-                    self.detectors[i] = Detector(self.dummy, self.other.UIEL_dmw_detector_model_qcb[i].currentText(), self.other.UIEL_dmw_detector_qcb[i].currentText().split(' ')[0])
-
-            except Exception as e:
-                log.error(e)
-                log.error("Failed to find detector (%s)."%(e))
-                self.SIGNAL_status.emit("Failed to find detector #%d (%s)."%(i, e))
-                self.SIGNAL_qmsg_warn.emit('Connection Failure', 'Failed to find detector (%s).'%(e))
-                self.detectors[i] = None
-                detectors_connected[i] = False
-                self.SIGNAL_failure.emit()
-                return
-            if self.detectors[i] is None:
-                detectors_connected[i] = False
+            if self.other.UIEL_dmw_detector_qcb[i].currentIndex() != 0:
+                jobs.append(('detector', i, self.other.UIEL_dmw_detector_model_qcb[i].currentText(), self.other.UIEL_dmw_detector_qcb[i].currentText().split(' ')[0]))
             else:
-                detectors_connected[i] = True
-                self.SIGNAL_status.emit(f'Connected to detector {i} of {self.num_detectors}.')
-
-            load+=load_increment
-            self.SIGNAL_load_bar.emit(load)
-            log.debug('load:', load)
-
-        # for i, combo in self.dm_detector_combos:
+                self._advance_load()
         for i in range(self.num_motion_controllers):
-            log.info('Instantiation attempt for motion controller #%d.'%(i))
-            self.SIGNAL_status.emit(f'Establishing connection to motion controller {i} of {self.num_motion_controllers}.')
-            try:
-                if self.other.UIEL_dmw_mtn_ctrl_qcb[i].currentIndex() != 0:
-                    log.info("Using manual port: %s"%(self.other.UIEL_dmw_mtn_ctrl_qcb[i].currentText().split(' ')[0]))
-                    # self.SIGNAL_status.emit("Connecting and homing motion controller #%d on port %s."%(i, self.other.UIEL_dmw_mtn_ctrl_qcb[i].currentText().split(' ')[0]))
-                    log.info(self.dummy, self.other.UIEL_dmw_mtn_ctrl_model_qcb[i].currentText(), self.other.UIEL_dmw_mtn_ctrl_qcb[i].currentText().split(' ')[0])
-                    
-                    log.debug('About to call new_motion_controller().')
-                    self.SIGNAL_status.emit(f'Homing motion controller {i} of {self.num_motion_controllers}.')
-                    new_mtn_ctrls = mw.new_motion_controller(self.dummy, self.other.UIEL_dmw_mtn_ctrl_model_qcb[i].currentText(), self.other.UIEL_dmw_mtn_ctrl_qcb[i].currentText().split(' ')[0])
-                    
-                    log.debug('new_motion_controller() returned.')
-                    
-                    for ctrlr in new_mtn_ctrls:
-                        log.debug('New axis:', ctrlr)
-                        self.mtn_ctrls.append(ctrlr)
-
-            except Exception as e:
-                log.error("Failed to find motion controller #%d (%s)."%(i,e))
-                log.error(traceback.format_exc())
-                self.SIGNAL_status.emit("Failed to find motion controller (%s)."%(e))
-                self.SIGNAL_qmsg_warn.emit('Connection Failure', 'Failed to find motion controller (%s).'%(e)) 
-                self.mtn_ctrls[-1] = None
-                mtn_ctrls_connected[i] = False
-                self.SIGNAL_failure.emit()
-                return
-            if len(self.mtn_ctrls) == 0 or self.mtn_ctrls[-1] is None:
-                mtn_ctrls_connected[i] = False
+            if self.other.UIEL_dmw_mtn_ctrl_qcb[i].currentIndex() != 0:
+                jobs.append(('motion controller', i, self.other.UIEL_dmw_mtn_ctrl_model_qcb[i].currentText(), self.other.UIEL_dmw_mtn_ctrl_qcb[i].currentText().split(' ')[0]))
             else:
-                mtn_ctrls_connected[i] = True
-                self.SIGNAL_status.emit(f'Connected to motion controller {i} of {self.num_motion_controllers}.')
-
-            load+=load_increment
-            self.SIGNAL_load_bar.emit(load)
-            log.debug('load:', load)
+                self._advance_load()
+
+        # Devices on different ports connect (and home) concurrently. Devices sharing a port go one after another.
+        lanes = {}
+        for job in jobs:
+            lanes.setdefault(job[3], []).append(job)
+
+        # Axes of each motion controller, kept per controller so that the final order matches the drop-downs.
+        self._new_axes = [[] for _ in range(self.num_motion_controllers)]
+        failed = False
+        with ThreadPoolExecutor(max_workers=max(1, len(lanes)), thread_name_prefix='connect') as pool:
+            results = [pool.submit(self._connect_lane, lane) for lane in lanes.values()]
+            for result in results:
+                for kind, i, ok in result.result():
+                    failed |= not ok
+                    if kind == 'detector':
+                        detectors_connected[i] = ok
+                    else:
+                        mtn_ctrls_connected[i] = ok
+
+        for axes in self._new_axes:
+            for ctrlr in axes:
+                log.debug('New axis:', ctrlr)
+                self.mtn_ctrls.append(ctrlr)
+
+        if failed:
+            # Some device failed; the others stay connected. Stop the loading animation, then report which.
+            self.SIGNAL_failure.emit()
 
         log.info('detectors_connected:', detectors_connected)
         log.info('mtn_ctrls_connected:', mtn_ctrls_connected)
@@ -164,4 +139,40 @@ class ConnectDevices(QThread):
 
         self.other.detectors = self.detectors
         self.other.mtn_ctrls = self.mtn_ctrls
-        self.SIGNAL_complete.emit(detectors_connected, mtn_ctrls_connected)
\ No newline at end of file
+        self.SIGNAL_complete.emit(detectors_connected, mtn_ctrls_connected)
+
+    def _advance_load(self):
+        with self._load_lock:
+            self._load += self._load_increment
+            self.SIGNAL_load_bar.emit(self._load)
+            log.debug('load:', self._load)
+
+    def _connect_lane(self, lane: list)->list:
+        # Connects the devices on one port in order. Returns (kind, index, connected) for each.
+        return [(kind, i, self._connect_device(kind, i, model, port)) for kind, i, model, port in lane]
+
+    def _connect_device(self, kind: str, i: int, model: str, port: str)->bool:
+        log.info('Instantiation attempt for %s #%d.'%(kind, i))
+        log.info("Using manual port: %s"%(port))
+        try:
+            if kind == 'detector':
+                self.SIGNAL_status.emit(f'Configuring detector {i} of {self.num_detectors} on {port}.')
+                self.detectors[i] = Detector(self.dummy, model, port)
+                self.SIGNAL_status.emit(f'Connected to detector {i} of {self.num_detectors}.')
+            else:
+                log.debug('About to call new_motion_controller().')
+                self.SIGNAL_status.emit(f'Homing motion controller {i} of {self.num_motion_controllers} on {port}.')
+                self._new_axes[i] = mw.new_motion_controller(self.dummy, model, port)
+                log.debug('new_motion_controller() returned.')
+                self.SIGNAL_status.emit(f'Connected to motion controller {i} of {self.num_motion_controllers}.')
+            return True
+
+        except Exception as e:
+            log.error("Failed to find %s #%d (%s)."%(kind, i, e))
+            log.error(traceback.format_exc())
+            self.SIGNAL_status.emit("Failed to find %s #%d (%s)."%(kind, i, e))
+            self.SIGNAL_qmsg_warn.emit('Connection Failure', 'Failed to find %s #%d (%s).'%(kind, i, e))
+            return False
+
+        finally:
+            self._advance_load()
@@ -123,14 +123,30 @@ class DataTableWidget(QTableWidget):
             self._internal_insert_exec = False
             return ret
         else:
-            if isinstance(xdata, float):
-                xdata = np.array([xdata], dtype=float)
-            if isinstance(ydata, float):
-                ydata = np.array([ydata], dtype=float)
-            log.debug(f"Appending {xdata} to the end of {self.recordedData[(global_scan_id, det_idx)]['x']} for global_scan_id {global_scan_id}")
-            self.recordedData[(global_scan_id, det_idx)]['x'] = np.concatenate((self.recordedData[(global_scan_id, det_idx)]['x'], xdata))
-            log.debug(f"Appending {ydata} to the end of {self.recordedData[(global_scan_id, det_idx)]['y']} for global_scan_id {global_scan_id}")
-            self.recordedData[(global_scan_id, det_idx)]['y'] = np.concatenate((self.recordedData[(global_scan_id, det_idx)]['y'], ydata))
+            xdata = np.atleast_1d(np.asarray(xdata, dtype=float))
+            ydata = np.atleast_1d(np.asarray(ydata, dtype=float))
+            x = self.recordedData[(global_scan_id, det_idx)]['x']
+            y = self.recordedData[(global_scan_id, det_idx)]['y']
+            # Adaptive scans go back to add points between earlier ones; those are placed in order so plots stay monotonic.
+            if len(x) > 1 and np.any((xdata > min(x[0], x[-1])) & (xdata < max(x[0], x[-1]))):
+                for xi, yi in zip(xdata, ydata):
+                    if len(x) > 1 and min(x[0], x[-1]) < xi < max(x[0], x[-1]):
+                        if x[-1] > x[0]:
+                            at = np.searchsorted(x, xi)
+                        else:
+                            at = len(x) - np.searchsorted(x[::-1], xi)
+                    else:
+                        at = len(x)
+                    log.debug(f"Inserting {xi} at index {at} for global_scan_id {global_scan_id}")
+                    x = np.insert(x, at, xi)
+                    y = np.insert(y, at, yi)
+                self.recordedData[(global_scan_id, det_idx)]['x'] = x
+                self.recordedData[(global_scan_id, det_idx)]['y'] = y
+            else:
+                log.debug(f"Appending {xdata} to the end of {x} for global_scan_id {global_scan_id}")
+                self.recordedData[(global_scan_id, det_idx)]['x'] = np.concatenate((x, xdata))
+                log.debug(f"Appending {ydata} to the end of {y} for global_scan_id {global_scan_id}")
+                self.recordedData[(global_scan_id, det_idx)]['y'] = np.concatenate((y, ydata))
             self.updateTableDisplay(det_idx, global_scan_id, name_editable=False)
         return global_scan_id
 
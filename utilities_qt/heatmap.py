@@ -0,0 +1,109 @@
+#
+# @file heatmap.py
+# @author Mit Bailey (mitbailey@outlook.com)
+# @brief Live heatmap window for grid scans.
+# @version See Git tags for version information.
+# @date 2026.10.19
+#
+# @copyright Copyright (c) 2022
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import (QMainWindow, QVBoxLayout, QWidget)
+
+import numpy as np
+import matplotlib
+matplotlib.use('Qt5Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
+
+from utilities import log
+
+class HeatmapWindow(QMainWindow):
+    """ Shows a grid scan as it fills in, one heatmap per detector.
+
+    The two innermost axes are plotted; for grids of more than two dimensions, the slice containing the latest point
+    is shown. Unmeasured cells are blank.
+    """
+
+    # Redraws are coalesced to at most this many per second; points can arrive much faster.
+    REDRAW_HZ = 5
+
+    def __init__(self, title: str, axis_names: list, axis_values: list, detector_names: list, parent = None):
+        super(HeatmapWindow, self).__init__(parent)
+        self.setWindowTitle(title)
+
+        self.axis_names = axis_names
+        self.axis_values = [np.asarray(v) for v in axis_values]
+        shape = tuple(len(v) for v in self.axis_values)
+        self.data = [np.full(shape, np.nan) for _ in detector_names]
+        self._slice = (0,) * (len(shape) - 2)
+        self._dirty = False
+
+        fig = Figure(figsize=(5 * len(detector_names), 4), dpi=100, tight_layout=True)
+        self.canvas = FigureCanvasQTAgg(fig)
+        self._images = []
+        for i, name in enumerate(detector_names):
+            ax = fig.add_subplot(1, len(detector_names), i + 1)
+            y, x = self.axis_values[-2], self.axis_values[-1]
+            image = ax.imshow(self.data[i][self._slice], origin='lower', aspect='auto', interpolation='nearest', extent=HeatmapWindow._extent(x, y))
+            ax.set_xlabel(axis_names[-1])
+            ax.set_ylabel(axis_names[-2])
+            ax.set_title(name)
+            fig.colorbar(image, ax=ax)
+            self._images.append(image)
+
+        layout = QVBoxLayout()
+        layout.addWidget(NavigationToolbar2QT(self.canvas, self))
+        layout.addWidget(self.canvas)
+        widget = QWidget()
+        widget.setLayout(layout)
+        self.setCentralWidget(widget)
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._redraw)
+        self._timer.start(int(1000 / HeatmapWindow.REDRAW_HZ))
+
+    @staticmethod
+    def _extent(x, y):
+        # Cell edges, so that each cell is centred on its position.
+        dx = (x[-1] - x[0]) / (len(x) - 1) if len(x) > 1 else 1
+        dy = (y[-1] - y[0]) / (len(y) - 1) if len(y) > 1 else 1
+        return (x[0] - dx / 2, x[-1] + dx / 2, y[0] - dy / 2, y[-1] + dy / 2)
+
+    def update_point(self, det_idx: int, index: tuple, value: float):
+        if det_idx >= len(self.data):
+            log.error('Heatmap has no detector %d.'%(det_idx))
+            return
+        self.data[det_idx][tuple(index)] = value
+        self._slice = tuple(index[:-2])
+        self._dirty = True
+
+    def _redraw(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        for image, data in zip(self._images, self.data):
+            plane = data[self._slice]
+            image.set_data(plane)
+            if np.any(np.isfinite(plane)):
+                image.set_clim(np.nanmin(plane), np.nanmax(plane))
+        self.canvas.draw_idle()
+
+    def closeEvent(self, event):
+        self._timer.stop()
+        super(HeatmapWindow, self).closeEvent(event)
@@ -26,6 +26,7 @@
 import os
 import sys
 import time
+import threading
 
 # PyQt Imports
 from PyQt5.QtCore import (pyqtSignal, QThread)
@@ -36,6 +37,7 @@ from time import sleep
 # import weakref
 import numpy as np
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 # from functools import partial
 from enum import Enum
 
@@ -44,25 +46,22 @@ matplotlib.use('Qt5Agg')
 
 from utilities import version
 from utilities import log
-
-class ScanAxis(Enum):
-    MAIN = 0
-    SAMPLE = 1
-    DETECTOR = 2
-    MULTI = 3
-
-class SampleScanType(Enum):
-    ROTATION = 0
-    TRANSLATION = 1
-    THETA2THETA = 2 
+from utilities.scan_plan import ScanPlan, ScanPlanError, GridPlan
+from utilities.scan_engine import ScanAxis, SampleScanType, ScanEngine, GridEngine, ScanSink, CsvSink, GridCsvSink, CheckpointSink, prep_position
+from utilities.queue_compiler import AXIS_CODES, RUN_AXES, QUEUE_RESOURCES, QueueTask, build_graph
 
 class Scan(QThread):
+    """Runs the scan set up in the main window.
+
+    A thin adapter around ScanEngine: it reads the scan from the GUI, compiles it and sets up the sinks, then forwards
+    the engine's events to the main window as Qt signals.
+    """
     SIGNAL_status_update = pyqtSignal(str)
     SIGNAL_progress = pyqtSignal(int, float)
     SIGNAL_complete = pyqtSignal()
 
     SIGNAL_data_begin = pyqtSignal(int, int, int, dict) # scan index, which detector, redundant
-    SIGNAL_data_update = pyqtSignal(int, int, int, float, float) # scan index, which detector, xdata, ydata (to be appended into index)
+    SIGNAL_data_chunk = pyqtSignal(int, int, list, object, object) # which detector, scan index, detector indices, xdata, ydata (points x detectors, to be appended)
     SIGNAL_data_complete = pyqtSignal(int, int, str) # scan index, which detector, redundant
 
     SIGNAL_error = pyqtSignal(str, str)
@@ -74,7 +73,7 @@ class Scan(QThread):
         self.SIGNAL_progress.connect(self.other.scan_progress)
         self.SIGNAL_complete.connect(self.other.scan_complete)
         self.SIGNAL_data_begin.connect(self.other.scan_data_begin)
-        self.SIGNAL_data_update.connect(self.other.scan_data_update)
+        self.SIGNAL_data_chunk.connect(self.other.scan_data_chunk)
         self.SIGNAL_data_complete.connect(self.other.scan_data_complete)
         self.SIGNAL_error.connect(self.other.QMessageBoxCritical)
         log.debug('mainWindow reference in scan init: %d'%(sys.getrefcount(self.other) - 1))
@@ -83,6 +82,12 @@ class Scan(QThread):
         self.internal_scan_no = 0
         self.done = True
 
+        # The ScanEngine of the current or last scan; holds its data.
+        self.engine = None
+
+        # Set to a checkpoint.ResumeState before starting to resume an interrupted scan; see run().
+        self.resume = None
+
     def __del__(self):
         self.wait()
 
@@ -90,8 +95,13 @@ class Scan(QThread):
         self.ctrl_axis = ctrl_axis
         self.start()
 
-    # def run(self, ctrl_axis: ScanAxis):
     def run(self):
+        try:
+            self._run_scan()
+        finally:
+            self.done = True
+
+    def _run_scan(self):
         ctrl_axis = self.ctrl_axis
 
         which_detector = self.other.UIE_mgw_enabled_detectors_qcb.currentIndex()
@@ -100,332 +110,358 @@ class Scan(QThread):
         else:
             active_detectors = [self.other.detectors[which_detector - 1]]
 
-        log.debug('self.other.detectors: %s'%(self.other.detectors))
         log.debug('active_detectors: %s'%(active_detectors))
         log.debug('which detector: %d'%(which_detector))
-        log.debug('qcb index: %d'%(self.other.UIE_mgw_enabled_detectors_qcb.currentIndex()))
 
         self.other.disable_movement_sensitive_buttons(True)
-        log.debug(self.other)
         log.info("Save to file? " + str(self.other.autosave_data_bool))
         self.SIGNAL_status_update.emit("PREPARING")
-        sav_files = []
         tnow = dt.datetime.now()
-        
-        if (self.other.autosave_data_bool):
-            log.info('Autosaving')
-            filetime = tnow.strftime('%Y%m%d%H%M%S')
-
-            for i, detector in enumerate(active_detectors):
-                filename = '%s%s_%s_%d_data.csv'%(self.other.data_save_directory, filetime, detector.short_name(), i)
-                os.makedirs(os.path.dirname(filename), exist_ok=True)
-                sav_files.append(open(filename, 'w'))
 
-        if ctrl_axis == ScanAxis.MAIN:
-            start = self.other.UIE_mgw_start_qdsb.value()
-            stop = self.other.UIE_mgw_stop_qdsb.value()
-            step = self.other.UIE_mgw_step_qdsb.value()
-        elif ctrl_axis == ScanAxis.SAMPLE:
-            start = self.other.UIE_mgw_sm_start_set_qdsb.value()
-            stop = self.other.UIE_mgw_sm_end_set_qdsb.value()
-            step = self.other.UIE_mgw_sm_step_set_qdsb.value()
-        elif ctrl_axis == ScanAxis.DETECTOR:
-            start = self.other.UIE_mgw_dm_start_set_qdsb.value()
-            stop = self.other.UIE_mgw_dm_end_set_qdsb.value()
-            step = self.other.UIE_mgw_dm_step_set_qdsb.value()
-
-        log.info("SCAN QTHREAD")
+        start, stop, step = self._scan_range(ctrl_axis)
         log.info("Start | Stop | Step")
         log.info(start, stop, step)
 
+        scan_type = SampleScanType(self.other.UIE_mgw_sm_scan_type_qcb.currentIndex())
+
+        # Resume data from a checkpoint is only used if it describes this same scan.
+        resume, self.resume = self.resume, None
+        params = {'ctrl_axis': ctrl_axis.name, 'scan_type': scan_type.value, 'start': start, 'stop': stop, 'step': step, 'which_detector': which_detector}
+        if resume is not None and any(resume.scan.get(key) != value for key, value in params.items()):
+            log.warn('Checkpoint does not match this scan; starting from the beginning.')
+            resume = None
+
+        filenames = []
+        append = False
+        if (self.other.autosave_data_bool):
+            log.info('Autosaving')
+            if resume is not None and len(resume.scan.get('files', [])) == len(active_detectors):
+                # Carry on in the files the interrupted scan was writing; they hold its completed points.
+                filenames = list(resume.scan['files'])
+                append = True
+            else:
+                filetime = tnow.strftime('%Y%m%d%H%M%S')
+                for i, detector in enumerate(active_detectors):
+                    filenames.append('%s%s_%s_%d_data.csv'%(self.other.data_save_directory, filetime, detector.short_name(), i))
+        params['files'] = filenames
+
         if step == 0 or start == stop:
-            for f in sav_files:
-                if (f is not None):
-                    f.close()
             self.SIGNAL_complete.emit()
             return
-        
-        scanrange = np.arange(start, stop + step, step)
-        log.info("Scan Range: %s"%(scanrange))
-        nidx = len(scanrange)
-
-        scan_type = SampleScanType(self.other.UIE_mgw_sm_scan_type_qcb.currentIndex())
-
-        short_name = ''
 
         try:
-            if ctrl_axis == ScanAxis.MAIN:
-                short_name = self.other.motion_controllers.main_drive_axis.short_name()
-            elif ctrl_axis == ScanAxis.SAMPLE:
-                short_name = self.other.motion_controllers.sample_rotation_axis.short_name()
-            elif ctrl_axis == ScanAxis.DETECTOR:
-                short_name = self.other.motion_controllers.detector_rotation_axis.short_name()
-            else:
-                log.error(f'Invalid control axis ({ctrl_axis}; {scan_type}).')
+            plan_axes = self._plan_axes(ctrl_axis, scan_type)
+            if len(plan_axes) == 0:
+                raise RuntimeError(f'Invalid control axis ({ctrl_axis}; {scan_type}).')
+            short_name = plan_axes[0][0].short_name()
         except Exception as e:
             log.error('Exception: Short Name Acquisition Failure - Failed to find axis short name: %s'%(e))
             self.SIGNAL_error.emit('Short Name Acquisition Failure', 'Failed to find axis short name: %s'%(e))
             self.SIGNAL_complete.emit()
             return
 
-        # Partial zeroing manuever.
-        self.SIGNAL_status_update.emit("ZEROING")
-        prep_pos = start * 0.85
-
-        # Only perform zeroing manuever if we are the KST-x01.
-        if 'KST' in short_name: # only do zeroing if its a KST-x01.
-            # MOVES TO ZERO PRIOR TO BEGINNING A SCAN
-            self.SIGNAL_status_update.emit("ZEROING")
-            # prep_pos = int((0 + self.other.zero_ofst))
-
-            prep_pos = 0
+        prep_pos = prep_position(plan_axes[0][0], start)
 
+        # Every point is checked against every axis before anything moves, so a bad range fails here rather than
+        # part-way through the scan.
         try:
-            log.info('107: Moving to', prep_pos)
-
-            log.debug('ctrl_axis: %s'%(ctrl_axis))
-            log.debug('scan_type: %s'%(scan_type))
-
-            if ctrl_axis == ScanAxis.MAIN:
-                log.info('ctrl_axis == ScanAxis.MAIN')
-                self.other.motion_controllers.main_drive_axis.move_to(prep_pos, True)
-                log.info('Complete move command.')
-            elif ctrl_axis == ScanAxis.SAMPLE:
-                log.info('ctrl_axis == ScanAxis.SAMPLE')
-                if scan_type == SampleScanType.ROTATION:
-                    log.info('scan_type == SampleScanType.ROTATION')
-                    self.other.motion_controllers.sample_rotation_axis.move_to(prep_pos, True)
-                elif scan_type == SampleScanType.TRANSLATION:
-                    log.info('scan_type == SampleScanType.TRANSLATION')
-                    self.other.motion_controllers.sample_translation_axis.move_to(prep_pos, True)
-                elif scan_type == SampleScanType.THETA2THETA:
-                    log.info('scan_type == SampleScanType.THETA2THETA')
-                    self.other.motion_controllers.sample_rotation_axis.move_to(prep_pos, True)
-                    self.other.motion_controllers.detector_rotation_axis.move_to(prep_pos * 2, True)
-                else:
-                    log.error(f'Invalid scan type for control axis: sample ({ctrl_axis}; {scan_type}).')
-            elif ctrl_axis == ScanAxis.DETECTOR:
-                log.info('ctrl_axis == ScanAxis.DETECTOR')
-                self.other.motion_controllers.detector_rotation_axis.move_to(prep_pos, True)
-            else:
-                log.error(f'Invalid control axis ({ctrl_axis}; {scan_type}).')
-
-            log.info('109: Done with', prep_pos)
-        except Exception as e:
-            log.error('Exception: Move Failure - Axis failed to move: %s'%(e))
-            self.SIGNAL_error.emit('Move Failure', 'Axis failed to move: %s'%(e))
+            plan = ScanPlan.compile(start, stop, step, plan_axes, active_detectors, prep_pos)
+        except ScanPlanError as e:
+            for problem in e.problems:
+                log.error('Scan plan: %s'%(problem))
+            self.SIGNAL_error.emit('Invalid Scan', str(e))
             self.SIGNAL_complete.emit()
             return
-            
-        log.info('Holding for 1 second.')
-
-        self.SIGNAL_status_update.emit("HOLDING")
-        sleep(1)
+        log.info("Scan Range: %s"%(plan.values))
+        log.info('Scan plan: %d points, about %.0f s.'%(len(plan), plan.duration()))
 
-        log.info('Held for 1 second.')
-
-        self._xdata = []
-        self._ydata = []
-
-        log.info('Creating data arrays for detectors.')
+        self.last_global_scan_id = self.other.global_scan_id
+        log.info('Global Scan ID:', self.other.global_scan_id)
+        log.info('Internal Scan No:', self.internal_scan_no)
 
-        for detector in active_detectors:
-            self._xdata.append([])
-            self._ydata.append([])
+        steps_per_value = plan_axes[0][0].get_steps_per_value()
+        metadata = {'tstamp': tnow, 'steps_per_value': steps_per_value, 'mm_per_nm': 0, 'lam_0': self.other.zero_ofst, 'scan_id': self.last_global_scan_id}
+
+        # The GUI first, then the data files, then the checkpoint, which must only record points already on disk.
+        signal_sink = _SignalSink(self, which_detector, metadata, self.other.scan_update_rate)
+        sinks = [signal_sink]
+        if len(filenames) > 0:
+            sinks.append(CsvSink(filenames, steps_per_value, self.other.zero_ofst, tnow, append))
+        sinks.append(CheckpointSink(self.other.checkpoint, params))
+
+        self.engine = ScanEngine(plan, active_detectors, sinks,
+                                 prep=prep_pos,
+                                 fly=ctrl_axis == ScanAxis.MAIN and self.other.fly_scan,
+                                 adaptive=self.other.adaptive_scan,
+                                 mes_sign=self.other.mes_sign,
+                                 start_delay=self.other.scan_start_delay,
+                                 done_points=resume.points if resume is not None else None,
+                                 keep_running=lambda: self.other.scanRunning)
+        # The main window, and any queue waiting on this scan, rely on SIGNAL_complete whatever happens in the engine.
+        try:
+            self.engine.run()
+        except Exception as e:
+            log.error('Exception: Scan Failure - The scan did not finish cleanly: %s'%(e))
+            self.SIGNAL_error.emit('Scan Failure', 'The scan did not finish cleanly: %s'%(e))
 
-        log.info('Getting scan ID.')
+        if signal_sink.began:
+            self.other.num_scans += 1
+            self.SIGNAL_complete.emit()
+            self.SIGNAL_data_complete.emit(which_detector, self.last_global_scan_id, 'main')
+        else:
+            self.SIGNAL_complete.emit()
 
-        # self._scan_id = self.other.table_list[0].scanId
-        # self._scan_id = self.other.global_scan_id
-        self.last_global_scan_id = self.other.global_scan_id
+        log.debug('mainWindow reference in scan end: %d'%(sys.getrefcount(self.other) - 1))
 
-        log.info('Global Scan ID:', self.other.global_scan_id)
-        log.info('Internal Scan No:', self.internal_scan_no)
+    def _scan_range(self, ctrl_axis: ScanAxis) -> tuple:
+        # (start, stop, step) from the spinboxes of the scanned axis.
+        if ctrl_axis == ScanAxis.SAMPLE:
+            return self.other.UIE_mgw_sm_start_set_qdsb.value(), self.other.UIE_mgw_sm_end_set_qdsb.value(), self.other.UIE_mgw_sm_step_set_qdsb.value()
+        elif ctrl_axis == ScanAxis.DETECTOR:
+            return self.other.UIE_mgw_dm_start_set_qdsb.value(), self.other.UIE_mgw_dm_end_set_qdsb.value(), self.other.UIE_mgw_dm_step_set_qdsb.value()
+        return self.other.UIE_mgw_start_qdsb.value(), self.other.UIE_mgw_stop_qdsb.value(), self.other.UIE_mgw_step_qdsb.value()
 
+    def _plan_axes(self, ctrl_axis: ScanAxis, scan_type: SampleScanType) -> list:
+        # The (MotionController, scale) pairs moved at each point, as ScanPlan.compile() expects them.
+        mcs = self.other.motion_controllers
         if ctrl_axis == ScanAxis.MAIN:
-            metadata = {'tstamp': tnow, 'steps_per_value': self.other.motion_controllers.main_drive_axis.get_steps_per_value(), 'mm_per_nm': 0, 'lam_0': self.other.zero_ofst, 'scan_id': self.last_global_scan_id}
+            return [(mcs.main_drive_axis, 1)]
         elif ctrl_axis == ScanAxis.SAMPLE:
             if scan_type == SampleScanType.ROTATION:
-                metadata = {'tstamp': tnow, 'steps_per_value': self.other.motion_controllers.sample_rotation_axis.get_steps_per_value(), 'mm_per_nm': 0, 'lam_0': self.other.zero_ofst, 'scan_id': self.last_global_scan_id}
+                return [(mcs.sample_rotation_axis, 1)]
             elif scan_type == SampleScanType.TRANSLATION:
-                metadata = {'tstamp': tnow, 'steps_per_value': self.other.motion_controllers.sample_translation_axis.get_steps_per_value(), 'mm_per_nm': 0, 'lam_0': self.other.zero_ofst, 'scan_id': self.last_global_scan_id}
+                return [(mcs.sample_translation_axis, 1)]
             elif scan_type == SampleScanType.THETA2THETA:
-                metadata = {'tstamp': tnow, 'steps_per_value': self.other.motion_controllers.sample_rotation_axis.get_steps_per_value(), 'mm_per_nm': 0, 'lam_0': self.other.zero_ofst, 'scan_id': self.last_global_scan_id}
-            else:
-                log.error(f'Invalid scan type for control axis: sample ({ctrl_axis}; {scan_type}).')
+                return [(mcs.sample_rotation_axis, 1), (mcs.detector_rotation_axis, 2)]
         elif ctrl_axis == ScanAxis.DETECTOR:
-            metadata = {'tstamp': tnow, 'steps_per_value': self.other.motion_controllers.detector_rotation_axis.get_steps_per_value(), 'mm_per_nm': 0, 'lam_0': self.other.zero_ofst, 'scan_id': self.last_global_scan_id}
-        else:
-            log.error(f'Invalid control axis ({ctrl_axis}; {scan_type}).')
+            return [(mcs.detector_rotation_axis, 1)]
+        return []
+
+class _SignalSink(ScanSink):
+    # Forwards a ScanEngine's events to a Scan's signals, which deliver them on the GUI thread. Points and progress are
+    # coalesced and sent at most `rate` times per second, so a fast scan cannot flood the GUI's event queue.
+
+    def __init__(self, scan: Scan, which_detector: int, metadata: dict, rate: float):
+        self.scan = scan
+        self.which_detector = which_detector
+        self.metadata = metadata
+        self.period = 1.0 / rate if rate > 0 else 0.0
+        self.began = False
+        self._det_idx = []
+        self._lock = threading.Lock()
+        self._rows = []
+        self._progress = None
+        self._last_flush = 0.0
+        self._timer = None
+
+    def begin(self, engine):
+        self.began = True
+        # Detectors are identified by their index in the main window's list, not among the active ones.
+        self._det_idx = [self.scan.other.detectors.index(det) for det in engine.detectors]
+        for det_idx in self._det_idx:
+            self.scan.SIGNAL_data_begin.emit(self.which_detector, det_idx, self.scan.last_global_scan_id, self.metadata)
+
+    def status(self, text: str):
+        self.scan.SIGNAL_status_update.emit(text)
+
+    def point(self, value: float, positions: list, rows: list, restored: bool = False):
+        with self._lock:
+            self._rows.append([(row[0], row[1]) for row in rows])
+            self._schedule()
+
+    def progress(self, percent: float, remaining: float):
+        with self._lock:
+            self._progress = (percent, remaining)
+            self._schedule()
+
+    def error(self, title: str, message: str):
+        self.flush()
+        self.scan.SIGNAL_error.emit(title, message)
+
+    def end(self, failed: bool):
+        self.flush()
+
+    # Called with the lock held. Flushes now if a frame has passed since the last flush, otherwise makes sure a flush
+    # is due at the end of the frame.
+    def _schedule(self):
+        wait_s = self._last_flush + self.period - time.time()
+        if wait_s <= 0:
+            self._flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(wait_s, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    # Called with the lock held.
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._last_flush = time.time()
+        if len(self._rows) > 0:
+            chunk = np.array(self._rows, dtype=float)
+            self._rows = []
+            self.scan.SIGNAL_data_chunk.emit(self.which_detector, self.scan.last_global_scan_id, self._det_idx, chunk[:, :, 0], chunk[:, :, 1])
+        if self._progress is not None:
+            percent, remaining = self._progress
+            self._progress = None
+            self.scan.SIGNAL_progress.emit(int(percent), remaining)
+
+class GridScan(QThread):
+    """Multi-axis (ScanAxis.MULTI) grid scan, e.g. sample translation x wavelength.
+
+    A thin adapter around GridEngine, which walks the grid in serpentine order (see GridPlan). Each detector's results
+    are written to a CSV, and a .npz of its grid arrays at the end; SIGNAL_grid_update feeds the live heatmap.
+    """
+    SIGNAL_status_update = pyqtSignal(str)
+    SIGNAL_progress = pyqtSignal(int, float)
+    SIGNAL_complete = pyqtSignal()
+
+    SIGNAL_grid_begin = pyqtSignal(list, list, list) # axis names, axis positions, detector names
+    SIGNAL_grid_update = pyqtSignal(int, tuple, float) # active detector index, grid index, value
 
+    SIGNAL_error = pyqtSignal(str, str)
+
+    def __init__(self, parent: QMainWindow):
+        super(GridScan, self).__init__()
+        self.other: MMC_Main = parent
+        self.SIGNAL_status_update.connect(self.other.scan_status_update)
+        self.SIGNAL_progress.connect(self.other.scan_progress)
+        self.SIGNAL_complete.connect(self.other.scan_complete)
+        self.SIGNAL_grid_begin.connect(self.other.grid_data_begin)
+        self.SIGNAL_grid_update.connect(self.other.grid_data_update)
+        self.SIGNAL_error.connect(self.other.QMessageBoxCritical)
+        self._axes = []
+        self.done = True
+
+        # The GridEngine of the current or last grid scan; holds its data.
+        self.engine = None
+
+        # Set to a checkpoint.ResumeState before starting to resume an interrupted grid scan; see run().
+        self.resume = None
+
+    def set_grid(self, axes: list):
+        """Sets the grid to scan.
+
+        Args:
+            axes (list): (axis code, start, stop, step) per grid axis, outermost first. Axis codes are those of the
+                queue file: MDA, SRA, SAA, STA or DRA.
+        """
+        self._axes = axes
+
+    def run(self):
         try:
-            time.sleep(self.other.scan_start_delay)
-        except Exception as e:
-            log.error('Exception: Scan Start Delay - Failed to sleep: %s'%(e))
+            self._run_grid()
+        finally:
+            self.done = True
 
-        log.info('Emitting data begin signal.')
+    def _run_grid(self):
+        which_detector = self.other.UIE_mgw_enabled_detectors_qcb.currentIndex()
+        if which_detector == 0:
+            active_detectors = self.other.detectors
+        else:
+            active_detectors = [self.other.detectors[which_detector - 1]]
 
-        # This ensures that the 'i' is the index of the detector in the Main GUI's list, not just always 0 if we only have one active detector.
-        for det_idx, det in enumerate(self.other.detectors):
-            if det in active_detectors:
-                self.SIGNAL_data_begin.emit(which_detector, det_idx, self.last_global_scan_id, metadata)
+        self.SIGNAL_status_update.emit("PREPARING")
 
-        # log.info('Waiting for scan ID to change.')
+        try:
+            spec = []
+            for code, start, stop, step in self._axes:
+                mc = getattr(self.other.motion_controllers, AXIS_CODES[code])
+                if mc is None:
+                    raise RuntimeError('Axis %s is not connected.'%(code))
+                spec.append((mc, start, stop, step))
+            if len(spec) < 2:
+                raise RuntimeError('A grid scan needs at least two axes.')
+            plan = GridPlan.compile(spec, active_detectors)
+        except (KeyError, RuntimeError, ScanPlanError) as e:
+            log.error('Grid scan: %s'%(e))
+            self.SIGNAL_error.emit('Invalid Grid Scan', str(e))
+            self.SIGNAL_complete.emit()
+            return
 
-        # while self.scanId == self.other.table_list[0].scanId: # spin until that happens
-        #     continue``
+        log.info('Grid scan: %s points (%s), about %.0f s.'%(len(plan), ' x '.join(str(n) for n in plan.shape), plan.duration()))
 
-        start = time.time()
-        task_i = 0
-        for idx, dpos in enumerate(scanrange):
-            log.debug('STARTING SCAN LOOP SECTION')
+        codes = [axis[0] for axis in self._axes]
+        tnow = dt.datetime.now()
 
-            if not self.other.scanRunning:
-                log.error('scanRunning False, stop button may have been pressed (A). Scan stopped before it started.')
-                break
-            self.SIGNAL_status_update.emit("MOVING")
-            
-            try:
-                log.debug('138: Moving to', dpos)
-                log.debug('MOVING TO')
-
-                if ctrl_axis == ScanAxis.MAIN:
-                    self.other.motion_controllers.main_drive_axis.move_to(dpos, True)
-                elif ctrl_axis == ScanAxis.SAMPLE:
-                    if scan_type == SampleScanType.ROTATION:
-                        self.other.motion_controllers.sample_rotation_axis.move_to(dpos, True)
-                    elif scan_type == SampleScanType.TRANSLATION:
-                        self.other.motion_controllers.sample_translation_axis.move_to(dpos, True)
-                    elif scan_type == SampleScanType.THETA2THETA:
-                        self.other.motion_controllers.sample_rotation_axis.move_to(dpos, True)
-                        self.other.motion_controllers.detector_rotation_axis.move_to(dpos * 2, True)
-                elif ctrl_axis == ScanAxis.DETECTOR:
-                    self.other.motion_controllers.detector_rotation_axis.move_to(dpos, True)
-                
-                log.debug('DONE MOVING TO')
-
-                log.debug('140: Done with', dpos)
-            except Exception as e:
-                log.error('QMessageBox.Critical: Move Failure - Axis failed to move: %s'%(e))
-                self.SIGNAL_error.emit('Move Failure', 'Axis failed to move: %s'%(e))
-                break
-            log.debug("Getting axis position.")
-
-            log.debug('GETTING POSITION')
-
-            if ctrl_axis == ScanAxis.MAIN:
-                pos = self.other.motion_controllers.main_drive_axis.get_position()
-            elif ctrl_axis == ScanAxis.SAMPLE:
-                if scan_type == SampleScanType.ROTATION:
-                    pos = self.other.motion_controllers.sample_rotation_axis.get_position()
-                elif scan_type == SampleScanType.TRANSLATION:
-                    pos = self.other.motion_controllers.sample_translation_axis.get_position()
-                elif scan_type == SampleScanType.THETA2THETA:
-                    pos = self.other.motion_controllers.sample_rotation_axis.get_position()
-                    det_pos = self.other.motion_controllers.detector_rotation_axis.get_position()
-            elif ctrl_axis == ScanAxis.DETECTOR:
-                pos = self.other.motion_controllers.detector_rotation_axis.get_position()
-
-            log.debug('DONE GETTING POSITION')
-
-            log.debug("Emitting status update signal SAMPLING.")
-            self.SIGNAL_status_update.emit("SAMPLING")
-
-            i=0
-            log.debug("Beginning loop.")
-            for i, detector in enumerate(active_detectors):
-                task_i += 1
-                mes = detector.detect()
-                log.debug(mes)
-
-                # idx: index of which step in the scan
-                # nidx: total num of steps
-
-                log.debug(f"Emitting progress signal: {((task_i) / (nidx * len(active_detectors))) * 100.0}")
-                log.debug(f"Progress signal components: task_i: {task_i}, nidx: {nidx}, len(active_detectors): {len(active_detectors)}")
-                elapsed_time = time.time() - start
-                percent_done = (task_i / (nidx * len(active_detectors)))
-                remaining_time = elapsed_time / percent_done - elapsed_time
-                self.SIGNAL_progress.emit( int((task_i / (nidx * len(active_detectors))) * 100.0), remaining_time )
-                # First half is wrong 2nd half is fine
-                # It should be 
-                
-                log.debug("Appending data.")
-                if (i != 0) and (ctrl_axis == ScanAxis.SAMPLE) and (scan_type == SampleScanType.THETA2THETA):
-                    log.debug(f"Appending detector position {det_pos}")
-                    self._xdata[i].append((((det_pos))))
-                else:
-                    log.debug(f"Appending position {pos}")
-                    self._xdata[i].append((((pos))))
-                self._ydata[i].append(self.other.mes_sign * mes)
-                log.debug(f'_ydata[i][-1]: {self._ydata[i][-1]}')
-                
-                # Find what detector index we are currently dealing with.
-                det_idx = -1
-                for j, det in enumerate(self.other.detectors):
-                    if det == detector:
-                        det_idx = j
-                if det_idx == -1:
-                    log.error('Could not find detector index.')
-                self.SIGNAL_data_update.emit(which_detector, self.last_global_scan_id, det_idx, self._xdata[i][-1], self._ydata[i][-1])
-
-                log.debug(sav_files)
-                if len(sav_files) > 0 and sav_files[i] is not None:
-                    if idx == 0:
-                        log.debug(f"Save files [{i}]")
-                        sav_files[i].write('# DATA RECORDED IN SOFTWARE VERSION: %sv%s\n'%(version.__short_name__, version.__version__))
-                        sav_files[i].write('# %s\n'%(tnow.strftime('%Y-%m-%d %H:%M:%S')))
-
-                        if ctrl_axis == ScanAxis.MAIN:
-                            sav_files[i].write('# Steps/mm: %f\n'%(self.other.motion_controllers.main_drive_axis.get_steps_per_value()))
-                        elif ctrl_axis == ScanAxis.SAMPLE:
-                            if scan_type == SampleScanType.ROTATION:
-                                sav_files[i].write('# Steps/mm: %f\n'%(self.other.motion_controllers.sample_rotation_axis.get_steps_per_value()))
-                            elif scan_type == SampleScanType.TRANSLATION:
-                                sav_files[i].write('# Steps/mm: %f\n'%(self.other.motion_controllers.sample_translation_axis.get_steps_per_value()))
-                            elif scan_type == SampleScanType.THETA2THETA:
-                                sav_files[i].write('# Steps/mm: %f\n'%(self.other.motion_controllers.sample_rotation_axis.get_steps_per_value()))
-                        elif ctrl_axis == ScanAxis.DETECTOR:
-                            sav_files[i].write('# Steps/mm: %f\n'%(self.other.motion_controllers.detector_rotation_axis.get_steps_per_value()))
-                        
-                        sav_files[i].write('# mm/nm: %e; lambda_0 (nm): %e\n'%(0, self.other.zero_ofst))
-                        sav_files[i].write('# Position (step),Position (nm),Mean Current(A),Status/Error Code\n')
-                    # process buf
-                    # 1. split by \n
-
-                    buf = '%d,%e,%e\n'%(pos, ((pos)) - self.other.zero_ofst, self.other.mes_sign * mes)
-                    sav_files[i].write(buf)
-
-                i += 1
-
-                log.debug('DONE LOOP SECTION')
-
-        for sav_file in sav_files:
-            if (sav_file is not None):
-                sav_file.close()
-        self.other.num_scans += 1
+        # Resume data from a checkpoint is only used if it describes this same grid.
+        resume, self.resume = self.resume, None
+        params = {'grid': [[code, float(start), float(stop), float(step)] for code, start, stop, step in self._axes], 'which_detector': which_detector}
+        if resume is not None and any(resume.scan.get(key) != value for key, value in params.items()):
+            log.warn('Checkpoint does not match this grid scan; starting from the beginning.')
+            resume = None
+
+        filenames = []
+        append = False
+        if self.other.autosave_data_bool:
+            if resume is not None and len(resume.scan.get('files', [])) == len(active_detectors):
+                # Carry on in the files the interrupted grid scan was writing; they hold its completed points.
+                filenames = list(resume.scan['files'])
+                append = True
+            else:
+                filetime = tnow.strftime('%Y%m%d%H%M%S')
+                filenames = ['%s%s_%s_%d_grid_data.csv'%(self.other.data_save_directory, filetime, detector.short_name(), i) for i, detector in enumerate(active_detectors)]
+        params['files'] = filenames
+
+        # The heatmap first, then the data files, then the checkpoint, which must only record points already on disk.
+        signal_sink = _GridSignalSink(self, codes)
+        sinks = [signal_sink]
+        if len(filenames) > 0:
+            sinks.append(GridCsvSink(filenames, codes, self._axes, tnow, append))
+        sinks.append(CheckpointSink(self.other.checkpoint, params))
+
+        self.engine = GridEngine(plan, active_detectors, sinks,
+                                 mes_sign=self.other.mes_sign,
+                                 done_points=resume.points if resume is not None else None,
+                                 keep_running=lambda: self.other.scanRunning)
+        # The main window, and any queue waiting on this scan, rely on SIGNAL_complete whatever happens in the engine.
+        try:
+            self.engine.run()
+        except Exception as e:
+            log.error('Exception: Grid Scan Failure - The grid scan did not finish cleanly: %s'%(e))
+            self.SIGNAL_error.emit('Grid Scan Failure', 'The grid scan did not finish cleanly: %s'%(e))
 
+        if signal_sink.began:
+            self.other.num_scans += 1
         self.SIGNAL_complete.emit()
-        
-        self.SIGNAL_data_complete.emit(which_detector, self.last_global_scan_id, 'main')
 
-        log.debug('mainWindow reference in scan end: %d'%(sys.getrefcount(self.other) - 1))
+class _GridSignalSink(ScanSink):
+    # Forwards a GridEngine's events to a GridScan's signals, which deliver them on the GUI thread.
 
-        self.done = True
+    def __init__(self, scan: GridScan, codes: list):
+        self.scan = scan
+        self.codes = codes
+        self.began = False
+
+    def begin(self, engine):
+        self.began = True
+        self.scan.SIGNAL_grid_begin.emit(self.codes, [list(v) for v in engine.plan.axis_values], [det.short_name() for det in engine.detectors])
+
+    def status(self, text: str):
+        self.scan.SIGNAL_status_update.emit(text)
+
+    def point(self, value: tuple, positions: list, rows: list, restored: bool = False):
+        for i, row in enumerate(rows):
+            self.scan.SIGNAL_grid_update.emit(i, tuple(value), row[len(positions)])
 
-    @property
-    def xdata(self, which_detector: int):
-        return np.array(self._xdata[which_detector], dtype=float)
-    
-    @property
-    def ydata(self, which_detector: int):
-        return np.array(self._ydata[which_detector], dtype=float)
+    def progress(self, percent: float, remaining: float):
+        self.scan.SIGNAL_progress.emit(int(percent), remaining)
 
-    # @property
-    # def scanId(self):
-    #     return self.last_global_scan_id
+    def error(self, title: str, message: str):
+        self.scan.SIGNAL_error.emit(title, message)
 
 class QueueExecutor(QThread):
+    """Runs a queue file.
+
+    The queue is turned into a dependency graph up front: each command waits only for the earlier commands it shares an
+    axis, the detectors or the scan thread with. Consecutive MOVEs of different axes therefore run concurrently, while
+    scans still see every earlier move finished. Completion is signalled, not polled.
+    """
     SIGNAL_error = pyqtSignal(str, str)
     SIGNAL_complete = pyqtSignal()
 
@@ -433,118 +469,208 @@ class QueueExecutor(QThread):
         super(QueueExecutor, self).__init__()
         self.other: MMC_Main = parent
         self._queue = []
+        self._start = 0
+        self._resume = None
         self._running = False
+        self._scan_idle = threading.Event()
         self.SIGNAL_error.connect(self.other.QMessageBoxCritical)
         self.SIGNAL_complete.connect(self.other.scan_complete)
 
-    def set_scan_obj(self, scan_obj: Scan):
-        self._scan_obj = scan_obj
+    def set_scan_obj(self, scan_obj: Scan, grid_scan_obj: GridScan = None):
+        """Connects the scan threads the queue drives, so that it learns when they finish.
 
-    def set_queue(self, queue: list):
+        Connected after the main window's own handlers, which therefore have run (and reset scanRunning) by the time the
+        queue moves on.
+        """
+        self._scan_obj = scan_obj
+        scan_obj.SIGNAL_complete.connect(self._scan_finished)
+        if grid_scan_obj is not None:
+            grid_scan_obj.SIGNAL_complete.connect(self._scan_finished)
+
+    def _scan_finished(self):
+        self._scan_idle.set()
+
+    def set_queue(self, queue: list, start: int = 0, resume = None):
+        """Sets the queue to run.
+
+        Args:
+            queue (list): Queue file lines.
+            start (int, optional): Index of the first command to run; earlier ones are skipped. Defaults to 0.
+            resume (ResumeState, optional): Checkpoint of a scan interrupted at command `start`, to be resumed rather
+                than restarted. Defaults to None.
+        """
         self._queue = queue
+        self._start = start
+        self._resume = resume
 
     def run(self):
+        try:
+            self._run_queue()
+        finally:
+            self.other.checkpoint.suspend_queue()
+
+    def _run_queue(self):
         log.info('QueueExecutor - Beginning processing of the following queue: %s'%(self._queue))
 
-        for cmd in self._queue:
-            log.info('QueueExecutor - Processing command: %s'%(cmd))
+        # Cleared once the whole queue has run; an interrupted queue leaves it behind to be resumed.
+        self.other.checkpoint.begin_queue(self._queue)
+        start, resume = self._start, self._resume
+        self._start, self._resume = 0, None
+        self._resume_at = (start, resume)
 
+        # A skipped SAVENEXT still applies if its scan has not run yet.
+        for cmd in self._queue[:start]:
             args = cmd.split(' ')
+            if args[0] == 'SAVENEXT':
+                self.other.autosave_next_scan = True
+                self.other.autosave_next_dir = args[1]
+            elif args[0] == 'RUN':
+                self.other.autosave_next_scan = False
+                self.other.autosave_next_dir = None
 
-            if cmd.startswith('#') or cmd == '':
-                log.info('QueueExecutor - Skipping comment or empty line.')
-                continue
-            
-            log.debug('Setting scanRunning to True.')
-            self.other.scanRunning = True
-            self.other.disable_movement_sensitive_buttons(True)
-
-            if args[0] == 'RUN':
-                if args[1] == 'MDA' or args[1] == 'SRA' or args[1] == 'SAA' or args[1] == 'STA' or args[1] == 'DRA':
-                    if args[1] == 'MDA':
-                        log.info('QueueExecutor - Running MDA scan.')
-                        self.other.scan.ctrl_axis = ScanAxis.MAIN
-                    elif args[1] == 'SRA':
-                        log.info('QueueExecutor - Running SRA scan.')
-                        self.other.scan.ctrl_axis = ScanAxis.SAMPLE
-                        self.other.scan.type = SampleScanType.ROTATION
-                    elif args[1] == 'STA':
-                        log.info('QueueExecutor - Running STA scan.')
-                        self.other.scan.ctrl_axis = ScanAxis.SAMPLE
-                        self.other.scan.type = SampleScanType.TRANSLATION
-                    elif args[1] == 'DRA':
-                        log.info('QueueExecutor - Running DRA scan.')
-                        self.other.scan.ctrl_axis = ScanAxis.DETECTOR
-
-                    # TODO: which detector
-                    self.other.UIE_mgw_start_qdsb.setValue(float(args[2]))
-                    self.other.UIE_mgw_stop_qdsb.setValue(float(args[3]))
-                    self.other.UIE_mgw_step_qdsb.setValue(float(args[4]))
-
-                    self.other.scan.done = False
-
-                    if self.other.scanRunning == False:
-                        log.error('QueueExecutor - Scan was stopped before it started.')
-                        log.debug('Setting scanRunning to True (again).')
-                        self.other.scanRunning = True
-
-                    self.other.scan.start()
-
-                    while not self.other.scan.done or self.other.scanRunning:
-                        log.debug('QueueExecutor - Waiting for scan to finish.')
-                        sleep(0.1)
-                else:
-                    log.error('QueueExecutor - Unknown Command: Unknown command argument: %s'%(args[1]))
-                    self.SIGNAL_error.emit('Unknown Command', 'Unknown command argument: %s'%(args[1]))
-                    self.SIGNAL_complete.emit()
-                    return
-
-            elif args[0] == 'MOVE':
-                if args[1] == 'MDA' or args[1] == 'SRA' or args[1] == 'SAA' or args[1] == 'STA' or args[1] == 'DRA':
-
-                    pos = float(args[2])
+        tasks = build_graph(self._queue, start)
+        waiting = {task.index: task for task in tasks}
+        finished = set()
+        running = {}
+        failed = False
 
+        pool = ThreadPoolExecutor(max_workers=len(QUEUE_RESOURCES), thread_name_prefix='queue')
+        try:
+            while waiting or running:
+                if not failed:
+                    for task in [t for t in waiting.values() if t.after <= finished]:
+                        del waiting[task.index]
+                        log.info('QueueExecutor - Processing command: %s'%(task.cmd))
+                        # A resumed queue restarts at the first command that had not finished.
+                        self.other.checkpoint.queue_index(min(list(waiting) + [t.index for t in running.values()] + [task.index]))
+                        running[pool.submit(self._run_command, task)] = task
+                if not running:
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
                     try:
-                        if args[1] == 'MDA':
-                            log.info('QueueExecutor - Moving MDA axis.')
-                            self.other.motion_controllers.main_drive_axis.move_to(pos, True)
-                        elif args[1] == 'SRA':
-                            log.info('QueueExecutor - Moving SRA axis.')
-                            self.other.motion_controllers.sample_rotation_axis.move_to(pos, True)
-                        elif args[1] == 'STA':
-                            log.info('QueueExecutor - Moving STA axis.')
-                            self.other.motion_controllers.sample_translation_axis.move_to(pos, True)
-                        elif args[1] == 'DRA':
-                            log.info('QueueExecutor - Moving DRA axis.')
-                            self.other.motion_controllers.detector_rotation_axis.move_to(pos, True)
+                        ok = future.result()
                     except Exception as e:
-                        log.error('QueueExecutor - Exception: Move Failure - Axis failed to move: %s'%(e))
-                        self.SIGNAL_error.emit('Move Failure', 'Failure occurred while attempting to process the queue command:\n%s\nAxis failed to move: %s'%(cmd, e))
-                        self.SIGNAL_complete.emit()
-                        return
-
-                else:
-                    log.error('QueueExecutor - Unknown scan type: %s'%(args[1]))
-                    self.SIGNAL_error.emit('Unknown Command', 'Unknown command argument: %s'%(args[1]))
-                    self.SIGNAL_complete.emit()
-                    return
-
-            elif args[0] == 'SAVENEXT':
-                self.other.autosave_next_scan = True
-                self.other.autosave_next_dir = args[1]
-            elif args[0] == 'WAIT':
-                sleep(float(args[1]))
-            else:
-                log.error('QueueExecutor - Unknown command argument: %s'%(args[0]))
-                self.SIGNAL_error.emit('Unknown Command', 'Unknown command argument: %s'%(args[0]))
-                self.SIGNAL_complete.emit()
-                return
-
-            log.info('QueueExecutor - Finished command: %s'%(cmd))
+                        log.error('QueueExecutor - Exception while processing %s: %s'%(task.cmd, e))
+                        self.SIGNAL_error.emit('Queue Failure', 'Failure occurred while attempting to process the queue command:\n%s\n%s'%(task.cmd, e))
+                        ok = False
+                    if ok:
+                        log.info('QueueExecutor - Finished command: %s'%(task.cmd))
+                        finished.add(task.index)
+                    else:
+                        # Commands already running are let finish; nothing further starts.
+                        failed = True
+        finally:
+            pool.shutdown(wait=True)
+
+        if failed:
+            self.SIGNAL_complete.emit()
+            return
 
         log.info('QueueExecutor - Finished processing queue.')
+        self.other.checkpoint.end_queue()
+
+    def _run_command(self, task: QueueTask) -> bool:
+        # Runs one queue command on a worker thread. Reports its own errors; returns False if the queue should stop.
+        cmd, args = task.cmd, task.args
+
+        log.debug('Setting scanRunning to True.')
+        self.other.scanRunning = True
+        self.other.disable_movement_sensitive_buttons(True)
+
+        if args[0] == 'RUN':
+            if args[1] in RUN_AXES:
+                log.info('QueueExecutor - Running %s scan.'%(args[1]))
+                # Scan reads its range from the spinboxes of the axis it scans, and the sample axis from the scan type.
+                if args[1] == 'MDA':
+                    self.other.scan.ctrl_axis = ScanAxis.MAIN
+                    spinboxes = (self.other.UIE_mgw_start_qdsb, self.other.UIE_mgw_stop_qdsb, self.other.UIE_mgw_step_qdsb)
+                elif args[1] == 'SRA' or args[1] == 'STA':
+                    self.other.scan.ctrl_axis = ScanAxis.SAMPLE
+                    scan_type = SampleScanType.ROTATION if args[1] == 'SRA' else SampleScanType.TRANSLATION
+                    self.other.UIE_mgw_sm_scan_type_qcb.setCurrentIndex(scan_type.value)
+                    spinboxes = (self.other.UIE_mgw_sm_start_set_qdsb, self.other.UIE_mgw_sm_end_set_qdsb, self.other.UIE_mgw_sm_step_set_qdsb)
+                elif args[1] == 'DRA':
+                    self.other.scan.ctrl_axis = ScanAxis.DETECTOR
+                    spinboxes = (self.other.UIE_mgw_dm_start_set_qdsb, self.other.UIE_mgw_dm_end_set_qdsb, self.other.UIE_mgw_dm_step_set_qdsb)
+
+                # TODO: which detector
+                for spinbox, value in zip(spinboxes, args[2:5]):
+                    spinbox.setValue(float(value))
+
+                start, resume = self._resume_at
+                if task.index == start and resume is not None and resume.scan is not None:
+                    self.other.scan.resume = resume
+
+                self._run_scan_thread(self.other.scan)
+            else:
+                log.error('QueueExecutor - Unknown Command: Unknown command argument: %s'%(args[1]))
+                self.SIGNAL_error.emit('Unknown Command', 'Unknown command argument: %s'%(args[1]))
+                return False
+
+        elif args[0] == 'MOVE':
+            if args[1] in AXIS_CODES:
+                pos = float(args[2])
+                try:
+                    mc = getattr(self.other.motion_controllers, AXIS_CODES[args[1]])
+                    if mc is None:
+                        raise RuntimeError('Axis %s is not connected.'%(args[1]))
+                    log.info('QueueExecutor - Moving %s axis.'%(args[1]))
+                    mc.move_to(pos, True)
+                except Exception as e:
+                    log.error('QueueExecutor - Exception: Move Failure - Axis failed to move: %s'%(e))
+                    self.SIGNAL_error.emit('Move Failure', 'Failure occurred while attempting to process the queue command:\n%s\nAxis failed to move: %s'%(cmd, e))
+                    return False
+            else:
+                log.error('QueueExecutor - Unknown scan type: %s'%(args[1]))
+                self.SIGNAL_error.emit('Unknown Command', 'Unknown command argument: %s'%(args[1]))
+                return False
 
-        pass
+        elif args[0] == 'GRID':
+            # GRID <axis> <start> <stop> <step> <axis> <start> <stop> <step> ..., outermost axis first.
+            try:
+                if (len(args) - 1) % 4 != 0:
+                    raise ValueError('expected groups of <axis> <start> <stop> <step>')
+                axes = [(args[i], float(args[i + 1]), float(args[i + 2]), float(args[i + 3])) for i in range(1, len(args), 4)]
+            except ValueError as e:
+                log.error('QueueExecutor - Invalid GRID command: %s'%(e))
+                self.SIGNAL_error.emit('Invalid Command', 'Invalid GRID command:\n%s\n%s'%(cmd, e))
+                return False
+
+            log.info('QueueExecutor - Running grid scan.')
+            self.other.grid_scan.set_grid(axes)
+
+            start, resume = self._resume_at
+            if task.index == start and resume is not None and resume.scan is not None:
+                self.other.grid_scan.resume = resume
+
+            self._run_scan_thread(self.other.grid_scan)
+
+        elif args[0] == 'SAVENEXT':
+            self.other.autosave_next_scan = True
+            self.other.autosave_next_dir = args[1]
+        elif args[0] == 'WAIT':
+            sleep(float(args[1]))
+        else:
+            log.error('QueueExecutor - Unknown command argument: %s'%(args[0]))
+            self.SIGNAL_error.emit('Unknown Command', 'Unknown command argument: %s'%(args[0]))
+            return False
+
+        return True
+
+    def _run_scan_thread(self, scan_thread: QThread):
+        # Starts a Scan or GridScan and blocks until the main window has handled its completion.
+        self._scan_idle.clear()
+        scan_thread.done = False
+        if self.other.scanRunning == False:
+            log.error('QueueExecutor - Scan was stopped before it started.')
+            log.debug('Setting scanRunning to True (again).')
+            self.other.scanRunning = True
+        scan_thread.start()
+        self._scan_idle.wait()
+        scan_thread.wait()
 
 class ScanType(Enum):
     ROTATION = 0